@@ -226,6 +226,13 @@ class CloudController(object):
             return services[0]['availability_zone']
         return 'unknown zone'
 
+    def _get_availability_zones_by_host(self, context):
+        """Map every host to its availability zone with a single query."""
+        zones = {}
+        for service in db.service_get_all(context.elevated()):
+            zones.setdefault(service['host'], service['availability_zone'])
+        return zones
+
     def _get_image_state(self, image):
         # NOTE(vish): fallback status if image_state isn't set
         state = image.get('status')
@@ -973,10 +980,27 @@ class CloudController(object):
     def _format_instance_bdm(self, context, instance_id, root_device_name,
                              result):
         """Format InstanceBlockDeviceMappingResponseItemType"""
+        bdms = db.block_device_mapping_get_all_by_instance(context,
+                                                           instance_id)
+        volumes = self._get_bdm_volumes(context, bdms)
+        self._format_block_device_mappings(bdms, volumes, root_device_name,
+                                           result)
+
+    def _get_bdm_volumes(self, context, bdms):
+        """Look up the volumes attached by bdms, keyed by volume id"""
+        volume_ids = set(bdm['volume_id'] for bdm in bdms
+                         if bdm['volume_id'] is not None and
+                            not bdm['no_device'])
+        if not volume_ids:
+            return {}
+        volumes = self.volume_api.get_all_by_ids(context, list(volume_ids))
+        return dict((vol['id'], vol) for vol in volumes)
+
+    def _format_block_device_mappings(self, bdms, volumes, root_device_name,
+                                      result):
         root_device_type = 'instance-store'
         mapping = []
-        for bdm in db.block_device_mapping_get_all_by_instance(context,
-                                                               instance_id):
+        for bdm in bdms:
             volume_id = bdm['volume_id']
             if (volume_id is None or bdm['no_device']):
                 continue
@@ -986,7 +1010,7 @@ class CloudController(object):
                 assert not bdm['virtual_name']
                 root_device_type = 'ebs'
 
-            vol = self.volume_api.get(context, volume_id=volume_id)
+            vol = volumes[volume_id]
             LOG.debug(_("vol = %s\n"), vol)
             # TODO(yamahata): volume attach time
             ebs = {'volumeId': volume_id,
@@ -1009,18 +1033,29 @@ class CloudController(object):
         reservations = {}
         # NOTE(vish): instance_id is an optional list of ids to filter by
         if instance_id:
-            instances = []
-            for ec2_id in instance_id:
-                internal_id = ec2utils.ec2_id_to_id(ec2_id)
-                instance = self.compute_api.get(context,
-                                                instance_id=internal_id)
-                instances.append(instance)
+            internal_ids = [ec2utils.ec2_id_to_id(ec2_id)
+                            for ec2_id in instance_id]
+            instances = self.compute_api.get_all_by_ids(context,
+                                                        internal_ids)
         else:
             instances = self.compute_api.get_all(context, **kwargs)
+        if not context.is_admin:
+            instances = [instance for instance in instances
+                         if instance['image_ref'] != str(FLAGS.vpn_image_id)]
+
+        # NOTE: look up the block devices, volumes and availability zones
+        # of all the instances up front, rather than once per instance.
+        instance_bdms = {}
+        for bdm in db.block_device_mapping_get_all_by_instances(context,
+                [instance['id'] for instance in instances]):
+            instance_bdms.setdefault(bdm['instance_id'], []).append(bdm)
+        volumes = self._get_bdm_volumes(context,
+                [bdm for bdms in instance_bdms.values() for bdm in bdms])
+        zones = {}
+        if instances:
+            zones = self._get_availability_zones_by_host(context)
+
         for instance in instances:
-            if not context.is_admin:
-                if instance['image_ref'] == str(FLAGS.vpn_image_id):
-                    continue
             i = {}
             instance_id = instance['id']
             ec2_id = ec2utils.id_to_ec2_id(instance_id)
@@ -1064,10 +1099,10 @@ class CloudController(object):
             i['displayDescription'] = instance['display_description']
             i['rootDeviceName'] = (instance.get('root_device_name') or
                                    _DEFAULT_ROOT_DEVICE_NAME)
-            self._format_instance_bdm(context, instance_id,
-                                      i['rootDeviceName'], i)
-            host = instance['host']
-            zone = self._get_availability_zone_by_host(context, host)
+            self._format_block_device_mappings(
+                    instance_bdms.get(instance_id, []), volumes,
+                    i['rootDeviceName'], i)
+            zone = zones.get(instance['host'], 'unknown zone')
             i['placement'] = {'availabilityZone': zone}
             if instance['reservation_id'] not in reservations:
                 r = {}
@@ -141,6 +141,7 @@ class VolumeController(object):
                                             vol.get('display_description'))
 
         # Work around problem that instance is lazy-loaded...
+        new_volume = dict(new_volume.iteritems())
         new_volume['instance'] = None
 
         retval = _translate_volume_detail_view(context, new_volume)
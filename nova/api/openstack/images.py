@@ -363,6 +363,33 @@ class ImageXMLSerializer(wsgi.XMLDictSerializer):
                                        detailed=True)
         return self.to_xml_string(node, True)
 
+    def _stream_image(self, image, indent):
+        """Streaming counterpart of _image_to_xml."""
+        attrs = {'id': str(image['id']), 'name': image['name']}
+        for piece in self._iter_start_tag('image', attrs, indent):
+            yield piece
+        if not image['links']:
+            yield '/>\n'
+            return
+        yield '>\n'
+        for piece in self._stream_link_nodes(image['links'],
+                                             indent + wsgi.XML_INDENT):
+            yield piece
+        yield '%s</image>\n' % indent
+
+    def _stream_image_detailed(self, image, indent):
+        # a detailed image is small, only the list isn't built as a DOM
+        node = self._image_to_xml_detailed(minidom.Document(), image)
+        return self._stream_dom_node(node, indent)
+
+    def _stream_index(self, images_dict):
+        return self._stream_node_list('images', images_dict['images'],
+                                      self._stream_image, True)
+
+    def _stream_detail(self, images_dict):
+        return self._stream_node_list('images', images_dict['images'],
+                                      self._stream_image_detailed, True)
+
     def show(self, image_dict):
         xml_doc = minidom.Document()
         node = self._image_to_xml_detailed(xml_doc,
@@ -35,6 +35,7 @@ import nova.api.openstack.views.images
 import nova.api.openstack.views.servers
 from nova.api.openstack import wsgi
 import nova.api.openstack
+import nova.context
 from nova.scheduler import api as scheduler_api
 
 
@@ -65,9 +66,13 @@ class Controller(object):
             return exc.HTTPBadRequest(explanation=str(err))
         return servers
 
-    def _build_view(self, req, instance, is_detail=False):
+    def _get_view_builder(self, req, finished_migrations=None):
         raise NotImplementedError()
 
+    def _build_view(self, req, instance, is_detail=False):
+        builder = self._get_view_builder(req)
+        return builder.build(instance, is_detail=is_detail)
+
     def _limit_items(self, items, req):
         raise NotImplementedError()
 
@@ -91,7 +96,19 @@ class Controller(object):
                 fixed_ip=fixed_ip,
                 recurse_zones=recurse_zones)
         limited_list = self._limit_items(instance_list, req)
-        servers = [self._build_view(req, inst, is_detail)['server']
+
+        # Look up the resize state of the whole page at once rather than
+        # once per server while building the views.
+        finished_migrations = None
+        if is_detail:
+            uuids = [inst['uuid'] for inst in limited_list
+                     if not inst.get('_is_precooked', False)]
+            finished_migrations = \
+                    self.compute_api.get_instances_with_finished_migration(
+                            nova.context.get_admin_context(), uuids)
+
+        builder = self._get_view_builder(req, finished_migrations)
+        servers = [builder.build(inst, is_detail)['server']
                 for inst in limited_list]
         return dict(servers=servers)
 
@@ -423,10 +440,10 @@ class ControllerV10(Controller):
     def _flavor_id_from_req_data(self, data):
         return data['server']['flavorId']
 
-    def _build_view(self, req, instance, is_detail=False):
+    def _get_view_builder(self, req, finished_migrations=None):
         addresses = nova.api.openstack.views.addresses.ViewBuilderV10()
-        builder = nova.api.openstack.views.servers.ViewBuilderV10(addresses)
-        return builder.build(instance, is_detail=is_detail)
+        return nova.api.openstack.views.servers.ViewBuilderV10(addresses,
+                finished_migrations)
 
     def _limit_items(self, items, req):
         return common.limited(items, req)
@@ -497,17 +514,16 @@ class ControllerV11(Controller):
 
         return common.get_id_from_href(flavor_ref)
 
-    def _build_view(self, req, instance, is_detail=False):
+    def _get_view_builder(self, req, finished_migrations=None):
         base_url = req.application_url
         flavor_builder = nova.api.openstack.views.flavors.ViewBuilderV11(
             base_url)
         image_builder = nova.api.openstack.views.images.ViewBuilderV11(
             base_url)
         addresses_builder = nova.api.openstack.views.addresses.ViewBuilderV11()
-        builder = nova.api.openstack.views.servers.ViewBuilderV11(
-            addresses_builder, flavor_builder, image_builder, base_url)
-
-        return builder.build(instance, is_detail=is_detail)
+        return nova.api.openstack.views.servers.ViewBuilderV11(
+            addresses_builder, flavor_builder, image_builder, base_url,
+            finished_migrations)
 
     def _action_change_password(self, input_dict, req, id):
         context = req.environ['nova.context']
@@ -713,6 +729,33 @@ class ServerXMLSerializer(wsgi.XMLDictSerializer):
                                        detailed=True)
         return self.to_xml_string(node, True)
 
+    def _stream_server(self, server, indent):
+        """Streaming counterpart of _server_to_xml."""
+        attrs = {'id': str(server['id']), 'name': server['name']}
+        for piece in self._iter_start_tag('server', attrs, indent):
+            yield piece
+        if not server['links']:
+            yield '/>\n'
+            return
+        yield '>\n'
+        for piece in self._stream_link_nodes(server['links'],
+                                             indent + wsgi.XML_INDENT):
+            yield piece
+        yield '%s</server>\n' % indent
+
+    def _stream_server_detailed(self, server, indent):
+        # a detailed server is small, only the list isn't built as a DOM
+        node = self._server_to_xml_detailed(minidom.Document(), server)
+        return self._stream_dom_node(node, indent)
+
+    def _stream_index(self, servers_dict):
+        return self._stream_node_list('servers', servers_dict['servers'],
+                                      self._stream_server, True)
+
+    def _stream_detail(self, servers_dict):
+        return self._stream_node_list('servers', servers_dict['servers'],
+                                      self._stream_server_detailed, True)
+
     def show(self, server_dict):
         xml_doc = minidom.Document()
         node = self._server_to_xml_detailed(xml_doc,
@@ -30,6 +30,20 @@ from nova.api.openstack.views import images as images_view
 from nova import utils
 
 
+# model class -> names of its columns, i.e. the keys of dict(model)
+_MODEL_FIELDS = {}
+
+
+def _has_field(inst, name):
+    """Return whether name is in dict(inst), without copying inst."""
+    if isinstance(inst, dict):
+        return name in inst
+    cls = inst.__class__
+    if cls not in _MODEL_FIELDS:
+        _MODEL_FIELDS[cls] = frozenset(dict(inst))
+    return name in _MODEL_FIELDS[cls]
+
+
 class ViewBuilder(object):
     """Model a server response as a python dictionary.
 
@@ -38,8 +52,15 @@ class ViewBuilder(object):
 
     """
 
-    def __init__(self, addresses_builder):
+    def __init__(self, addresses_builder, finished_migrations=None):
+        """
+        :param finished_migrations: set of uuids of the instances that have
+                                    a finished migration, prefetched for all
+                                    of the servers to be built. If None,
+                                    each detailed server is looked up.
+        """
         self.addresses_builder = addresses_builder
+        self.finished_migrations = finished_migrations
 
     def build(self, inst, is_detail):
         """Return a dict that represenst a server."""
@@ -80,10 +101,7 @@ class ViewBuilder(object):
             'name': inst['display_name'],
             'status': power_mapping[inst.get('state')]}
 
-        ctxt = nova.context.get_admin_context()
-        compute_api = nova.compute.API()
-
-        if compute_api.has_finished_migration(ctxt, inst['uuid']):
+        if self._has_finished_migration(inst):
             inst_dict['status'] = 'RESIZE-CONFIRM'
 
         # Return the metadata as a dictionary
@@ -102,6 +120,13 @@ class ViewBuilder(object):
 
         return dict(server=inst_dict)
 
+    def _has_finished_migration(self, inst):
+        if self.finished_migrations is not None:
+            return inst['uuid'] in self.finished_migrations
+        ctxt = nova.context.get_admin_context()
+        compute_api = nova.compute.API()
+        return compute_api.has_finished_migration(ctxt, inst['uuid'])
+
     def _build_addresses(self, response, inst):
         """Return the addresses sub-resource of a server."""
         raise NotImplementedError()
@@ -125,14 +150,14 @@ class ViewBuilderV10(ViewBuilder):
         response['uuid'] = inst['uuid']
 
     def _build_image(self, response, inst):
-        if 'image_ref' in dict(inst):
+        if _has_field(inst, 'image_ref'):
             image_ref = inst['image_ref']
             if str(image_ref).startswith('http'):
                 raise exception.ListingImageRefsNotSupported()
             response['imageId'] = int(image_ref)
 
     def _build_flavor(self, response, inst):
-        if 'instance_type' in dict(inst):
+        if _has_field(inst, 'instance_type'):
             response['flavorId'] = inst['instance_type']['flavorid']
 
     def _build_addresses(self, response, inst):
@@ -142,8 +167,8 @@ class ViewBuilderV10(ViewBuilder):
 class ViewBuilderV11(ViewBuilder):
     """Model an Openstack API V1.0 server response."""
     def __init__(self, addresses_builder, flavor_builder, image_builder,
-                 base_url):
-        ViewBuilder.__init__(self, addresses_builder)
+                 base_url, finished_migrations=None):
+        ViewBuilder.__init__(self, addresses_builder, finished_migrations)
         self.flavor_builder = flavor_builder
         self.image_builder = image_builder
         self.base_url = base_url
@@ -162,7 +187,7 @@ class ViewBuilderV11(ViewBuilder):
         return response
 
     def _build_image(self, response, inst):
-        if 'image_ref' in dict(inst):
+        if _has_field(inst, 'image_ref'):
             image_href = inst['image_ref']
             image_id = str(common.get_id_from_href(image_href))
             _bookmark = self.image_builder.generate_bookmark(image_id)
@@ -177,7 +202,7 @@ class ViewBuilderV11(ViewBuilder):
             }
 
     def _build_flavor(self, response, inst):
-        if "instance_type" in dict(inst):
+        if _has_field(inst, "instance_type"):
             flavor_id = inst["instance_type"]['flavorid']
             flavor_ref = self.flavor_builder.generate_href(flavor_id)
             flavor_bookmark = self.flavor_builder.generate_bookmark(flavor_id)
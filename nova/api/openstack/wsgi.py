@@ -1,5 +1,6 @@
 
 import json
+import StringIO
 import webob
 from xml.dom import minidom
 from xml.parsers import expat
@@ -15,9 +16,19 @@ XMLNS_V10 = 'http://docs.rackspacecloud.com/servers/api/v1.0'
 XMLNS_V11 = 'http://docs.openstack.org/compute/api/v1.1'
 XMLNS_ATOM = 'http://www.w3.org/2005/Atom'
 
+XML_INDENT = '    '
+# Size of the chunks streamed XML responses are written in
+XML_CHUNK_SIZE = 64 * 1024
+
 LOG = logging.getLogger('nova.api.openstack.wsgi')
 
 
+def _xml_escape(data):
+    """Escape text or an attribute value the way minidom writes it."""
+    return data.replace('&', '&amp;').replace('<', '&lt;').\
+                replace('"', '&quot;').replace('>', '&gt;')
+
+
 class Request(webob.Request):
     """Add some Openstack API-specific logic to the base webob.Request."""
 
@@ -305,16 +316,189 @@ class XMLDictSerializer(DictSerializer):
         self.xmlns = xmlns
 
     def default(self, data):
+        return ''.join(self._iter_xml(data))
+
+    def serialize_iter(self, data, action='default'):
+        """Serialize data, returning an iterator over chunks of the result.
+
+        The generic XML serialization, and actions a subclass streams with
+        a _stream_<action> method, are written without building the DOM of
+        the whole document; other actions are returned as a single chunk.
+
+        """
+        stream_method = getattr(self, '_stream_%s' % action, None)
+        if stream_method is not None:
+            return self._iter_chunks(self._iter_encoded(stream_method(data)))
+        action_method = getattr(self, str(action), self.default)
+        if getattr(action_method, 'im_func', None) is \
+                XMLDictSerializer.default.im_func:
+            return self._iter_chunks(self._iter_xml(data))
+        return iter([action_method(data)])
+
+    def _iter_encoded(self, pieces):
+        for piece in pieces:
+            if isinstance(piece, unicode):
+                piece = piece.encode('UTF-8')
+            yield piece
+
+    def _iter_chunks(self, pieces):
+        """Coalesce small pieces of output into chunks of a sane size."""
+        chunk = []
+        size = 0
+        for piece in pieces:
+            chunk.append(piece)
+            size += len(piece)
+            if size >= XML_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+    def _iter_xml(self, data):
+        """Yield the UTF-8 encoded output of to_xml_string(_to_xml_node()).
+
+        The output is byte for byte what minidom's toprettyxml writes for
+        the tree _to_xml_node would build, without building the tree.
+
+        """
         # We expect data to contain a single key which is the XML root.
         root_key = data.keys()[0]
-        doc = minidom.Document()
-        node = self._to_xml_node(doc, self.metadata, root_key, data[root_key])
+        root_attrs = {}
+        if self.xmlns is not None:
+            root_attrs['xmlns'] = self.xmlns
+        return self._iter_encoded(self._iter_xml_node(self.metadata,
+                                  root_key, data[root_key], '', root_attrs))
+
+    def _iter_xml_node(self, metadata, nodename, data, indent,
+                       extra_attrs=None):
+        """Streaming counterpart of _to_xml_node."""
+        attrs = {}
+        text = None
+        # each child is either a (metadata, nodename, data) triple to
+        # recurse on, or a collection item given as (None, name, attrs, text)
+        children = ()
+        has_children = False
+
+        xmlns = metadata.get('xmlns', None)
+        if xmlns:
+            attrs['xmlns'] = xmlns
 
-        return self.to_xml_string(node)
+        #TODO(bcwaldon): accomplish this without a type-check
+        if type(data) is list:
+            has_children = bool(data)
+            collections = metadata.get('list_collections', {})
+            if nodename in collections:
+                coll = collections[nodename]
+                children = ((None, coll['item_name'],
+                             {coll['item_key']: str(item)}, None)
+                            for item in data)
+            else:
+                singular = metadata.get('plurals', {}).get(nodename, None)
+                if singular is None:
+                    if nodename.endswith('s'):
+                        singular = nodename[:-1]
+                    else:
+                        singular = 'item'
+                children = ((metadata, singular, item) for item in data)
+        #TODO(bcwaldon): accomplish this without a type-check
+        elif type(data) is dict:
+            collections = metadata.get('dict_collections', {})
+            if nodename in collections:
+                has_children = bool(data)
+                coll = collections[nodename]
+                children = ((None, coll['item_name'],
+                             {coll['item_key']: str(k)}, str(v))
+                            for k, v in data.items())
+            else:
+                names = metadata.get('attributes', {}).get(nodename, {})
+                keys = []
+                for k, v in data.items():
+                    if k in names:
+                        attrs[k] = str(v)
+                    else:
+                        keys.append(k)
+                has_children = bool(keys)
+                children = ((metadata, k, data[k]) for k in keys)
+        else:
+            # Type is atom
+            text = str(data)
+
+        if extra_attrs:
+            attrs.update(extra_attrs)
+
+        for piece in self._iter_start_tag(nodename, attrs, indent):
+            yield piece
+        if text is not None:
+            yield '>%s</%s>\n' % (_xml_escape(text), nodename)
+        elif has_children:
+            yield '>\n'
+            child_indent = indent + XML_INDENT
+            for child in children:
+                if child[0] is None:
+                    _meta, name, item_attrs, item_text = child
+                    for piece in self._iter_start_tag(name, item_attrs,
+                                                      child_indent):
+                        yield piece
+                    if item_text is None:
+                        yield '/>\n'
+                    else:
+                        yield '>%s</%s>\n' % (_xml_escape(item_text), name)
+                else:
+                    for piece in self._iter_xml_node(child[0], child[1],
+                                                     child[2], child_indent):
+                        yield piece
+            yield '%s</%s>\n' % (indent, nodename)
+        else:
+            yield '/>\n'
+
+    def _iter_start_tag(self, nodename, attrs, indent):
+        yield '%s<%s' % (indent, nodename)
+        # minidom writes attributes sorted by name
+        for name in sorted(attrs.keys()):
+            yield ' %s="%s"' % (name, _xml_escape(attrs[name]))
+
+    def _stream_node_list(self, nodename, items, stream_item, has_atom=False):
+        """Stream a document holding an element per item, like the one
+        to_xml_string writes, one item at a time.
+
+        :param stream_item: called with an item and the indent to write it
+                            at, yields the pieces of the item's element
+
+        """
+        attrs = {}
+        if self.xmlns is not None:
+            attrs['xmlns'] = self.xmlns
+        if has_atom:
+            attrs['xmlns:atom'] = XMLNS_ATOM
+        for piece in self._iter_start_tag(nodename, attrs, ''):
+            yield piece
+        if not items:
+            yield '/>\n'
+            return
+        yield '>\n'
+        for item in items:
+            for piece in stream_item(item, XML_INDENT):
+                yield piece
+        yield '</%s>\n' % nodename
+
+    def _stream_dom_node(self, node, indent):
+        """Yield the XML of a DOM node written as part of a document."""
+        writer = StringIO.StringIO()
+        node.writexml(writer, indent, XML_INDENT, '\n')
+        yield writer.getvalue()
+
+    def _stream_link_nodes(self, links, indent):
+        """Streaming counterpart of _create_link_nodes."""
+        for link in links:
+            attrs = {'rel': link['rel'], 'href': link['href']}
+            for piece in self._iter_start_tag('atom:link', attrs, indent):
+                yield piece
+            yield '/>\n'
 
     def to_xml_string(self, node, has_atom=False):
         self._add_xmlns(node, has_atom)
-        return node.toprettyxml(indent='    ', encoding='UTF-8')
+        return node.toprettyxml(indent=XML_INDENT, encoding='UTF-8')
 
     #NOTE (ameade): the has_atom should be removed after all of the
     # xml serializers and view builders have been updated to the current
@@ -432,7 +616,16 @@ class ResponseSerializer(object):
         response.headers['Content-Type'] = content_type
         if data is not None:
             serializer = self.get_body_serializer(content_type)
-            response.body = serializer.serialize(data, action)
+            if hasattr(serializer, 'serialize_iter'):
+                # Serialize the whole body here rather than as it is sent
+                # so errors still turn into a fault, but keep it in chunks
+                # instead of joining them into one more copy.
+                chunks = list(serializer.serialize_iter(data, action))
+                response.app_iter = chunks
+                response.content_length = sum(len(chunk)
+                                              for chunk in chunks)
+            else:
+                response.body = serializer.serialize(data, action)
 
     def get_body_serializer(self, content_type):
         try:
@@ -35,6 +35,7 @@ from nova import volume
 from nova.api.ec2 import ec2utils
 from nova.compute import instance_types
 from nova.compute import power_state
+from nova.compute.utils import reserve_quota_release
 from nova.compute.utils import terminate_volumes
 from nova.scheduler import api as scheduler_api
 from nova.db import base
@@ -250,11 +251,30 @@ class API(base.Base):
 
         return (num_instances, base_options, image)
 
-    def _update_image_block_device_mapping(self, elevated_context, instance_id,
-                                           mappings):
+    def _reserve_instances(self, context, num_instances, base_options):
+        """Reserve quota for num_instances built from base_options.
+
+        Raises a QuotaError if another request used up the quota since
+        _check_create_parameters() looked at it.
+        """
+        try:
+            return quota.reserve(context,
+                    instances=num_instances,
+                    cores=num_instances * base_options['vcpus'],
+                    ram=num_instances * base_options['memory_mb'])
+        except exception.OverQuota:
+            pid = context.project_id
+            LOG.warn(_("Quota exceeded for %(pid)s,"
+                    " tried to run %(num_instances)s instances") % locals())
+            message = _("Instance quota exceeded. You cannot run any "
+                        "more instances of this type.")
+            raise quota.QuotaError(message, "InstanceLimitExceeded")
+
+    def _image_block_device_mapping(self, mappings):
         """tell vm driver to create ephemeral/swap device at boot time by
-        updating BlockDeviceMapping
+        returning BlockDeviceMapping values for them
         """
+        values_list = []
         for bdm in ec2utils.mappings_prepend_dev(mappings):
             LOG.debug(_("bdm %s"), bdm)
 
@@ -264,23 +284,21 @@ class API(base.Base):
 
             assert (virtual_name == 'swap' or
                     virtual_name.startswith('ephemeral'))
-            values = {
-                'instance_id': instance_id,
+            values_list.append({
                 'device_name': bdm['device'],
-                'virtual_name': virtual_name, }
-            self.db.block_device_mapping_update_or_create(elevated_context,
-                                                          values)
-
-    def _update_block_device_mapping(self, elevated_context, instance_id,
-                                     block_device_mapping):
-        """tell vm driver to attach volume at boot time by updating
-        BlockDeviceMapping
+                'virtual_name': virtual_name, })
+        return values_list
+
+    def _block_device_mapping(self, block_device_mapping):
+        """tell vm driver to attach volume at boot time by returning
+        BlockDeviceMapping values for them
         """
+        values_list = []
         for bdm in block_device_mapping:
             LOG.debug(_('bdm %s'), bdm)
             assert 'device_name' in bdm
 
-            values = {'instance_id': instance_id}
+            values = {}
             for key in ('device_name', 'delete_on_termination', 'virtual_name',
                         'snapshot_id', 'volume_id', 'volume_size',
                         'no_device'):
@@ -296,8 +314,23 @@ class API(base.Base):
                           'virtual_name'):
                     values[k] = None
 
-            self.db.block_device_mapping_update_or_create(elevated_context,
-                                                          values)
+            values_list.append(values)
+        return values_list
+
+    def _merge_block_device_mappings(self, *mapping_lists):
+        """Merge BlockDeviceMapping values by device name, later values
+        overriding earlier ones."""
+        merged = {}
+        device_names = []
+        for mappings in mapping_lists:
+            for values in mappings:
+                device_name = values['device_name']
+                if device_name in merged:
+                    merged[device_name].update(values)
+                else:
+                    merged[device_name] = dict(values)
+                    device_names.append(device_name)
+        return [merged[device_name] for device_name in device_names]
 
     def create_db_entry_for_new_instance(self, context, image, base_options,
              security_group, block_device_mapping, num=1):
@@ -305,15 +338,29 @@ class API(base.Base):
         including any related table updates (such as security group,
         etc).
 
-        This will called by create() in the majority of situations,
-        but create_all_at_once() style Schedulers may initiate the call.
-        If you are changing this method, be sure to update both
-        call paths.
+        This is called by create_all_at_once() style Schedulers once
+        they have picked a host in this zone, so the instance is charged
+        to the project's quota usage here rather than when the request
+        was handed to the scheduler.
         """
-        instance = dict(launch_index=num, **base_options)
-        instance = self.db.instance_create(context, instance)
-        instance_id = instance['id']
+        reservations = self._reserve_instances(context, 1, base_options)
+        try:
+            instance = self.create_db_entries_for_new_instances(context,
+                    image, base_options, security_group,
+                    block_device_mapping, num_instances=1, start_index=num)[0]
+        except Exception:
+            quota.rollback(context, reservations)
+            raise
+        quota.commit(context, reservations)
+        return instance
 
+    def create_db_entries_for_new_instances(self, context, image,
+             base_options, security_group, block_device_mapping,
+             num_instances, start_index=0):
+        """Create num_instances entries in the DB for these new instances,
+        with bulk inserts for the instances and their related tables.
+        The instances get launch indexes from start_index onwards.
+        """
         elevated = context.elevated()
         if security_group is None:
             security_group = ['default']
@@ -327,46 +374,58 @@ class API(base.Base):
                                                   security_group_name)
             security_groups.append(group['id'])
 
-        for security_group_id in security_groups:
-            self.db.instance_add_security_group(elevated,
-                                                instance_id,
-                                                security_group_id)
+        values_list = [dict(launch_index=start_index + num, **base_options)
+                       for num in xrange(num_instances)]
+        instances = self.db.instance_create_bulk(context, values_list,
+                                                 security_groups)
 
         # BlockDeviceMapping table
-        self._update_image_block_device_mapping(elevated, instance_id,
-            image['properties'].get('mappings', []))
-        self._update_block_device_mapping(elevated, instance_id,
-            image['properties'].get('block_device_mapping', []))
-        # override via command line option
-        self._update_block_device_mapping(elevated, instance_id,
-                                          block_device_mapping)
+        mappings = self._merge_block_device_mappings(
+            self._image_block_device_mapping(
+                image['properties'].get('mappings', [])),
+            self._block_device_mapping(
+                image['properties'].get('block_device_mapping', [])),
+            # override via command line option
+            self._block_device_mapping(block_device_mapping))
+        if mappings:
+            self.db.block_device_mapping_create_bulk(elevated,
+                    [dict(values, instance_id=instance['id'])
+                     for instance in instances for values in mappings])
 
         # Set sane defaults if not specified
-        updates = {}
-        if (not hasattr(instance, 'display_name') or
-                instance.display_name is None):
-            updates['display_name'] = "Server %s" % instance_id
-            instance['display_name'] = updates['display_name']
-        updates['hostname'] = self.hostname_factory(instance)
-
-        instance = self.update(context, instance_id, **updates)
+        updates = []
+        for instance in instances:
+            values = {}
+            if instance.get('display_name') is None:
+                values['display_name'] = "Server %s" % instance['id']
+                instance['display_name'] = values['display_name']
+            values['hostname'] = self.hostname_factory(instance)
+            updates.append((instance['id'], values))
+        instances = self.db.instance_update_bulk(context, updates)
 
-        for group_id in security_groups:
-            self.trigger_security_group_members_refresh(elevated, group_id)
+        self.trigger_security_group_members_refresh(elevated,
+                                                    security_groups)
 
-        return instance
+        return [dict(instance.iteritems()) for instance in instances]
 
     def _ask_scheduler_to_create_instance(self, context, base_options,
                                           instance_type, zone_blob,
                                           availability_zone, injected_files,
                                           admin_password,
-                                          instance_id=None, num_instances=1):
-        """Send the run_instance request to the schedulers for processing."""
+                                          instance_id=None, num_instances=1,
+                                          instance_ids=None):
+        """Send the run_instance request to the schedulers for processing.
+
+        A list of instance_ids is sent as a single run_instances request.
+        """
         pid = context.project_id
         uid = context.user_id
         if instance_id:
             LOG.debug(_("Casting to scheduler for %(pid)s/%(uid)s's"
                     " instance %(instance_id)s (single-shot)") % locals())
+        elif instance_ids:
+            LOG.debug(_("Casting to scheduler for %(pid)s/%(uid)s's"
+                    " instances %(instance_ids)s") % locals())
         else:
             LOG.debug(_("Casting to scheduler for %(pid)s/%(uid)s's"
                     " (all-at-once)") % locals())
@@ -380,15 +439,20 @@ class API(base.Base):
             'num_instances': num_instances,
         }
 
+        args = {"topic": FLAGS.compute_topic,
+                "request_spec": request_spec,
+                "availability_zone": availability_zone,
+                "admin_password": admin_password,
+                "injected_files": injected_files}
+        if instance_ids:
+            method = "run_instances"
+            args["instance_ids"] = instance_ids
+        else:
+            method = "run_instance"
+            args["instance_id"] = instance_id
         rpc.cast(context,
                  FLAGS.scheduler_topic,
-                 {"method": "run_instance",
-                  "args": {"topic": FLAGS.compute_topic,
-                           "instance_id": instance_id,
-                           "request_spec": request_spec,
-                           "availability_zone": availability_zone,
-                           "admin_password": admin_password,
-                           "injected_files": injected_files}})
+                 {"method": method, "args": args})
 
     def create_all_at_once(self, context, instance_type,
                image_href, kernel_id=None, ramdisk_id=None,
@@ -411,6 +475,10 @@ class API(base.Base):
                                injected_files, admin_password, zone_blob,
                                reservation_id)
 
+        # NOTE: quota usage is charged by create_db_entry_for_new_instance
+        #       as the scheduler creates the instances, since a request that
+        #       can't be scheduled, or is built in a child zone, never
+        #       creates them here.
         self._ask_scheduler_to_create_instance(context, base_options,
                                       instance_type, zone_blob,
                                       availability_zone, injected_files,
@@ -450,22 +518,32 @@ class API(base.Base):
                                reservation_id)
 
         block_device_mapping = block_device_mapping or []
-        instances = []
+        reservations = self._reserve_instances(context, num_instances,
+                                               base_options)
         LOG.debug(_("Going to run %s instances..."), num_instances)
-        for num in range(num_instances):
-            instance = self.create_db_entry_for_new_instance(context, image,
-                                    base_options, security_group,
-                                    block_device_mapping, num=num)
-            instances.append(instance)
-            instance_id = instance['id']
-
-            self._ask_scheduler_to_create_instance(context, base_options,
-                                          instance_type, zone_blob,
-                                          availability_zone, injected_files,
-                                          admin_password,
-                                          instance_id=instance_id)
+        try:
+            instances = self.create_db_entries_for_new_instances(context,
+                                    image, base_options, security_group,
+                                    block_device_mapping, num_instances)
+            instance_ids = [instance['id'] for instance in instances]
+            if len(instance_ids) == 1:
+                self._ask_scheduler_to_create_instance(context, base_options,
+                                              instance_type, zone_blob,
+                                              availability_zone,
+                                              injected_files, admin_password,
+                                              instance_id=instance_ids[0])
+            else:
+                self._ask_scheduler_to_create_instance(context, base_options,
+                                              instance_type, zone_blob,
+                                              availability_zone,
+                                              injected_files, admin_password,
+                                              instance_ids=instance_ids)
+        except Exception:
+            quota.rollback(context, reservations)
+            raise
+        quota.commit(context, reservations)
 
-        return [dict(x.iteritems()) for x in instances]
+        return instances
 
     def has_finished_migration(self, context, instance_uuid):
         """Returns true if an instance has a finished migration."""
@@ -476,6 +554,16 @@ class API(base.Base):
         except exception.NotFound:
             return False
 
+    def get_instances_with_finished_migration(self, context, instance_uuids):
+        """Returns the set of instance uuids that have a finished migration.
+
+        Looks up all of the instances in a single query, for callers that
+        would otherwise call has_finished_migration once per instance.
+        """
+        migrations = db.migration_get_all_by_instances_and_status(context,
+                instance_uuids, 'finished')
+        return set(migration['instance_uuid'] for migration in migrations)
+
     def ensure_default_security_group(self, context):
         """Ensure that a context has a security group.
 
@@ -510,56 +598,62 @@ class API(base.Base):
                      {"method": "refresh_security_group_rules",
                       "args": {"security_group_id": security_group.id}})
 
-    def trigger_security_group_members_refresh(self, context, group_id):
-        """Called when a security group gains a new or loses a member.
+    def trigger_security_group_members_refresh(self, context, group_ids):
+        """Called when security groups gain a new or lose a member.
 
-        Sends an update request to each compute node for whom this is
-        relevant.
+        Sends one update request per group to each compute node for whom
+        this is relevant.
         """
-        # First, we get the security group rules that reference this group as
-        # the grantee..
-        security_group_rules = \
+        if not isinstance(group_ids, list):
+            group_ids = [group_ids]
+
+        host_groups = set()
+        for group_id in set(group_ids):
+            # First, we get the security group rules that reference this
+            # group as the grantee..
+            security_group_rules = \
                 self.db.security_group_rule_get_by_security_group_grantee(
                                                                      context,
                                                                      group_id)
 
-        # ..then we distill the security groups to which they belong..
-        security_groups = set()
-        for rule in security_group_rules:
-            security_group = self.db.security_group_get(
-                                                    context,
-                                                    rule['parent_group_id'])
-            security_groups.add(security_group)
-
-        # ..then we find the instances that are members of these groups..
-        instances = set()
-        for security_group in security_groups:
-            for instance in security_group['instances']:
-                instances.add(instance)
-
-        # ...then we find the hosts where they live...
-        hosts = set()
-        for instance in instances:
-            if instance['host']:
-                hosts.add(instance['host'])
-
-        # ...and finally we tell these nodes to refresh their view of this
-        # particular security group.
-        for host in hosts:
+            # ..then we distill the security groups to which they belong..
+            parent_group_ids = set(rule['parent_group_id']
+                                   for rule in security_group_rules)
+
+            # ..then we find the hosts where their instances live...
+            for parent_group_id in parent_group_ids:
+                security_group = self.db.security_group_get(context,
+                                                            parent_group_id)
+                for instance in security_group['instances']:
+                    if instance['host']:
+                        host_groups.add((instance['host'], group_id))
+
+        # ...and finally we tell these nodes to refresh their view of these
+        # particular security groups.
+        for host, group_id in host_groups:
             rpc.cast(context,
                      self.db.queue_get_for(context, FLAGS.compute_topic, host),
                      {"method": "refresh_security_group_members",
                       "args": {"security_group_id": group_id}})
 
     def trigger_provider_fw_rules_refresh(self, context):
-        """Called when a rule is added to or removed from a security_group"""
+        """Called when a provider firewall rule is added or removed.
 
-        hosts = [x['host'] for (x, idx)
-                           in db.service_get_all_compute_sorted(context)]
-        for host in hosts:
-            rpc.cast(context,
-                     self.db.queue_get_for(context, FLAGS.compute_topic, host),
-                     {'method': 'refresh_provider_fw_rules', 'args': {}})
+        The full rule set goes out once on the compute fanout exchange,
+        stamped with the version the database gives the set, so that
+        compute hosts can ignore updates older than the rules they already
+        have.
+        """
+        rules, version = self.db.provider_fw_rule_get_all_with_version(
+                context)
+        rules = [{'protocol': rule['protocol'],
+                  'cidr': rule['cidr'],
+                  'from_port': rule['from_port'],
+                  'to_port': rule['to_port']}
+                 for rule in rules]
+        rpc.fanout_cast(context, FLAGS.compute_topic,
+                        {'method': 'refresh_provider_fw_rules',
+                         'args': {'rules': rules, 'version': version}})
 
     @scheduler_api.reroute_compute("update")
     def update(self, context, instance_id, **kwargs):
@@ -606,7 +700,9 @@ class API(base.Base):
                     instance_id, host)
         else:
             terminate_volumes(self.db, context, instance_id)
+            reservations = reserve_quota_release(context, instance)
             self.db.instance_destroy(context, instance_id)
+            quota.commit(context, reservations)
 
     @scheduler_api.reroute_compute("stop")
     def stop(self, context, instance_id):
@@ -659,6 +755,13 @@ class API(base.Base):
             instance = self.db.instance_get(context, instance_id)
         return dict(instance.iteritems())
 
+    def get_all_by_ids(self, context, instance_ids):
+        """Get the instances with the given integer ids, in the given order.
+
+        Raises InstanceNotFound if any of them does not exist.
+        """
+        return self.db.instance_get_all_by_ids(context, instance_ids)
+
     @scheduler_api.reroute_compute("get")
     def routing_get(self, context, instance_id):
         """A version of get with special routing characteristics.
@@ -50,11 +50,13 @@ import nova.image
 from nova import log as logging
 from nova import manager
 from nova import network
+from nova import quota
 from nova import rpc
 from nova import utils
 from nova import volume
 from nova.compute import power_state
 from nova.notifier import api as notifier
+from nova.compute.utils import reserve_quota_release
 from nova.compute.utils import terminate_volumes
 from nova.virt import driver
 
@@ -141,6 +143,7 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.network_manager = utils.import_object(FLAGS.network_manager)
         self.volume_manager = utils.import_object(FLAGS.volume_manager)
         self._last_host_check = 0
+        self._provider_fw_version = 0
         super(ComputeManager, self).__init__(service_name="compute",
                                              *args, **kwargs)
 
@@ -210,9 +213,26 @@ class ComputeManager(manager.SchedulerDependentManager):
         return self.driver.refresh_security_group_members(security_group_id)
 
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
-    def refresh_provider_fw_rules(self, context, **_kwargs):
-        """This call passes straight through to the virtualization driver."""
-        return self.driver.refresh_provider_fw_rules()
+    def refresh_provider_fw_rules(self, context, rules=None, version=None,
+                                  **_kwargs):
+        """Pass the provider firewall rules to the virtualization driver.
+
+        Updates carrying a version no newer than the last one applied are
+        ignored. Without rules the driver reads them from the database.
+
+        """
+        if version is not None:
+            if version <= self._provider_fw_version:
+                LOG.debug(_('Ignoring provider firewall rules version '
+                            '%(version)s, already at %(current)s'),
+                          {'version': version,
+                           'current': self._provider_fw_version})
+                return
+        result = self.driver.refresh_provider_fw_rules(rules=rules)
+        # Only once applied, so that a failed update can be sent again
+        if version is not None:
+            self._provider_fw_version = version
+        return result
 
     def _get_instance_nw_info(self, context, instance):
         """Get a list of dictionaries of network data of an instance.
@@ -376,7 +396,9 @@ class ComputeManager(manager.SchedulerDependentManager):
 
         if (instance['state'] == power_state.SHUTOFF and
             instance['state_description'] != 'stopped'):
+            reservations = reserve_quota_release(context, instance)
             self.db.instance_destroy(context, instance_id)
+            quota.commit(context, reservations)
             raise exception.Error(_('trying to destroy already destroyed'
                                     ' instance: %s') % instance_id)
         self.driver.destroy(instance, network_info)
@@ -392,7 +414,9 @@ class ComputeManager(manager.SchedulerDependentManager):
         instance = self.db.instance_get(context.elevated(), instance_id)
 
         # TODO(ja): should we keep it in a terminated state for a bit?
+        reservations = reserve_quota_release(context, instance)
         self.db.instance_destroy(context, instance_id)
+        quota.commit(context, reservations)
         usage_info = utils.usage_from_instance(instance)
         notifier.notify('compute.%s' % self.host,
                         'compute.instance.delete',
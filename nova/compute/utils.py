@@ -15,6 +15,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from nova import quota
 from nova import volume
 
 
@@ -27,3 +28,11 @@ def terminate_volumes(db, context, instance_id):
         if bdm['volume_id'] and bdm['delete_on_termination']:
             volume_api.delete(context, bdm['volume_id'])
         db.block_device_mapping_destroy(context, bdm['id'])
+
+
+def reserve_quota_release(context, instance):
+    """reserve the return of an instance's quota, commit once it is gone"""
+    return quota.reserve(context, project_id=instance['project_id'],
+                         instances=-1,
+                         cores=-(instance['vcpus'] or 0),
+                         ram=-(instance['memory_mb'] or 0))
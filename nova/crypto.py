@@ -23,16 +23,21 @@ Includes root and intermediate CAs, SSH key_pairs and x509 certificates.
 """
 
 import base64
+import collections
 import gettext
 import hashlib
 import os
 import shutil
 import string
 import struct
+import sys
 import tempfile
 import time
 import utils
 
+import eventlet
+from eventlet.green import subprocess
+from eventlet import tpool
 import M2Crypto
 
 gettext.install('nova', unicode=1)
@@ -59,6 +64,11 @@ flags.DEFINE_string('ca_path', '$state_path/CA',
                     _('Where we keep our root CA'))
 flags.DEFINE_boolean('use_project_ca', False,
                      _('Should we use a CA for each project?'))
+flags.DEFINE_integer('key_pair_pool_size', 0,
+                     _('Number of pre-generated key pairs to keep ready, '
+                       '0 generates each key pair on request'))
+flags.DEFINE_integer('key_pair_pool_workers', 1,
+                     _('Number of processes refilling the key pair pool'))
 flags.DEFINE_string('user_cert_subject',
                     '/C=US/ST=California/L=MountainView/O=AnsoLabs/'
                     'OU=NovaDev/CN=%s-%s-%s',
@@ -104,45 +114,156 @@ def fetch_ca(project_id=None, chain=True):
     return buffer
 
 
-def generate_key_pair(bits=1024):
-    # what is the magic 65537?
+def _rsa_to_ssh_blob(rsa_key):
+    """Return the ssh wire encoding of an M2Crypto RSA public key."""
+    # NOTE: pub() already returns e and n as length-prefixed mpints.
+    e, n = rsa_key.pub()
+    key_type = 'ssh-rsa'
+    return struct.pack('>I', len(key_type)) + key_type + e + n
 
-    tmpdir = tempfile.mkdtemp()
-    keyfile = os.path.join(tmpdir, 'temp')
-    utils.execute('ssh-keygen', '-q', '-b', bits, '-N', '',
-                  '-f', keyfile)
-    (out, err) = utils.execute('ssh-keygen', '-q', '-l', '-f',
-                               '%s.pub' % (keyfile))
-    fingerprint = out.split(' ')[1]
-    private_key = open(keyfile).read()
-    public_key = open(keyfile + '.pub').read()
 
-    shutil.rmtree(tmpdir)
-    # code below returns public key in pem format
-    # key = M2Crypto.RSA.gen_key(bits, 65537, callback=lambda: None)
-    # private_key = key.as_pem(cipher=None)
-    # bio = M2Crypto.BIO.MemoryBuffer()
-    # key.save_pub_key_bio(bio)
-    # public_key = bio.read()
-    # public_key, err = execute('ssh-keygen', '-y', '-f',
-    #                           '/dev/stdin', private_key)
+def generate_fingerprint_from_blob(key_data):
+    """Return the md5 fingerprint of an ssh public key blob."""
+    digest = hashlib.md5(key_data).hexdigest()
+    return ':'.join(a + b for a, b in zip(digest[::2], digest[1::2]))
 
-    return (private_key, public_key, fingerprint)
 
+def _generate_key_pair(bits):
+    rsa_key = M2Crypto.RSA.gen_key(bits, 65537, callback=lambda: None)
+    private_key = rsa_key.as_pem(cipher=None)
+    key_data = _rsa_to_ssh_blob(rsa_key)
+    public_key = 'ssh-rsa %s Generated by Nova\n' % \
+                 base64.b64encode(key_data)
+    return (private_key, public_key,
+            generate_fingerprint_from_blob(key_data))
 
-def ssl_pub_to_ssh_pub(ssl_public_key, name='root', suffix='nova'):
-    buf = M2Crypto.BIO.MemoryBuffer(ssl_public_key)
-    rsa_key = M2Crypto.RSA.load_pub_key_bio(buf)
-    e, n = rsa_key.pub()
 
-    key_type = 'ssh-rsa'
+class KeyPairPool(object):
+    """Keeps freshly generated key pairs ready to hand out.
+
+    Keys are generated by worker processes, so the greenthreads of the
+    calling process never wait on RSA generation. get() pops a ready key
+    and asks the workers for replacements, or returns None if the pool
+    has run dry.
+    """
+
+    def __init__(self, size, workers=1, bits=1024):
+        self.size = size
+        self.bits = bits
+        self._keys = collections.deque()
+        self._workers = [_KeyPairWorker(self, bits) for i in xrange(workers)]
+        self._refill()
+
+    @property
+    def pending(self):
+        return sum(worker.pending for worker in self._workers)
+
+    def _refill(self):
+        alive = [worker for worker in self._workers if worker.alive]
+        if not alive:
+            return
+        for i in xrange(self.size - len(self._keys) - self.pending):
+            min(alive, key=lambda worker: worker.pending).request()
+
+    def _add(self, key_pair):
+        self._keys.append(key_pair)
+
+    def get(self):
+        try:
+            key_pair = self._keys.popleft()
+        except IndexError:
+            key_pair = None
+        self._refill()
+        return key_pair
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+
+
+class _KeyPairWorker(object):
+    """A child process generating one key pair per request."""
+
+    def __init__(self, pool, bits):
+        self.pool = pool
+        self.pending = 0
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        self.process = subprocess.Popen([sys.executable, '-c',
+                                         'import sys; '
+                                         'from nova import crypto; '
+                                         'crypto.key_pair_worker(%d)' % bits],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        env=env)
+        self.alive = True
+        self.reader = eventlet.spawn(self._read)
+
+    def request(self):
+        try:
+            self.process.stdin.write('\n')
+            self.process.stdin.flush()
+        except IOError:
+            self.alive = False
+            return
+        self.pending += 1
+
+    def _read(self):
+        for line in iter(self.process.stdout.readline, ''):
+            self.pending -= 1
+            self.pool._add(tuple(utils.loads(line)))
+        LOG.warn(_('Key pair worker %d exited'), self.process.pid)
+        self.alive = False
+        self.pending = 0
+
+    def stop(self):
+        if self.alive:
+            self.alive = False
+            self.process.stdin.close()
+            self.process.wait()
+        self.reader.kill()
+
+
+def key_pair_worker(bits):
+    """Main loop of a KeyPairPool worker process."""
+    while sys.stdin.readline():
+        sys.stdout.write(utils.dumps(_generate_key_pair(bits)) + '\n')
+        sys.stdout.flush()
+
+
+_KEY_PAIR_POOL = None
+
+
+def _get_key_pair_pool(bits):
+    global _KEY_PAIR_POOL
+    if FLAGS.key_pair_pool_size <= 0 or bits != 1024:
+        return None
+    if _KEY_PAIR_POOL is None:
+        _KEY_PAIR_POOL = KeyPairPool(FLAGS.key_pair_pool_size,
+                                     FLAGS.key_pair_pool_workers)
+    return _KEY_PAIR_POOL
 
-    key_data = struct.pack('>I', len(key_type))
-    key_data += key_type
-    key_data += '%s%s' % (e, n)
 
-    b64_blob = base64.b64encode(key_data)
-    return '%s %s %s@%s\n' % (key_type, b64_blob, name, suffix)
+def generate_key_pair(bits=1024):
+    """Return (private_key, public_key, fingerprint) for a new RSA key.
+
+    Keys come from the background pool when --key_pair_pool_size is set
+    and it has one ready, otherwise they are generated in a native thread
+    so that other greenthreads keep running meanwhile.
+    """
+    pool = _get_key_pair_pool(bits)
+    if pool is not None:
+        key_pair = pool.get()
+        if key_pair is not None:
+            return key_pair
+    return tpool.execute(_generate_key_pair, bits)
+
+
+def ssl_pub_to_ssh_pub(ssl_public_key, name='root', suffix='nova'):
+    buf = M2Crypto.BIO.MemoryBuffer(ssl_public_key)
+    rsa_key = M2Crypto.RSA.load_pub_key_bio(buf)
+    b64_blob = base64.b64encode(_rsa_to_ssh_blob(rsa_key))
+    return '%s %s %s@%s\n' % ('ssh-rsa', b64_blob, name, suffix)
 
 
 def revoke_cert(project_id, file_name):
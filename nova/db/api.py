@@ -320,6 +320,13 @@ def migration_get_by_instance_and_status(context, instance_uuid, status):
             status)
 
 
+def migration_get_all_by_instances_and_status(context, instance_uuids,
+                                              status):
+    """Finds all migrations with a status for any of the instance uuids."""
+    return IMPL.migration_get_all_by_instances_and_status(context,
+            instance_uuids, status)
+
+
 ####################
 
 
@@ -347,6 +354,15 @@ def fixed_ip_create(context, values):
     return IMPL.fixed_ip_create(context, values)
 
 
+def fixed_ip_create_bulk(context, values_iter):
+    """Create fixed ips from an iterable of values dictionaries.
+
+    All rows are written in a single transaction.
+
+    """
+    return IMPL.fixed_ip_create_bulk(context, values_iter)
+
+
 def fixed_ip_disassociate(context, address):
     """Disassociate a fixed ip from an instance by address."""
     return IMPL.fixed_ip_disassociate(context, address)
@@ -377,6 +393,11 @@ def fixed_ip_get_by_instance(context, instance_id):
     return IMPL.fixed_ip_get_by_instance(context, instance_id)
 
 
+def fixed_ip_get_by_security_group(context, security_group_id):
+    """Get allocated fixed ips of all instances in a security group."""
+    return IMPL.fixed_ip_get_by_security_group(context, security_group_id)
+
+
 def fixed_ip_get_by_network_host(context, network_id, host):
     """Get fixed ip for a host in a network."""
     return IMPL.fixed_ip_get_by_network_host(context, network_id, host)
@@ -414,6 +435,20 @@ def virtual_interface_create(context, values):
     return IMPL.virtual_interface_create(context, values)
 
 
+def virtual_interface_create_bulk(context, values_list):
+    """Create virtual interface records in a single statement.
+
+    Either all of them are created or, if any address is taken, none.
+
+    """
+    return IMPL.virtual_interface_create_bulk(context, values_list)
+
+
+def virtual_interface_get_used_addresses(context, addresses):
+    """Return the subset of addresses already used by virtual interfaces."""
+    return IMPL.virtual_interface_get_used_addresses(context, addresses)
+
+
 def virtual_interface_update(context, vif_id, values):
     """Update a virtual interface record in the database."""
     return IMPL.virtual_interface_update(context, vif_id, values)
@@ -439,6 +474,25 @@ def virtual_interface_get_by_instance(context, instance_id):
     return IMPL.virtual_interface_get_by_instance(context, instance_id)
 
 
+def virtual_interface_get_version_by_instance(context, instance_id):
+    """Gets a value that changes whenever the virtual_interfaces of an
+    instance or their fixed ips do, without reading them."""
+    return IMPL.virtual_interface_get_version_by_instance(context,
+                                                          instance_id)
+
+
+def virtual_interface_get_by_instance_with_fixed_ips(context, instance_id):
+    """Gets the virtual_interfaces for instance with their fixed ips.
+
+    :returns: list of (virtual_interface, fixed_ips) tuples where
+              fixed_ips are the instance's fixed ips on the network of
+              the virtual_interface
+
+    """
+    return IMPL.virtual_interface_get_by_instance_with_fixed_ips(context,
+                                                                 instance_id)
+
+
 def virtual_interface_get_by_instance_and_network(context, instance_id,
                                                            network_id):
     """Gets all virtual interfaces for instance."""
@@ -470,6 +524,16 @@ def instance_create(context, values):
     return IMPL.instance_create(context, values)
 
 
+def instance_create_bulk(context, values_list, security_group_ids=None):
+    """Create an instance from each values dictionary in one go.
+
+    The instances are made members of the given security groups.
+
+    """
+    return IMPL.instance_create_bulk(context, values_list,
+                                     security_group_ids)
+
+
 def instance_data_get_for_project(context, project_id):
     """Get (instance_count, total_cores, total_ram) for project."""
     return IMPL.instance_data_get_for_project(context, project_id)
@@ -500,6 +564,11 @@ def instance_get_all(context):
     return IMPL.instance_get_all(context)
 
 
+def instance_get_all_by_ids(context, instance_ids):
+    """Get the given instances, in order, or raise if one does not exist."""
+    return IMPL.instance_get_all_by_ids(context, instance_ids)
+
+
 def instance_get_active_by_window(context, begin, end=None):
     """Get instances active during a certain time window."""
     return IMPL.instance_get_active_by_window(context, begin, end)
@@ -558,6 +627,16 @@ def instance_update(context, instance_id, values):
     return IMPL.instance_update(context, instance_id, values)
 
 
+def instance_update_bulk(context, updates):
+    """Set properties on several instances in one go.
+
+    updates is a list of (instance_id, values) pairs, the updated
+    instances are returned in the same order.
+
+    """
+    return IMPL.instance_update_bulk(context, updates)
+
+
 def instance_add_security_group(context, instance_id, security_group_id):
     """Associate the given security group with the given instance."""
     return IMPL.instance_add_security_group(context, instance_id,
@@ -860,6 +939,45 @@ def quota_destroy_all_by_project(context, project_id):
 ###################
 
 
+def quota_usage_get_all_by_project(context, project_id, resources,
+                                   max_age=0):
+    """Retrieve usage counters for the given resources of a project.
+
+    Counters that do not exist yet, or were last synchronized more than
+    max_age seconds ago, are recomputed from the underlying tables.
+    """
+    return IMPL.quota_usage_get_all_by_project(context, project_id,
+                                               resources, max_age)
+
+
+def quota_reserve(context, project_id, quotas, deltas, expire, max_age=0):
+    """Check quotas and reserve the deltas against the usage counters.
+
+    Raises OverQuota if any positive delta would exceed its quota.
+    Returns a list of reservation uuids.
+    """
+    return IMPL.quota_reserve(context, project_id, quotas, deltas, expire,
+                              max_age)
+
+
+def reservation_commit(context, reservations):
+    """Apply the reservations to the usage counters and remove them."""
+    return IMPL.reservation_commit(context, reservations)
+
+
+def reservation_rollback(context, reservations):
+    """Release the reservations without changing in-use counters."""
+    return IMPL.reservation_rollback(context, reservations)
+
+
+def reservation_expire(context):
+    """Roll back all reservations that have passed their expiration."""
+    return IMPL.reservation_expire(context)
+
+
+###################
+
+
 def volume_allocate_shelf_and_blade(context, volume_id):
     """Atomically allocate a free shelf and blade from the pool."""
     return IMPL.volume_allocate_shelf_and_blade(context, volume_id)
@@ -905,6 +1023,11 @@ def volume_get_all(context):
     return IMPL.volume_get_all(context)
 
 
+def volume_get_all_by_ids(context, volume_ids):
+    """Get the given volumes or raise if one does not exist."""
+    return IMPL.volume_get_all_by_ids(context, volume_ids)
+
+
 def volume_get_all_by_host(context, host):
     """Get all volumes belonging to a host."""
     return IMPL.volume_get_all_by_host(context, host)
@@ -994,6 +1117,11 @@ def block_device_mapping_create(context, values):
     return IMPL.block_device_mapping_create(context, values)
 
 
+def block_device_mapping_create_bulk(context, values_list):
+    """Create an entry of block device mapping for each values dict"""
+    return IMPL.block_device_mapping_create_bulk(context, values_list)
+
+
 def block_device_mapping_update(context, bdm_id, values):
     """Update an entry of block device mapping"""
     return IMPL.block_device_mapping_update(context, bdm_id, values)
@@ -1010,6 +1138,12 @@ def block_device_mapping_get_all_by_instance(context, instance_id):
     return IMPL.block_device_mapping_get_all_by_instance(context, instance_id)
 
 
+def block_device_mapping_get_all_by_instances(context, instance_ids):
+    """Get all block device mapping belonging to a list of instances"""
+    return IMPL.block_device_mapping_get_all_by_instances(context,
+                                                          instance_ids)
+
+
 def block_device_mapping_destroy(context, bdm_id):
     """Destroy the block device mapping."""
     return IMPL.block_device_mapping_destroy(context, bdm_id)
@@ -1109,6 +1243,15 @@ def provider_fw_rule_get_all(context):
     return IMPL.provider_fw_rule_get_all(context)
 
 
+def provider_fw_rule_get_all_with_version(context):
+    """Get all provider-level firewall rules and a version of the set.
+
+    The version grows with every rule added or deleted.
+
+    """
+    return IMPL.provider_fw_rule_get_all_with_version(context)
+
+
 def provider_fw_rule_get_all_by_cidr(context, cidr):
     """Get all provider-level firewall rules."""
     return IMPL.provider_fw_rule_get_all_by_cidr(context, cidr)
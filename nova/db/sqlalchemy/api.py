@@ -18,6 +18,7 @@
 """
 Implementation of SQLAlchemy backend.
 """
+import itertools
 import warnings
 
 from nova import db
@@ -28,6 +29,7 @@ from nova import utils
 from nova import log as logging
 from nova.db.sqlalchemy import models
 from nova.db.sqlalchemy.session import get_session
+from sqlalchemy import and_
 from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
@@ -499,13 +501,14 @@ def floating_ip_create(context, values):
 
 
 @require_context
-def floating_ip_count_by_project(context, project_id):
+def floating_ip_count_by_project(context, project_id, session=None):
     authorize_project_context(context, project_id)
-    session = get_session()
-    # TODO(tr3buchet): why leave auto_assigned floating IPs out?
+    if not session:
+        session = get_session()
+    # NOTE: auto assigned floating IPs are charged to the quota usage when
+    #       they are allocated, so they have to be counted here as well
     return session.query(models.FloatingIp).\
                    filter_by(project_id=project_id).\
-                   filter_by(auto_assigned=False).\
                    filter_by(deleted=False).\
                    count()
 
@@ -709,6 +712,25 @@ def fixed_ip_create(_context, values):
     return fixed_ip_ref['address']
 
 
+# Number of rows sent to the database per INSERT by fixed_ip_create_bulk
+_FIXED_IP_BULK_CHUNK_SIZE = 1000
+
+
+@require_context
+def fixed_ip_create_bulk(_context, values_iter):
+    """Insert fixed ip rows in chunks, each chunk a single executemany."""
+    values_iter = iter(values_iter)
+    insert = models.FixedIp.__table__.insert()
+    session = get_session()
+    with session.begin():
+        while True:
+            chunk = list(itertools.islice(values_iter,
+                                          _FIXED_IP_BULK_CHUNK_SIZE))
+            if not chunk:
+                break
+            session.execute(insert, chunk)
+
+
 @require_context
 def fixed_ip_disassociate(context, address):
     session = get_session()
@@ -801,6 +823,22 @@ def fixed_ip_get_by_instance(context, instance_id):
     return rv
 
 
+@require_context
+def fixed_ip_get_by_security_group(context, security_group_id):
+    session = get_session()
+    association = models.SecurityGroupInstanceAssociation
+    inner_q = session.query(association.instance_id).\
+                      filter(association.security_group_id ==
+                             security_group_id).\
+                      filter(association.deleted == False).\
+                      subquery()
+    return session.query(models.FixedIp).\
+                   filter(models.FixedIp.instance_id.in_(inner_q)).\
+                   filter_by(allocated=True).\
+                   filter_by(deleted=False).\
+                   all()
+
+
 @require_context
 def fixed_ip_get_by_network_host(context, network_id, host):
     session = get_session()
@@ -886,6 +924,39 @@ def virtual_interface_create(context, values):
     return vif_ref
 
 
+@require_context
+def virtual_interface_create_bulk(_context, values_list):
+    """Insert virtual interface records with one multi-row statement.
+
+    :param values_list: = list of dicts containing column values
+    """
+    if not values_list:
+        return
+    session = get_session()
+    try:
+        with session.begin():
+            session.execute(models.VirtualInterface.__table__.insert(),
+                            values_list)
+    except IntegrityError:
+        raise exception.VirtualInterfaceCreateException()
+
+
+@require_context
+def virtual_interface_get_used_addresses(_context, addresses):
+    """Return the set of the given mac addresses that are already taken.
+
+    :param addresses: = mac addresses to check, looked up through the
+                        unique index on address
+    """
+    if not addresses:
+        return set()
+    session = get_session()
+    rows = session.query(models.VirtualInterface.address).\
+                   filter(models.VirtualInterface.address.in_(addresses)).\
+                   all()
+    return set(row[0] for row in rows)
+
+
 @require_context
 def virtual_interface_update(context, vif_id, values):
     """Update a virtual interface record in the database.
@@ -968,6 +1039,58 @@ def virtual_interface_get_by_instance(context, instance_id):
     return vif_refs
 
 
+@require_context
+def virtual_interface_get_by_instance_with_fixed_ips(context, instance_id):
+    """Gets the vifs of an instance, their networks and the instance's
+    fixed ips on those networks in a single query.
+    """
+    vif_model = models.VirtualInterface
+    fixed_ip_model = models.FixedIp
+    session = get_session()
+    rows = session.query(vif_model, fixed_ip_model).\
+                   outerjoin((fixed_ip_model,
+                              and_(fixed_ip_model.instance_id ==
+                                   vif_model.instance_id,
+                                   fixed_ip_model.network_id ==
+                                   vif_model.network_id,
+                                   fixed_ip_model.deleted == False))).\
+                   options(joinedload(vif_model.network)).\
+                   filter(vif_model.instance_id == instance_id).\
+                   order_by(vif_model.id, fixed_ip_model.id).\
+                   all()
+
+    result = []
+    for vif_ref, fixed_ip_ref in rows:
+        if not result or result[-1][0]['id'] != vif_ref['id']:
+            result.append((vif_ref, []))
+        if fixed_ip_ref is not None:
+            result[-1][1].append(fixed_ip_ref)
+    return result
+
+
+@require_context
+def virtual_interface_get_version_by_instance(context, instance_id):
+    """Gets the ids of the rows virtual_interface_get_by_instance_with_
+    fixed_ips returns.  Vifs are deleted and created rather than changed
+    and fixed ips join or leave the instance, so the ids change with
+    every allocation and deallocation.
+    """
+    vif_model = models.VirtualInterface
+    fixed_ip_model = models.FixedIp
+    session = get_session()
+    rows = session.query(vif_model.id, fixed_ip_model.id).\
+                   outerjoin((fixed_ip_model,
+                              and_(fixed_ip_model.instance_id ==
+                                   vif_model.instance_id,
+                                   fixed_ip_model.network_id ==
+                                   vif_model.network_id,
+                                   fixed_ip_model.deleted == False))).\
+                   filter(vif_model.instance_id == instance_id).\
+                   order_by(vif_model.id, fixed_ip_model.id).\
+                   all()
+    return tuple(tuple(row) for row in rows)
+
+
 @require_context
 def virtual_interface_get_by_instance_and_network(context, instance_id,
                                                            network_id):
@@ -1057,9 +1180,32 @@ def instance_create(context, values):
     return instance_ref
 
 
-@require_admin_context
-def instance_data_get_for_project(context, project_id):
+@require_context
+def instance_create_bulk(context, values_list, security_group_ids=None):
+    """Create Instance records for a list of column value dicts in one
+    transaction, each of them a member of the given security groups."""
     session = get_session()
+    with session.begin():
+        security_groups = [security_group_get(context, security_group_id,
+                                              session=session)
+                           for security_group_id in security_group_ids or []]
+        instance_refs = []
+        for values in values_list:
+            values = dict(values)
+            values['metadata'] = _metadata_refs(values.get('metadata'))
+            instance_ref = models.Instance()
+            instance_ref['uuid'] = str(utils.gen_uuid())
+            instance_ref.update(values)
+            instance_ref.security_groups = list(security_groups)
+            session.add(instance_ref)
+            instance_refs.append(instance_ref)
+    return instance_refs
+
+
+@require_admin_context
+def instance_data_get_for_project(context, project_id, session=None):
+    if not session:
+        session = get_session()
     result = session.query(func.count(models.Instance.id),
                            func.sum(models.Instance.vcpus),
                            func.sum(models.Instance.memory_mb)).\
@@ -1132,6 +1278,19 @@ def instance_get(context, instance_id, session=None):
     return result
 
 
+@require_context
+def instance_get_all_by_ids(context, instance_ids):
+    if not instance_ids:
+        return []
+    partial = _build_instance_get(context)
+    result = partial.filter(models.Instance.id.in_(instance_ids)).all()
+    instances = dict((instance['id'], instance) for instance in result)
+    for instance_id in instance_ids:
+        if instance_id not in instances:
+            raise exception.InstanceNotFound(instance_id=instance_id)
+    return [instances[instance_id] for instance_id in instance_ids]
+
+
 @require_context
 def _build_instance_get(context, session=None):
     if not session:
@@ -1359,6 +1518,25 @@ def instance_update(context, instance_id, values):
         return instance_ref
 
 
+@require_context
+def instance_update_bulk(context, updates):
+    session = get_session()
+    with session.begin():
+        instance_ids = [instance_id for instance_id, values in updates]
+        instance_refs = _build_instance_get(context, session=session).\
+                                filter(models.Instance.id.in_(instance_ids)).\
+                                all()
+        instance_refs = dict((ref['id'], ref) for ref in instance_refs)
+        result = []
+        for instance_id, values in updates:
+            if instance_id not in instance_refs:
+                raise exception.InstanceNotFound(instance_id=instance_id)
+            instance_ref = instance_refs[instance_id]
+            instance_ref.update(values)
+            result.append(instance_ref)
+        return result
+
+
 def instance_add_security_group(context, instance_id, security_group_id):
     """Associate the given security group with the given instance"""
     session = get_session()
@@ -1932,6 +2110,212 @@ def quota_destroy_all_by_project(context, project_id):
 ###################
 
 
+def _sync_instances(context, project_id, session):
+    return dict(zip(('instances', 'cores', 'ram'),
+                    instance_data_get_for_project(context, project_id,
+                                                  session=session)))
+
+
+def _sync_volumes(context, project_id, session):
+    return dict(zip(('volumes', 'gigabytes'),
+                    volume_data_get_for_project(context, project_id,
+                                                session=session)))
+
+
+def _sync_floating_ips(context, project_id, session):
+    return {'floating_ips': floating_ip_count_by_project(context, project_id,
+                                                         session=session)}
+
+
+QUOTA_SYNC_FUNCTIONS = {
+    'instances': _sync_instances,
+    'cores': _sync_instances,
+    'ram': _sync_instances,
+    'volumes': _sync_volumes,
+    'gigabytes': _sync_volumes,
+    'floating_ips': _sync_floating_ips,
+}
+
+
+def _quota_usage_create(project_id, resource):
+    """Create an empty usage row, unless a concurrent request already has.
+
+    The row is committed in its own session so that it can be locked by
+    the caller's transaction; rows created here have no updated_at yet
+    and are synced by the first request that locks them.
+    """
+    usage = models.QuotaUsage()
+    usage.project_id = project_id
+    usage.resource = resource
+    usage.in_use = 0
+    usage.reserved = 0
+    try:
+        usage.save()
+    except exception.DBError, e:
+        if not isinstance(e.inner_exception, IntegrityError):
+            raise
+
+
+def _quota_usage_get_synced(context, project_id, resources, max_age,
+                            session):
+    """Lock and return the usage rows for resources, keyed by resource.
+
+    Missing rows are created, and rows that are older than max_age seconds,
+    have never been synced or have gone negative are recomputed with the
+    aggregate queries in QUOTA_SYNC_FUNCTIONS. Must be called inside a
+    transaction.
+    """
+    query = session.query(models.QuotaUsage).\
+                    filter_by(project_id=project_id).\
+                    filter_by(deleted=False)
+    # NOTE: missing rows are inserted before any rows are locked, since the
+    #       inserts run in their own sessions. If a concurrent request got
+    #       there first, the insert fails on the unique constraint and the
+    #       locking read below picks up that request's row instead.
+    known = set(resource for resource, in
+                query.values(models.QuotaUsage.resource))
+    for resource in set(resources) - known:
+        _quota_usage_create(project_id, resource)
+    rows = query.with_lockmode('update').all()
+    usages = dict((row.resource, row) for row in rows)
+
+    now = utils.utcnow()
+    stale = set()
+    for resource in resources:
+        usage = usages[resource]
+        if usage.updated_at is None or usage.in_use < 0:
+            stale.add(resource)
+        elif max_age:
+            age = now - usage.updated_at
+            if age.days * 86400 + age.seconds >= max_age:
+                stale.add(resource)
+
+    synced = set()
+    refreshed = set()
+    for resource in stale:
+        sync = QUOTA_SYNC_FUNCTIONS.get(resource)
+        if sync is None or sync in synced:
+            continue
+        synced.add(sync)
+        for res, in_use in sync(context, project_id, session).iteritems():
+            if res in usages:
+                usages[res].in_use = in_use
+                refreshed.add(res)
+
+    for resource in stale | refreshed:
+        # NOTE: always touch synced rows so updated_at restarts max_age
+        usages[resource].updated_at = now
+        usages[resource].save(session=session)
+    return usages
+
+
+@require_context
+def quota_usage_get_all_by_project(context, project_id, resources,
+                                   max_age=0):
+    authorize_project_context(context, project_id)
+    session = get_session()
+    with session.begin():
+        usages = _quota_usage_get_synced(context, project_id, resources,
+                                         max_age, session)
+    result = {'project_id': project_id}
+    for resource in resources:
+        usage = usages[resource]
+        result[resource] = dict(in_use=usage.in_use,
+                                reserved=usage.reserved)
+    return result
+
+
+@require_context
+def quota_reserve(context, project_id, quotas, deltas, expire, max_age=0):
+    authorize_project_context(context, project_id)
+    session = get_session()
+    with session.begin():
+        usages = _quota_usage_get_synced(context, project_id, deltas.keys(),
+                                         max_age, session)
+
+        # NOTE: negative deltas never fail the check, and only positive
+        #       deltas are held in reserved until they are committed, so
+        #       pending releases do not free up quota early.
+        overs = [resource for resource, delta in deltas.iteritems()
+                 if delta > 0 and quotas.get(resource) is not None and
+                    quotas[resource] < usages[resource].total + delta]
+        if overs:
+            raise exception.OverQuota(overs=sorted(overs))
+
+        reservations = []
+        for resource, delta in deltas.iteritems():
+            usage = usages[resource]
+            reservation = models.Reservation()
+            reservation.uuid = str(utils.gen_uuid())
+            reservation.usage_id = usage.id
+            reservation.project_id = project_id
+            reservation.resource = resource
+            reservation.delta = delta
+            reservation.expire = expire
+            reservation.save(session=session)
+            reservations.append(reservation.uuid)
+            if delta > 0:
+                usage.reserved += delta
+                usage.save(session=session)
+    return reservations
+
+
+def _reservation_get_all(session, reservations=None, expired_before=None):
+    query = session.query(models.Reservation).\
+                    options(joinedload('usage')).\
+                    filter_by(deleted=False)
+    if reservations is not None:
+        query = query.filter(models.Reservation.uuid.in_(reservations))
+    if expired_before is not None:
+        query = query.filter(models.Reservation.expire < expired_before)
+    return query.with_lockmode('update').all()
+
+
+def _reservation_finish(session, rows, commit):
+    for reservation in rows:
+        usage = reservation.usage
+        if reservation.delta > 0:
+            usage.reserved -= reservation.delta
+        if commit:
+            usage.in_use += reservation.delta
+        usage.save(session=session)
+        reservation.delete(session=session)
+
+
+@require_context
+def reservation_commit(context, reservations):
+    if not reservations:
+        return
+    session = get_session()
+    with session.begin():
+        _reservation_finish(session,
+                            _reservation_get_all(session, reservations),
+                            commit=True)
+
+
+@require_context
+def reservation_rollback(context, reservations):
+    if not reservations:
+        return
+    session = get_session()
+    with session.begin():
+        _reservation_finish(session,
+                            _reservation_get_all(session, reservations),
+                            commit=False)
+
+
+@require_admin_context
+def reservation_expire(context):
+    session = get_session()
+    with session.begin():
+        rows = _reservation_get_all(session, expired_before=utils.utcnow())
+        _reservation_finish(session, rows, commit=False)
+    return len(rows)
+
+
+###################
+
+
 @require_admin_context
 def volume_allocate_shelf_and_blade(context, volume_id):
     session = get_session()
@@ -1994,8 +2378,9 @@ def volume_create(context, values):
 
 
 @require_admin_context
-def volume_data_get_for_project(context, project_id):
-    session = get_session()
+def volume_data_get_for_project(context, project_id, session=None):
+    if not session:
+        session = get_session()
     result = session.query(func.count(models.Volume.id),
                            func.sum(models.Volume.size)).\
                      filter_by(project_id=project_id).\
@@ -2059,6 +2444,29 @@ def volume_get(context, volume_id, session=None):
     return result
 
 
+@require_context
+def volume_get_all_by_ids(context, volume_ids):
+    if not volume_ids:
+        return []
+    session = get_session()
+    query = session.query(models.Volume).\
+                    options(joinedload('instance')).\
+                    filter(models.Volume.id.in_(volume_ids))
+
+    if is_admin_context(context):
+        query = query.filter_by(deleted=can_read_deleted(context))
+    elif is_user_context(context):
+        query = query.filter_by(project_id=context.project_id).\
+                      filter_by(deleted=False)
+    result = query.all()
+
+    found = set(volume['id'] for volume in result)
+    for volume_id in volume_ids:
+        if volume_id not in found:
+            raise exception.VolumeNotFound(volume_id=volume_id)
+    return result
+
+
 @require_admin_context
 def volume_get_all(context):
     session = get_session()
@@ -2238,6 +2646,16 @@ def block_device_mapping_create(context, values):
         bdm_ref.save(session=session)
 
 
+@require_context
+def block_device_mapping_create_bulk(context, values_list):
+    session = get_session()
+    with session.begin():
+        for values in values_list:
+            bdm_ref = models.BlockDeviceMapping()
+            bdm_ref.update(values)
+            session.add(bdm_ref)
+
+
 @require_context
 def block_device_mapping_update(context, bdm_id, values):
     session = get_session()
@@ -2277,6 +2695,18 @@ def block_device_mapping_get_all_by_instance(context, instance_id):
     return result
 
 
+@require_context
+def block_device_mapping_get_all_by_instances(context, instance_ids):
+    if not instance_ids:
+        return []
+    session = get_session()
+    return session.query(models.BlockDeviceMapping).\
+                   filter(models.BlockDeviceMapping.instance_id.in_(
+                          instance_ids)).\
+                   filter_by(deleted=False).\
+                   all()
+
+
 @require_context
 def block_device_mapping_destroy(context, bdm_id):
     session = get_session()
@@ -2530,6 +2960,19 @@ def provider_fw_rule_get_all(context):
                    all()
 
 
+@require_admin_context
+def provider_fw_rule_get_all_with_version(context):
+    session = get_session()
+    # Rules are only ever added, with a growing id, or soft deleted, so
+    # the highest id plus the number of deleted rules changes with every
+    # update and never goes back.
+    rules = session.query(models.ProviderFirewallRule).all()
+    live_rules = [rule for rule in rules if not rule.deleted]
+    version = max([0] + [rule.id for rule in rules]) + \
+              len(rules) - len(live_rules)
+    return live_rules, version
+
+
 @require_admin_context
 def provider_fw_rule_get_all_by_cidr(context, cidr):
     session = get_session()
@@ -2834,6 +3277,18 @@ def migration_get_by_instance_and_status(context, instance_uuid, status):
     return result
 
 
+@require_admin_context
+def migration_get_all_by_instances_and_status(context, instance_uuids,
+                                              status):
+    if not instance_uuids:
+        return []
+    session = get_session()
+    return session.query(models.Migration).\
+                   filter(models.Migration.instance_uuid.in_(instance_uuids)).\
+                   filter_by(status=status).\
+                   all()
+
+
 ##################
 
 
@@ -337,6 +337,52 @@ class Quota(BASE, NovaBase):
     hard_limit = Column(Integer, nullable=True)
 
 
+class QuotaUsage(BASE, NovaBase):
+    """Represents the current usage of a quota-limited resource.
+
+    in_use counts committed allocations; reserved counts allocations
+    that are in flight and have not yet been committed or rolled back.
+    """
+
+    __tablename__ = 'quota_usages'
+    __table_args__ = (schema.UniqueConstraint("project_id", "resource",
+                                              "deleted"),
+                      {'mysql_engine': 'InnoDB'})
+    id = Column(Integer, primary_key=True)
+
+    project_id = Column(String(255), index=True)
+    resource = Column(String(255))
+
+    in_use = Column(Integer)
+    reserved = Column(Integer)
+
+    @property
+    def total(self):
+        return self.in_use + self.reserved
+
+
+class Reservation(BASE, NovaBase):
+    """Represents a pending change to a QuotaUsage."""
+
+    __tablename__ = 'reservations'
+    id = Column(Integer, primary_key=True)
+    uuid = Column(String(36), nullable=False)
+
+    usage_id = Column(Integer, ForeignKey('quota_usages.id'), nullable=False)
+
+    project_id = Column(String(255), index=True)
+    resource = Column(String(255))
+
+    delta = Column(Integer)
+    expire = Column(DateTime, nullable=False)
+
+    usage = relationship(QuotaUsage,
+                         foreign_keys=usage_id,
+                         primaryjoin='and_(Reservation.usage_id == '
+                                          'QuotaUsage.id,'
+                                          'QuotaUsage.deleted == False)')
+
+
 class Snapshot(BASE, NovaBase):
     """Represents a block storage device that can be attached to a vm."""
     __tablename__ = 'snapshots'
@@ -805,7 +851,8 @@ def register_models():
               Network, SecurityGroup, SecurityGroupIngressRule,
               SecurityGroupInstanceAssociation, AuthToken, User,
               Project, Certificate, ConsolePool, Console, Zone,
-              AgentBuild, InstanceMetadata, InstanceTypeExtraSpecs, Migration)
+              AgentBuild, InstanceMetadata, InstanceTypeExtraSpecs, Migration,
+              QuotaUsage, Reservation)
     engine = create_engine(FLAGS.sql_connection, echo=False)
     for model in models:
         model.metadata.create_all(engine)
@@ -34,6 +34,10 @@ LOG = logging.getLogger('nova.exception')
 class ProcessExecutionError(IOError):
     def __init__(self, stdout=None, stderr=None, exit_code=None, cmd=None,
                  description=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_code = exit_code
+        self.cmd = cmd
         if description is None:
             description = _('Unexpected error while running command.')
         if exit_code is None:
@@ -692,3 +696,11 @@ class PasteConfigNotFound(NotFound):
 
 class PasteAppNotFound(NotFound):
     message = _("Could not load paste app '%(name)s' from %(path)s")
+
+
+class OverQuota(NovaException):
+    message = _("Quota exceeded for resources: %(overs)s")
+
+    def __init__(self, **kwargs):
+        self.overs = kwargs.get('overs', [])
+        super(OverQuota, self).__init__(**kwargs)
@@ -27,9 +27,6 @@ from nova.image import glance as glance_image_service
 FLAGS = flags.FLAGS
 
 
-GlanceClient = utils.import_class('glance.client.Client')
-
-
 def _parse_image_ref(image_href):
     """Parse an image href into composite parts.
 
@@ -67,14 +64,15 @@ def get_glance_client(image_href):
     if str(image_href).isdigit():
         glance_host, glance_port = \
             glance_image_service.pick_glance_api_server()
-        glance_client = GlanceClient(glance_host, glance_port)
+        glance_client = glance_image_service.PooledGlanceClient(glance_host,
+                                                                glance_port)
         return (glance_client, int(image_href))
 
     try:
         (image_id, host, port) = _parse_image_ref(image_href)
     except:
         raise exception.InvalidImageRef(image_href=image_href)
-    glance_client = GlanceClient(host, port)
+    glance_client = glance_image_service.PooledGlanceClient(host, port)
     return (glance_client, image_id)
 
 
@@ -19,9 +19,13 @@
 
 from __future__ import absolute_import
 
+import copy
 import datetime
+import httplib
 import random
+import time
 
+from eventlet import pools
 from glance.common import exception as glance_exception
 
 from nova import exception
@@ -35,9 +39,18 @@ LOG = logging.getLogger('nova.image.glance')
 
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('glance_client_pool_size', 10,
+                     'max number of kept-alive connections to each '
+                     'glance server')
+flags.DEFINE_integer('glance_image_cache_ttl', 5,
+                     'seconds to cache image metadata fetched from glance, '
+                     'changes made through other nova hosts can take this '
+                     'long to show up. 0 disables caching')
 
 
 GlanceClient = utils.import_class('glance.client.Client')
+ClientConnectionError = utils.import_class(
+        'glance.client.ClientConnectionError')
 
 
 def pick_glance_api_server():
@@ -55,6 +68,199 @@ def pick_glance_api_server():
     return host, port
 
 
+class _KeepAliveConnection(httplib.HTTPConnection):
+    """An HTTPConnection that is reused for request after request.
+
+    httplib won't send a request until the previous response has been read.
+    Glance never reads the empty body of a HEAD response, so those are
+    finished off here; a connection left in the middle of any other
+    response is closed instead and reconnects on its next request.
+
+    """
+
+    _response = None
+
+    def getresponse(self, *args, **kwargs):
+        self._response = httplib.HTTPConnection.getresponse(self, *args,
+                                                            **kwargs)
+        return self._response
+
+    def finish_response(self):
+        response = self._response
+        self._response = None
+        if response is None or response.isclosed():
+            return
+        if response._method == 'HEAD':
+            response.read()
+        else:
+            self.close()
+
+
+class _KeepAliveGlanceClient(GlanceClient):
+    """A glance client that keeps its connection open between requests."""
+
+    # requests that can be sent again without doing anything twice
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
+
+    def __init__(self, host, port):
+        super(_KeepAliveGlanceClient, self).__init__(host, port)
+        self._connection = _KeepAliveConnection(host, port)
+
+    def get_connection_type(self):
+        def _reuse_connection(host, port):
+            self._connection.finish_response()
+            return self._connection
+        return _reuse_connection
+
+    def do_request(self, method, action, body=None, headers=None,
+                   params=None):
+        reused = self._connection.sock is not None
+        try:
+            return super(_KeepAliveGlanceClient, self).do_request(
+                    method, action, body, headers, params)
+        except (httplib.HTTPException, ClientConnectionError):
+            self._connection.close()
+            # glance may have dropped a connection that sat idle in the
+            # pool, so try once more on a fresh one.  Glance may also have
+            # acted on the request before the connection broke, so others,
+            # such as the POST adding an image, are never sent twice.
+            if not reused or method not in self.IDEMPOTENT_METHODS:
+                raise
+            return super(_KeepAliveGlanceClient, self).do_request(
+                    method, action, body, headers, params)
+
+
+class _GlanceClientPool(pools.Pool):
+    """Pool of keep-alive clients of one glance server."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        pools.Pool.__init__(self,
+                            max_size=FLAGS.glance_client_pool_size,
+                            order_as_stack=True)
+
+    def create(self):
+        LOG.debug(_('Creating new glance client for %(host)s:%(port)s'),
+                  {'host': self.host, 'port': self.port})
+        return _KeepAliveGlanceClient(self.host, self.port)
+
+
+_CLIENT_POOLS = {}
+
+
+def _get_client_pool(host, port):
+    """Return the client pool of the glance server at host:port."""
+    pool = _CLIENT_POOLS.get((host, port))
+    if pool is None:
+        pool = _CLIENT_POOLS[(host, port)] = _GlanceClientPool(host, port)
+    return pool
+
+
+class _PooledImageBody(object):
+    """Image chunks that keep their client checked out until read through."""
+
+    def __init__(self, pool, client, image_chunks):
+        self._pool = pool
+        self._client = client
+        self._image_chunks = image_chunks
+
+    def __iter__(self):
+        try:
+            for chunk in self._image_chunks:
+                yield chunk
+        finally:
+            self._put_client()
+
+    def _put_client(self):
+        client, self._client = self._client, None
+        if client is not None:
+            self._pool.put(client)
+
+    def __del__(self):
+        self._put_client()
+
+
+class PooledGlanceClient(object):
+    """A glance client that runs each call on a pooled keep-alive client.
+
+    Behaves like glance.client.Client for the glance server at host:port,
+    but only holds a connection for the length of a call, or until the body
+    returned by get_image has been read.
+
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._pool = _get_client_pool(host, port)
+
+    def __getattr__(self, name):
+        def _call(*args, **kwargs):
+            client = self._pool.get()
+            try:
+                result = getattr(client, name)(*args, **kwargs)
+            except Exception:
+                self._pool.put(client)
+                raise
+            if name != 'get_image':
+                self._pool.put(client)
+                return result
+            image_meta, image_chunks = result
+            return (image_meta,
+                    _PooledImageBody(self._pool, client, image_chunks))
+        return _call
+
+
+class _ImageCache(object):
+    """Results fetched from glance, kept for FLAGS.glance_image_cache_ttl.
+
+    A key of None is never cached, so callers that can't name what they
+    looked up just pass it through.
+
+    """
+
+    # expired entries are only dropped once this many pile up
+    PURGE_SIZE = 1000
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, key):
+        if key is None or FLAGS.glance_image_cache_ttl <= 0:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.time():
+            del self._entries[key]
+            return None
+        return value
+
+    def set(self, key, value):
+        if key is None or FLAGS.glance_image_cache_ttl <= 0:
+            return
+        now = time.time()
+        if len(self._entries) >= self.PURGE_SIZE:
+            for stale_key, (expires, _value) in self._entries.items():
+                if expires < now:
+                    del self._entries[stale_key]
+        self._entries[key] = (now + FLAGS.glance_image_cache_ttl, value)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# images glance doesn't have are cached as _IMAGE_NOT_FOUND
+_IMAGE_NOT_FOUND = object()
+_IMAGE_META_CACHE = _ImageCache()
+_IMAGE_LIST_CACHE = _ImageCache()
+
+
 class GlanceImageService(service.BaseImageService):
     """Provides storage and retrieval of disk image objects within Glance."""
 
@@ -76,13 +282,68 @@ class GlanceImageService(service.BaseImageService):
         if self._client is not None:
             return self._client
         glance_host, glance_port = pick_glance_api_server()
-        return GlanceClient(glance_host, glance_port)
+        return PooledGlanceClient(glance_host, glance_port)
 
     def _set_client(self, client):
         self._client = client
 
     client = property(_get_client, _set_client)
 
+    def _cache_endpoint(self):
+        """Return which glance servers this service talks to.
+
+        Returns None, so nothing is cached, for clients that were handed in
+        rather than pooled, since those may be anything.
+
+        """
+        if self._client is None:
+            return 'default'
+        if isinstance(self._client, PooledGlanceClient):
+            return (self._client.host, self._client.port)
+        return None
+
+    def _get_images_detailed(self, filters, marker, limit):
+        key = None
+        endpoint = self._cache_endpoint()
+        if endpoint is not None:
+            key = (endpoint, tuple(sorted(filters.items())), marker, limit)
+            try:
+                hash(key)
+            except TypeError:
+                key = None
+
+        image_metas = _IMAGE_LIST_CACHE.get(key)
+        if image_metas is None:
+            image_metas = list(self.client.get_images_detailed(
+                    filters=filters, marker=marker, limit=limit))
+            _IMAGE_LIST_CACHE.set(key, image_metas)
+        return copy.deepcopy(image_metas)
+
+    def _get_image_meta(self, image_id):
+        key = None
+        endpoint = self._cache_endpoint()
+        if endpoint is not None:
+            key = (endpoint, image_id)
+
+        image_meta = _IMAGE_META_CACHE.get(key)
+        if image_meta is _IMAGE_NOT_FOUND:
+            raise exception.ImageNotFound(image_id=image_id)
+        if image_meta is None:
+            try:
+                image_meta = self.client.get_image_meta(image_id)
+            except glance_exception.NotFound:
+                _IMAGE_META_CACHE.set(key, _IMAGE_NOT_FOUND)
+                raise exception.ImageNotFound(image_id=image_id)
+            _IMAGE_META_CACHE.set(key, image_meta)
+        return copy.deepcopy(image_meta)
+
+    def _invalidate_cache(self, image_id):
+        """Forget what we know of image_id, which we've just changed."""
+        endpoint = self._cache_endpoint()
+        if endpoint is not None:
+            _IMAGE_META_CACHE.delete((endpoint, image_id))
+        _IMAGE_LIST_CACHE.clear()
+
     def index(self, context, filters=None, marker=None, limit=None):
         """Calls out to Glance for a list of images available."""
         # NOTE(sirp): We need to use `get_images_detailed` and not
@@ -93,9 +354,7 @@ class GlanceImageService(service.BaseImageService):
         if 'is_public' not in filters:
             # NOTE(vish): don't filter out private images
             filters['is_public'] = 'none'
-        image_metas = self.client.get_images_detailed(filters=filters,
-                                                      marker=marker,
-                                                      limit=limit)
+        image_metas = self._get_images_detailed(filters, marker, limit)
         for image_meta in image_metas:
             if self._is_image_available(context, image_meta):
                 meta_subset = utils.subset_dict(image_meta, ('id', 'name'))
@@ -109,9 +368,7 @@ class GlanceImageService(service.BaseImageService):
         if 'is_public' not in filters:
             # NOTE(vish): don't filter out private images
             filters['is_public'] = 'none'
-        image_metas = self.client.get_images_detailed(filters=filters,
-                                                      marker=marker,
-                                                      limit=limit)
+        image_metas = self._get_images_detailed(filters, marker, limit)
         for image_meta in image_metas:
             if self._is_image_available(context, image_meta):
                 base_image_meta = self._translate_to_base(image_meta)
@@ -120,11 +377,7 @@ class GlanceImageService(service.BaseImageService):
 
     def show(self, context, image_id):
         """Returns a dict with image data for the given opaque image id."""
-        try:
-            image_meta = self.client.get_image_meta(image_id)
-        except glance_exception.NotFound:
-            raise exception.ImageNotFound(image_id=image_id)
-
+        image_meta = self._get_image_meta(image_id)
         if not self._is_image_available(context, image_meta):
             raise exception.ImageNotFound(image_id=image_id)
 
@@ -133,9 +386,7 @@ class GlanceImageService(service.BaseImageService):
 
     def show_by_name(self, context, name):
         """Returns a dict containing image data for the given name."""
-        # TODO(vish): replace this with more efficient call when glance
-        #             supports it.
-        image_metas = self.detail(context)
+        image_metas = self.detail(context, filters={'name': name})
         for image_meta in image_metas:
             if name == image_meta.get('name'):
                 return image_meta
@@ -169,6 +420,7 @@ class GlanceImageService(service.BaseImageService):
 
         recv_service_image_meta = self.client.add_image(
             sent_service_image_meta, data)
+        self._invalidate_cache(recv_service_image_meta.get('id'))
 
         # Translate Service -> Base
         base_image_meta = self._translate_to_base(recv_service_image_meta)
@@ -188,6 +440,8 @@ class GlanceImageService(service.BaseImageService):
             image_meta = self.client.update_image(image_id, image_meta, data)
         except glance_exception.NotFound:
             raise exception.ImageNotFound(image_id=image_id)
+        finally:
+            self._invalidate_cache(image_id)
 
         base_image_meta = self._translate_to_base(image_meta)
         return base_image_meta
@@ -204,6 +458,8 @@ class GlanceImageService(service.BaseImageService):
             result = self.client.delete_image(image_id)
         except glance_exception.NotFound:
             raise exception.ImageNotFound(image_id=image_id)
+        finally:
+            self._invalidate_cache(image_id)
         return result
 
     def delete_all(self):
@@ -53,6 +53,8 @@ This module provides Manager, a base class for managers.
 
 """
 
+import time
+
 from nova import flags
 from nova import log as logging
 from nova import utils
@@ -61,6 +63,9 @@ from nova.scheduler import api
 
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('capabilities_full_sync_interval', 600,
+                     'Seconds between sending the scheduler all of a '
+                     'service\'s capabilities rather than only changes')
 
 
 LOG = logging.getLogger('nova.manager')
@@ -94,22 +99,61 @@ class SchedulerDependentManager(Manager):
     manager.Manager directly. Updates are only sent after
     update_service_capabilities is called with non-None values.
 
+    Only capabilities that changed since the previous update are sent,
+    tagged with a sequence number so the Schedulers can spot a missed
+    update. All capabilities are sent on the first update, when a
+    Scheduler asks for them with resend_service_capabilities and every
+    --capabilities_full_sync_interval seconds.
+
     """
 
     def __init__(self, host=None, db_driver=None, service_name='undefined'):
         self.last_capabilities = None
         self.service_name = service_name
+        self._sent_capabilities = None
+        self._capabilities_sequence = 0
+        self._last_full_sync = 0
         super(SchedulerDependentManager, self).__init__(host, db_driver)
 
     def update_service_capabilities(self, capabilities):
         """Remember these capabilities to send on next periodic update."""
         self.last_capabilities = capabilities
 
+    def resend_service_capabilities(self, context=None):
+        """Send all the capabilities on the next update, a Scheduler
+        missed some of the changes sent."""
+        self._sent_capabilities = None
+
+    def _capabilities_delta(self):
+        """Return (changed, removed) since the last capabilities sent."""
+        sent = self._sent_capabilities
+        changed = dict((key, value)
+                       for key, value in self.last_capabilities.iteritems()
+                       if key not in sent or sent[key] != value)
+        removed = [key for key in sent
+                   if key not in self.last_capabilities]
+        return changed, removed
+
     def periodic_tasks(self, context=None):
         """Pass data back to the scheduler at a periodic interval."""
         if self.last_capabilities:
             LOG.debug(_('Notifying Schedulers of capabilities ...'))
-            api.update_service_capabilities(context, self.service_name,
-                                self.host, self.last_capabilities)
+            self._capabilities_sequence += 1
+            now = time.time()
+            if self._sent_capabilities is None or \
+               now - self._last_full_sync >= \
+                        FLAGS.capabilities_full_sync_interval:
+                self._last_full_sync = now
+                api.update_service_capabilities(context, self.service_name,
+                                self.host, self.last_capabilities,
+                                sequence=self._capabilities_sequence)
+            else:
+                # An empty delta still tells the Schedulers we are alive.
+                changed, removed = self._capabilities_delta()
+                api.update_service_capabilities(context, self.service_name,
+                                self.host, changed,
+                                sequence=self._capabilities_sequence,
+                                full=False, removed=removed)
+            self._sent_capabilities = dict(self.last_capabilities)
 
         super(SchedulerDependentManager, self).periodic_tasks(context)
@@ -144,12 +144,15 @@ class IptablesTable(object):
         chain_set.remove(name)
         self.rules = filter(lambda r: r.chain != name, self.rules)
 
+        # NOTE: pad with spaces so that removing 'foo-1' leaves the jumps
+        #       to 'foo-12' alone.
         if wrap:
-            jump_snippet = '-j %s-%s' % (binary_name, name)
+            jump_snippet = ' -j %s-%s ' % (binary_name, name)
         else:
-            jump_snippet = '-j %s' % (name,)
+            jump_snippet = ' -j %s ' % (name,)
 
-        self.rules = filter(lambda r: jump_snippet not in r.rule, self.rules)
+        self.rules = filter(lambda r: jump_snippet not in ' %s ' % r.rule,
+                            self.rules)
 
     def add_rule(self, chain, rule, wrap=True, top=False):
         """Add a rule to the table.
@@ -464,9 +467,10 @@ def ensure_vlan(vlan_num, bridge_interface):
     interface = 'vlan%s' % vlan_num
     if not _device_exists(interface):
         LOG.debug(_('Starting VLAN inteface %s'), interface)
-        _execute('sudo', 'vconfig', 'set_name_type', 'VLAN_PLUS_VID_NO_PAD')
-        _execute('sudo', 'vconfig', 'add', bridge_interface, vlan_num)
-        _execute('sudo', 'ip', 'link', 'set', interface, 'up')
+        _execute_batch(('sudo', 'vconfig', 'set_name_type',
+                        'VLAN_PLUS_VID_NO_PAD'),
+                       ('sudo', 'vconfig', 'add', bridge_interface, vlan_num),
+                       ('sudo', 'ip', 'link', 'set', interface, 'up'))
     return interface
 
 
@@ -487,11 +491,11 @@ def ensure_bridge(bridge, interface, net_attrs=None):
     """
     if not _device_exists(bridge):
         LOG.debug(_('Starting Bridge interface for %s'), interface)
-        _execute('sudo', 'brctl', 'addbr', bridge)
-        _execute('sudo', 'brctl', 'setfd', bridge, 0)
         # _execute('sudo brctl setageing %s 10' % bridge)
-        _execute('sudo', 'brctl', 'stp', bridge, 'off')
-        _execute('sudo', 'ip', 'link', 'set', bridge, 'up')
+        _execute_batch(('sudo', 'brctl', 'addbr', bridge),
+                       ('sudo', 'brctl', 'setfd', bridge, 0),
+                       ('sudo', 'brctl', 'stp', bridge, 'off'),
+                       ('sudo', 'ip', 'link', 'set', bridge, 'up'))
     if net_attrs:
         # NOTE(vish): The ip for dnsmasq has to be the first address on the
         #             bridge for it to respond to reqests properly
@@ -689,6 +693,16 @@ def _execute(*cmd, **kwargs):
         return utils.execute(*cmd, **kwargs)
 
 
+def _execute_batch(*cmds):
+    """Wrapper around utils.execute_batch for fake_network."""
+    if FLAGS.fake_network:
+        for cmd in cmds:
+            LOG.debug('FAKE NET: %s', ' '.join(map(str, cmd)))
+        return [('fake', 0) for cmd in cmds]
+    else:
+        return utils.execute_batch(*cmds)
+
+
 def _device_exists(device):
     """Check if ethernet device exists."""
     (_out, err) = _execute('ip', 'link', 'show', 'dev', device,
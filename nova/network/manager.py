@@ -41,15 +41,20 @@ topologies.  All of the network commands are issued to a subclass of
                                  is disassociated
 :create_unique_mac_address_attempts:  Number of times to attempt creating
                                       a unique mac address
+:network_info_cache_ttl:  Seconds the network info of an instance is
+                          cached for
 
 """
 
+import copy
 import datetime
 import math
 import netaddr
 import socket
+import time
 from eventlet import greenpool
 
+from nova import compute
 from nova import context
 from nova import db
 from nova import exception
@@ -110,6 +115,9 @@ flags.DEFINE_string('network_host', socket.gethostname(),
                     'Network host to use for ip allocation in flat modes')
 flags.DEFINE_bool('fake_call', False,
                   'If True, skip using the queue and make local calls')
+flags.DEFINE_integer('network_info_cache_ttl', 60,
+                     'Seconds the network info of an instance is cached '
+                     'for, 0 to disable the cache')
 
 
 class AddressAlreadyAllocated(exception.Error):
@@ -256,16 +264,24 @@ class FloatingIP(object):
     def allocate_floating_ip(self, context, project_id):
         """Gets an floating ip from the pool."""
         # NOTE(tr3buchet): all networks hosts in zone now use the same pool
-        LOG.debug("QUOTA: %s" % quota.allowed_floating_ips(context, 1))
-        if quota.allowed_floating_ips(context, 1) < 1:
+        try:
+            reservations = quota.reserve(context, project_id=project_id,
+                                         floating_ips=1)
+        except exception.OverQuota:
             LOG.warn(_('Quota exceeded for %s, tried to allocate '
                        'address'),
                      context.project_id)
             raise quota.QuotaError(_('Address quota exceeded. You cannot '
                                      'allocate any more addresses'))
         # TODO(vish): add floating ips through manage command
-        return self.db.floating_ip_allocate_address(context,
-                                                    project_id)
+        try:
+            address = self.db.floating_ip_allocate_address(context,
+                                                           project_id)
+        except Exception:
+            quota.rollback(context, reservations)
+            raise
+        quota.commit(context, reservations)
+        return address
 
     def associate_floating_ip(self, context, floating_address, fixed_address):
         """Associates an floating ip to a fixed ip."""
@@ -284,7 +300,15 @@ class FloatingIP(object):
 
     def deallocate_floating_ip(self, context, floating_address):
         """Returns an floating ip to the pool."""
+        floating_ip = self.db.floating_ip_get_by_address(context,
+                                                         floating_address)
+        reservations = None
+        if floating_ip['project_id']:
+            reservations = quota.reserve(context,
+                                         project_id=floating_ip['project_id'],
+                                         floating_ips=-1)
         self.db.floating_ip_deallocate(context, floating_address)
+        quota.commit(context, reservations)
 
 
 class NetworkManager(manager.SchedulerDependentManager):
@@ -313,6 +337,16 @@ class NetworkManager(manager.SchedulerDependentManager):
             network_driver = FLAGS.network_driver
         self.driver = utils.import_object(network_driver)
         self.network_api = network_api.API()
+        self.compute_api = compute.API()
+        # instance id -> (cache key, expiry time, network info)
+        self._nw_info_cache = {}
+        # instance type id -> (expiry time, instance type)
+        self._instance_type_cache = {}
+        # (network id, host) -> (expiry time, dhcp server address)
+        self._dhcp_ip_cache = {}
+        # bumped on every invalidation so that a lookup racing with an
+        # allocation doesn't cache what it read before the change
+        self._nw_info_epoch = 0
         super(NetworkManager, self).__init__(service_name='network',
                                                 *args, **kwargs)
 
@@ -350,6 +384,7 @@ class NetworkManager(manager.SchedulerDependentManager):
     def periodic_tasks(self, context=None):
         """Tasks to be run at a periodic interval."""
         super(NetworkManager, self).periodic_tasks(context)
+        self._expire_nw_info_cache()
         if self.timeout_fixed_ips:
             now = utils.utcnow()
             timeout = FLAGS.fixed_ip_disassociate_timeout
@@ -395,12 +430,14 @@ class NetworkManager(manager.SchedulerDependentManager):
         admin_context = context.elevated()
         LOG.debug(_("network allocations for instance %s"), instance_id,
                                                             context=context)
+        self._invalidate_nw_info(instance_id)
         networks = self._get_networks_for_instance(admin_context, instance_id,
                                                                   project_id)
         LOG.warn(networks)
         self._allocate_mac_addresses(context, instance_id, networks)
         ips = self._allocate_fixed_ips(admin_context, instance_id,
                                        host, networks, vpn=vpn)
+        self._refresh_security_group_members(instance_id)
         return self.get_instance_nw_info(context, instance_id,
                                          type_id, host, ips=ips)
 
@@ -415,9 +452,11 @@ class NetworkManager(manager.SchedulerDependentManager):
                   self.db.fixed_ip_get_by_instance(context, instance_id)
         LOG.debug(_("network deallocation for instance |%s|"), instance_id,
                                                                context=context)
+        self._invalidate_nw_info(instance_id)
         # deallocate fixed ips
         for fixed_ip in fixed_ips:
             self.deallocate_fixed_ip(context, fixed_ip['address'], **kwargs)
+        self._refresh_security_group_members(instance_id)
 
         # deallocate vifs (mac addresses)
         self.db.virtual_interface_delete_by_instance(context, instance_id)
@@ -432,24 +471,86 @@ class NetworkManager(manager.SchedulerDependentManager):
         where network = dict containing pertinent data from a network db object
         and info = dict containing pertinent networking data
         """
+        if FLAGS.network_info_cache_ttl <= 0:
+            return self._build_instance_nw_info(context, instance_id,
+                                                instance_type_id, host)
+
+        # Only the network host handling an allocation invalidates its
+        # cache, the others notice the change from the version.
+        version = self.db.virtual_interface_get_version_by_instance(
+                context, instance_id)
+        cache_key = (instance_type_id, host, version)
+        cached = self._nw_info_cache.get(instance_id)
+        if cached and cached[0] == cache_key and cached[1] > time.time():
+            return copy.deepcopy(cached[2])
+
+        epoch = self._nw_info_epoch
+        network_info = self._build_instance_nw_info(context, instance_id,
+                                                    instance_type_id, host)
+        if epoch == self._nw_info_epoch:
+            expires = time.time() + FLAGS.network_info_cache_ttl
+            self._nw_info_cache[instance_id] = (cache_key, expires,
+                                                network_info)
+        return copy.deepcopy(network_info)
+
+    def _refresh_security_group_members(self, instance_id):
+        """Tell compute hosts the addresses of an instance's groups changed.
+
+        Called once fixed ips are allocated or deallocated, so that hosts
+        matching these groups by address see the change.
+
+        """
+        admin_context = context.get_admin_context()
+        groups = self.db.security_group_get_by_instance(admin_context,
+                                                        instance_id)
+        if groups:
+            self.compute_api.trigger_security_group_members_refresh(
+                    admin_context, [group['id'] for group in groups])
+
+    def _invalidate_nw_info(self, instance_id):
+        """Forget the cached network info of an instance."""
+        self._nw_info_epoch += 1
+        self._nw_info_cache.pop(instance_id, None)
+
+    def _expire_nw_info_cache(self):
+        now = time.time()
+        for instance_id, cached in self._nw_info_cache.items():
+            if cached[1] <= now:
+                del self._nw_info_cache[instance_id]
+        for cache in (self._instance_type_cache, self._dhcp_ip_cache):
+            for key, cached in cache.items():
+                if cached[0] <= now:
+                    del cache[key]
+
+    def _cached(self, cache, key, lookup, *args):
+        """Return what lookup(*args) returned for key less than
+        --network_info_cache_ttl seconds ago, or call it again."""
+        cached = cache.get(key)
+        if cached and cached[0] > time.time():
+            return cached[1]
+        value = lookup(*args)
+        if FLAGS.network_info_cache_ttl > 0:
+            cache[key] = (time.time() + FLAGS.network_info_cache_ttl, value)
+        return value
+
+    def _build_instance_nw_info(self, context, instance_id,
+                                instance_type_id, host):
         # TODO(tr3buchet) should handle floating IPs as well?
-        try:
-            fixed_ips = self.db.fixed_ip_get_by_instance(context, instance_id)
-        except exception.FixedIpNotFoundForInstance:
+        vifs = self.db.virtual_interface_get_by_instance_with_fixed_ips(
+                context, instance_id)
+        if not any(fixed_ips for (_vif, fixed_ips) in vifs):
             LOG.warn(_('No fixed IPs for instance %s'), instance_id)
-            fixed_ips = []
 
-        vifs = self.db.virtual_interface_get_by_instance(context, instance_id)
-        flavor = self.db.instance_type_get(context, instance_type_id)
+        flavor = self._cached(self._instance_type_cache, instance_type_id,
+                              self.db.instance_type_get, context,
+                              instance_type_id)
         network_info = []
         # a vif has an address, instance_id, and network_id
-        # it is also joined to the instance and network given by those IDs
-        for vif in vifs:
+        # it is also joined to the network given by those IDs, and comes
+        # with the instance's fixed ips on that network
+        for vif, fixed_ips in vifs:
             network = vif['network']
-
-            # determine which of the instance's IPs belong to this network
-            network_IPs = [fixed_ip['address'] for fixed_ip in fixed_ips if
-                           fixed_ip['network_id'] == network['id']]
+            network_IPs = [fixed_ip['address'] for fixed_ip in fixed_ips]
 
             # TODO(tr3buchet) eventually "enabled" should be determined
             def ip_dict(ip):
@@ -474,12 +575,13 @@ class NetworkManager(manager.SchedulerDependentManager):
                 'vlan': network['vlan'],
                 'bridge_interface': network['bridge_interface'],
                 'multi_host': network['multi_host']}
-            if network['multi_host']:
-                dhcp_server = self._get_dhcp_ip(context, network, host)
+            if not network['multi_host']:
+                dhcp_server = network['gateway']
             else:
-                dhcp_server = self._get_dhcp_ip(context,
-                                                network,
-                                                network['host'])
+                dhcp_server = self._cached(self._dhcp_ip_cache,
+                                           (network['id'], host),
+                                           self._get_dhcp_ip, context,
+                                           network, host)
             info = {
                 'label': network['label'],
                 'gateway': network['gateway'],
@@ -506,22 +608,43 @@ class NetworkManager(manager.SchedulerDependentManager):
         return network_info
 
     def _allocate_mac_addresses(self, context, instance_id, networks):
-        """Generates mac addresses and creates vif rows in db for them."""
-        for network in networks:
-            vif = {'address': self.generate_mac_address(),
-                   'instance_id': instance_id,
-                   'network_id': network['id']}
-            # try FLAG times to create a vif record with a unique mac_address
-            for i in range(FLAGS.create_unique_mac_address_attempts):
-                try:
-                    self.db.virtual_interface_create(context, vif)
-                    break
-                except exception.VirtualInterfaceCreateException:
-                    vif['address'] = self.generate_mac_address()
-            else:
-                self.db.virtual_interface_delete_by_instance(context,
-                                                             instance_id)
-                raise exception.VirtualInterfaceMacAddressException()
+        """Generates mac addresses and creates vif rows in db for them.
+
+        The addresses are checked against the db in one query and all of
+        the instance's vifs are inserted in one statement. Only addresses
+        found to be taken are generated again, unless another allocation
+        grabbed one in the meantime.
+        """
+        vifs = [{'instance_id': instance_id,
+                 'network_id': network['id']} for network in networks]
+        if not vifs:
+            return
+
+        addresses = [None] * len(vifs)
+        # try FLAG times to create the vif records with unique mac_addresses
+        for i in range(FLAGS.create_unique_mac_address_attempts):
+            addresses = [address or self.generate_mac_address()
+                         for address in addresses]
+            used = self.db.virtual_interface_get_used_addresses(context,
+                                                                addresses)
+            seen = set()
+            for index, address in enumerate(addresses):
+                if address in used or address in seen:
+                    addresses[index] = None
+                else:
+                    seen.add(address)
+            if None in addresses:
+                continue
+            for vif, address in zip(vifs, addresses):
+                vif['address'] = address
+            try:
+                self.db.virtual_interface_create_bulk(context, vifs)
+                return
+            except exception.VirtualInterfaceCreateException:
+                LOG.debug(_('Mac address collision creating vifs for '
+                            'instance %s, retrying'), instance_id)
+                addresses = [None] * len(vifs)
+        raise exception.VirtualInterfaceMacAddressException()
 
     def generate_mac_address(self):
         """Generate a mac address for a vif on an instance."""
@@ -533,15 +656,19 @@ class NetworkManager(manager.SchedulerDependentManager):
 
     def add_fixed_ip_to_instance(self, context, instance_id, host, network_id):
         """Adds a fixed ip to an instance from specified network."""
+        self._invalidate_nw_info(instance_id)
         networks = [self.db.network_get(context, network_id)]
         self._allocate_fixed_ips(context, instance_id, host, networks)
+        self._refresh_security_group_members(instance_id)
 
     def remove_fixed_ip_from_instance(self, context, instance_id, address):
         """Removes a fixed ip from an instance from specified network."""
+        self._invalidate_nw_info(instance_id)
         fixed_ips = self.db.fixed_ip_get_by_instance(context, instance_id)
         for fixed_ip in fixed_ips:
             if fixed_ip['address'] == address:
                 self.deallocate_fixed_ip(context, address)
+                self._refresh_security_group_members(instance_id)
                 return
         raise exception.FixedIpNotFoundForSpecificInstance(
                                     instance_id=instance_id, ip=address)
@@ -561,6 +688,7 @@ class NetworkManager(manager.SchedulerDependentManager):
         values = {'allocated': True,
                   'virtual_interface_id': vif['id']}
         self.db.fixed_ip_update(context, address, values)
+        self._invalidate_nw_info(instance_id)
         self._setup_network(context, network)
         return address
 
@@ -603,6 +731,7 @@ class NetworkManager(manager.SchedulerDependentManager):
                                 {'leased': False})
         if not fixed_ip['allocated']:
             self.db.fixed_ip_disassociate(context, address)
+            self._invalidate_nw_info(instance['id'])
             # NOTE(vish): dhcp server isn't updated until next setup, this
             #             means there will stale entries in the conf file
             #             the code below will update the file if necessary
@@ -717,15 +846,18 @@ class NetworkManager(manager.SchedulerDependentManager):
         top_reserved = self._top_reserved_ips
         project_net = netaddr.IPNetwork(network['cidr'])
         num_ips = len(project_net)
-        for index in range(num_ips):
-            address = str(project_net[index])
-            if index < bottom_reserved or num_ips - index < top_reserved:
-                reserved = True
-            else:
-                reserved = False
-            self.db.fixed_ip_create(context, {'network_id': network_id,
-                                              'address': address,
-                                              'reserved': reserved})
+
+        def fixed_ips():
+            for index, address in enumerate(project_net):
+                if index < bottom_reserved or num_ips - index < top_reserved:
+                    reserved = True
+                else:
+                    reserved = False
+                yield {'network_id': network_id,
+                       'address': str(address),
+                       'reserved': reserved}
+
+        self.db.fixed_ip_create_bulk(context, fixed_ips())
 
     def _allocate_fixed_ips(self, context, instance_id, host, networks,
                             **kwargs):
@@ -873,6 +1005,7 @@ class VlanManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
         values = {'allocated': True,
                   'virtual_interface_id': vif['id']}
         self.db.fixed_ip_update(context, address, values)
+        self._invalidate_nw_info(instance_id)
         self._setup_network(context, network)
         return address
 
@@ -16,11 +16,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-"""Quotas for instances, volumes, and floating ips."""
+"""Quotas for instances, volumes, and floating ips.
+
+Usage of instances, cores, ram, volumes, gigabytes and floating ips is
+tracked in per-project counters. Callers that consume one of those
+resources first reserve() the change, which checks the quota and holds the
+amount under a row lock, and then commit() or rollback() the returned
+reservations once the resource has been created or the request has failed.
+Releasing a resource is a reservation with a negative delta.
+"""
+
+import datetime
+import time
 
 from nova import db
 from nova import exception
 from nova import flags
+from nova import utils
 
 
 FLAGS = flags.FLAGS
@@ -44,6 +56,19 @@ flags.DEFINE_integer('quota_max_injected_file_content_bytes', 10 * 1024,
                      'number of bytes allowed per injected file')
 flags.DEFINE_integer('quota_max_injected_file_path_bytes', 255,
                      'number of bytes allowed per injected file path')
+flags.DEFINE_integer('quota_cache_ttl', 30,
+                     'seconds to cache per-project quota overrides, so a '
+                     'changed override can take this long to apply, '
+                     '0 disables the cache')
+flags.DEFINE_integer('quota_usage_max_age', 0,
+                     'seconds between resyncs of a usage counter from the '
+                     'database, 0 only resyncs missing or negative counters')
+flags.DEFINE_integer('reservation_expire', 86400,
+                     'seconds until an uncommitted reservation is rolled '
+                     'back')
+
+
+_QUOTA_CACHE = {}
 
 
 def _get_default_quotas():
@@ -66,15 +91,41 @@ def _get_default_quotas():
     return defaults
 
 
+def _get_project_overrides(context, project_id):
+    """Return the project's quota overrides, cached for quota_cache_ttl.
+
+    Overrides are changed from other processes (nova-manage), so there is
+    no invalidation; a change is picked up once the cached entry expires.
+    """
+    ttl = FLAGS.quota_cache_ttl
+    if ttl <= 0:
+        return db.quota_get_all_by_project(context, project_id)
+    now = time.time()
+    cached = _QUOTA_CACHE.get(project_id)
+    if cached is None or now - cached[0] >= ttl:
+        cached = (now, db.quota_get_all_by_project(context, project_id))
+        _QUOTA_CACHE[project_id] = cached
+    return cached[1]
+
+
 def get_project_quotas(context, project_id):
     rval = _get_default_quotas()
-    quota = db.quota_get_all_by_project(context, project_id)
+    quota = _get_project_overrides(context, project_id)
     for key in rval.keys():
         if key in quota:
             rval[key] = quota[key]
     return rval
 
 
+def _get_usages(context, project_id, *resources):
+    """Return in_use + reserved for each resource, in order."""
+    usages = db.quota_usage_get_all_by_project(context, project_id,
+                                               resources,
+                                               FLAGS.quota_usage_max_age)
+    return [usages[resource]['in_use'] + usages[resource]['reserved']
+            for resource in resources]
+
+
 def _get_request_allotment(requested, used, quota):
     if quota is None:
         return requested
@@ -87,8 +138,9 @@ def allowed_instances(context, requested_instances, instance_type):
     context = context.elevated()
     requested_cores = requested_instances * instance_type['vcpus']
     requested_ram = requested_instances * instance_type['memory_mb']
-    usage = db.instance_data_get_for_project(context, project_id)
-    used_instances, used_cores, used_ram = usage
+    used_instances, used_cores, used_ram = _get_usages(context, project_id,
+                                                       'instances', 'cores',
+                                                       'ram')
     quota = get_project_quotas(context, project_id)
     allowed_instances = _get_request_allotment(requested_instances,
                                                used_instances,
@@ -108,8 +160,8 @@ def allowed_volumes(context, requested_volumes, size):
     context = context.elevated()
     size = int(size)
     requested_gigabytes = requested_volumes * size
-    used_volumes, used_gigabytes = db.volume_data_get_for_project(context,
-                                                                  project_id)
+    used_volumes, used_gigabytes = _get_usages(context, project_id,
+                                               'volumes', 'gigabytes')
     quota = get_project_quotas(context, project_id)
     allowed_volumes = _get_request_allotment(requested_volumes, used_volumes,
                                              quota['volumes'])
@@ -125,7 +177,7 @@ def allowed_floating_ips(context, requested_floating_ips):
     """Check quota and return min(requested, allowed) floating ips."""
     project_id = context.project_id
     context = context.elevated()
-    used_floating_ips = db.floating_ip_count_by_project(context, project_id)
+    used_floating_ips, = _get_usages(context, project_id, 'floating_ips')
     quota = get_project_quotas(context, project_id)
     allowed_floating_ips = _get_request_allotment(requested_floating_ips,
                                                   used_floating_ips,
@@ -133,6 +185,45 @@ def allowed_floating_ips(context, requested_floating_ips):
     return min(requested_floating_ips, allowed_floating_ips)
 
 
+def reserve(context, project_id=None, **deltas):
+    """Check quotas and reserve the given resource deltas.
+
+    Positive deltas are checked against the project's quotas and held as
+    reserved until they are committed or rolled back, so concurrent
+    requests can not commit past a limit. Negative deltas release
+    resources and are applied on commit.
+
+    :param project_id: project to charge, defaults to the context's project
+    :param deltas: resource name to change in usage, e.g. instances=2
+    :returns: a list of reservations to pass to commit() or rollback()
+    :raises: OverQuota if a positive delta does not fit in the quota
+
+    """
+    if project_id is None:
+        project_id = context.project_id
+    context = context.elevated()
+    quotas = get_project_quotas(context, project_id)
+    expires = utils.utcnow() + datetime.timedelta(
+                                    seconds=FLAGS.reservation_expire)
+    return db.quota_reserve(context, project_id, quotas, deltas, expires,
+                            FLAGS.quota_usage_max_age)
+
+
+def commit(context, reservations):
+    """Apply reservations returned by reserve() to the usage counters."""
+    db.reservation_commit(context.elevated(), reservations)
+
+
+def rollback(context, reservations):
+    """Release reservations returned by reserve() without using them."""
+    db.reservation_rollback(context.elevated(), reservations)
+
+
+def expire(context):
+    """Roll back reservations that were never committed or rolled back."""
+    return db.reservation_expire(context.elevated())
+
+
 def _calculate_simple_quota(context, resource, requested):
     """Check quota for resource; return min(requested, allowed)."""
     quota = get_project_quotas(context, context.project_id)
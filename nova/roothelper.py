@@ -0,0 +1,321 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Long-lived helper that runs privileged commands for nova services.
+
+Every 'sudo' command run through nova.utils.execute normally forks a new
+sudo process. When --root_helper_socket is set, those commands are sent
+instead to nova-roothelper, a daemon running as root that listens on a
+local unix socket and runs commands whose executable is listed in
+--root_helper_commands.
+
+The wire protocol is one JSON document per line. A request is::
+
+    {"id": 1, "cmds": [["ip", "link", "show"]], "input": null}
+
+and is answered, in order, with::
+
+    {"id": 1, "results": [[0, "stdout", "stderr"]]}
+
+or {"id": 1, "error": "reason"} if the request was refused, in which case
+none of its commands ran. A request can carry several commands, which run
+one after another and stop at the first one that exits non-zero; input is
+only allowed for a request with a single command. Clients may also send
+several requests before reading any replies.
+
+Once a request has been written the client never sends it again, nor does
+nova.utils.execute fall back to sudo: the helper may have run it already.
+
+"""
+
+import errno
+import grp
+import json
+import os
+import socket
+
+import eventlet
+from eventlet import semaphore
+from eventlet.green import subprocess
+
+from nova import exception
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.roothelper')
+FLAGS = flags.FLAGS
+flags.DEFINE_string('root_helper_socket', None,
+                    'Unix socket of nova-roothelper; if unset, privileged '
+                    'commands fork sudo for every call')
+flags.DEFINE_list('root_helper_commands',
+                  ['aoe-discover', 'aoe-stat', 'brctl', 'ietadm', 'ip',
+                   'ip6tables-restore', 'ip6tables-save', 'iptables-restore',
+                   'iptables-save', 'iscsiadm', 'kpartx', 'losetup',
+                   'lvcreate', 'lvdisplay', 'lvremove', 'ovs-vsctl',
+                   'parted', 'qemu-nbd', 'route', 'tune2fs', 'umount',
+                   'vblade-persist', 'vconfig', 'vgs'],
+                  'Executables nova-roothelper is allowed to run, with any '
+                  'arguments. Commands that can write arbitrary files or '
+                  'signal arbitrary processes (tee, dd, chmod, chown, '
+                  'mount, kill) are left to sudo and its sudoers rules')
+flags.DEFINE_string('root_helper_socket_group', None,
+                    'Group allowed to connect to the nova-roothelper '
+                    'socket; only root can connect if unset')
+
+# NOTE: sudo resets the environment, so the helper does the same.
+_HELPER_ENV = {'PATH': '/sbin:/usr/sbin:/bin:/usr/bin'}
+
+
+class RootHelperError(exception.Error):
+    """The helper refused or never got a request; nothing was run."""
+    pass
+
+
+class RootHelperUnavailable(RootHelperError):
+    pass
+
+
+class RootHelperConnectionLost(exception.Error):
+    """The connection broke after a request was sent.
+
+    The helper may or may not have run the commands, so they must not be
+    run again.
+
+    """
+    pass
+
+
+class RootHelperClient(object):
+    """Connection to a nova-roothelper daemon.
+
+    A client serializes its requests on a single connection, so it may be
+    shared between greenthreads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        self._file = None
+        self._next_id = 0
+        self._lock = semaphore.Semaphore()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self._sock = sock
+        self._file = sock.makefile('rw')
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+                self._sock.close()
+            except socket.error:
+                pass
+        self._sock = None
+        self._file = None
+
+    def _connection_alive(self):
+        """Whether the helper is still at the other end of the socket.
+
+        An idle connection has nothing to read, so a closed or unreadable
+        one means the helper went away, e.g. it was restarted.
+
+        """
+        self._sock.setblocking(False)
+        try:
+            try:
+                self._sock.recv(1, socket.MSG_PEEK)
+            except socket.error as e:
+                return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+            return False
+        finally:
+            self._sock.setblocking(True)
+
+    def _send(self, cmds, process_input):
+        self._next_id += 1
+        request = {'id': self._next_id,
+                   'cmds': [map(str, cmd) for cmd in cmds],
+                   'input': process_input}
+        self._file.write(json.dumps(request) + '\n')
+        return self._next_id
+
+    def _receive(self, request_id):
+        line = self._file.readline()
+        if not line:
+            raise socket.error(_('nova-roothelper closed the connection'))
+        reply = json.loads(line)
+        if reply.get('id') != request_id:
+            raise socket.error(_('nova-roothelper reply out of order'))
+        if 'error' in reply:
+            raise RootHelperError(reply['error'])
+        return [tuple(result) for result in reply['results']]
+
+    def submit(self, requests):
+        """Pipeline requests and return their results in order.
+
+        :param requests: list of (cmds, process_input) tuples
+        :returns: one list of (exit_code, stdout, stderr) per request
+
+        """
+        with self._lock:
+            if self._sock is not None and not self._connection_alive():
+                self.close()
+            if self._sock is None:
+                try:
+                    self._connect()
+                except socket.error as e:
+                    self.close()
+                    raise RootHelperUnavailable(str(e))
+
+            try:
+                ids = [self._send(cmds, process_input)
+                       for cmds, process_input in requests]
+                self._file.flush()
+                return [self._receive(request_id) for request_id in ids]
+            except (socket.error, ValueError) as e:
+                self.close()
+                raise RootHelperConnectionLost(str(e))
+            except RootHelperError:
+                # NOTE: replies to any later pipelined requests
+                #       are still unread, so start over.
+                self.close()
+                raise
+
+    def execute(self, cmd, process_input=None):
+        """Run one command, returning (exit_code, stdout, stderr)."""
+        return self.submit([([cmd], process_input)])[0][0]
+
+    def execute_batch(self, cmds):
+        """Run cmds in order in one request, stopping at the first failure.
+
+        Returns the (exit_code, stdout, stderr) of each command that ran.
+        """
+        return self.submit([(cmds, None)])[0]
+
+
+_CLIENT = None
+
+
+def get_client():
+    """Return the shared client, or None if the helper is not configured."""
+    global _CLIENT
+    if not FLAGS.root_helper_socket:
+        return None
+    if _CLIENT is None or _CLIENT.path != FLAGS.root_helper_socket:
+        _CLIENT = RootHelperClient(FLAGS.root_helper_socket)
+    return _CLIENT
+
+
+class RootHelperServer(object):
+    """Runs allowlisted commands on behalf of nova services."""
+
+    def __init__(self, path=None, commands=None):
+        self.path = path or FLAGS.root_helper_socket
+        if commands is None:
+            commands = FLAGS.root_helper_commands
+        self.commands = set(commands)
+
+    def check_command(self, cmd):
+        """Raise RootHelperError unless cmd may be run."""
+        if not cmd or not isinstance(cmd, list):
+            raise RootHelperError(_('Malformed command %r') % (cmd,))
+        if cmd[0] not in self.commands:
+            raise RootHelperError(_('Command %s is not allowed') % cmd[0])
+
+    def run_command(self, cmd, process_input=None):
+        obj = subprocess.Popen(cmd,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               env=_HELPER_ENV)
+        stdout, stderr = obj.communicate(process_input)
+        return obj.returncode, stdout, stderr
+
+    def handle_request(self, request):
+        """Run the commands of one decoded request and build the reply."""
+        reply = {'id': request.get('id')}
+        cmds = request.get('cmds')
+        try:
+            if not cmds or not isinstance(cmds, list):
+                raise RootHelperError(_('Request has no commands'))
+            if len(cmds) > 1 and request.get('input') is not None:
+                raise RootHelperError(_('Input is only allowed for a '
+                                        'single command'))
+            for cmd in cmds:
+                self.check_command(cmd)
+        except RootHelperError as e:
+            LOG.warn(_('Refusing request: %s'), e)
+            reply['error'] = str(e)
+            return reply
+
+        results = []
+        process_input = request.get('input')
+        for cmd in cmds:
+            LOG.debug(_('Running cmd (roothelper): %s'), ' '.join(cmd))
+            try:
+                result = self.run_command(cmd, process_input)
+            except OSError as e:
+                result = (-1, '', str(e))
+            results.append(result)
+            if result[0]:
+                break
+        reply['results'] = results
+        return reply
+
+    def handle_connection(self, sock):
+        """Answer requests on sock, in order, until the peer disconnects."""
+        sockfile = sock.makefile('rw')
+        try:
+            while True:
+                line = sockfile.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = {}
+                sockfile.write(json.dumps(self.handle_request(request)) +
+                               '\n')
+                sockfile.flush()
+        except socket.error as e:
+            LOG.debug(_('Connection lost: %s'), e)
+        finally:
+            sockfile.close()
+            sock.close()
+
+    def listen(self):
+        """Bind the unix socket, readable by root_helper_socket_group."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = eventlet.listen(self.path, family=socket.AF_UNIX, backlog=128)
+        if FLAGS.root_helper_socket_group:
+            gid = grp.getgrnam(FLAGS.root_helper_socket_group).gr_gid
+            os.chown(self.path, 0, gid)
+            os.chmod(self.path, 0660)
+        else:
+            os.chmod(self.path, 0600)
+        return sock
+
+    def serve(self):
+        sock = self.listen()
+        LOG.info(_('nova-roothelper listening on %s'), self.path)
+        pool = eventlet.GreenPool()
+        while True:
+            conn, _addr = sock.accept()
+            pool.spawn_n(self.handle_connection, conn)
@@ -17,6 +17,7 @@
 Handles all requests relating to schedulers.
 """
 
+import eventlet
 import novaclient
 
 from nova import db
@@ -25,6 +26,7 @@ from nova import flags
 from nova import log as logging
 from nova import rpc
 from nova import utils
+from nova.scheduler import zone_manager
 
 from eventlet import greenpool
 
@@ -32,6 +34,13 @@ FLAGS = flags.FLAGS
 flags.DEFINE_bool('enable_zone_routing',
     False,
     'When True, routing to child zones will occur.')
+flags.DEFINE_integer('zone_client_ttl', 3600,
+    'Seconds to reuse an authenticated child zone client.')
+flags.DEFINE_integer('zone_call_timeout', 30,
+    'Seconds to wait for a child zone to answer a call.')
+flags.DEFINE_integer('zone_retry_interval', 60,
+    'Seconds before calling a child zone again once it has been '
+    'marked offline.')
 
 LOG = logging.getLogger('nova.scheduler.api')
 
@@ -93,12 +102,16 @@ def select(context, specs=None):
             params={"request_spec": specs})
 
 
-def update_service_capabilities(context, service_name, host, capabilities):
+def update_service_capabilities(context, service_name, host, capabilities,
+                                sequence=None, full=True, removed=None):
     """Send an update to all the scheduler services informing them
-       of the capabilities of this service."""
-    kwargs = dict(method='update_service_capabilities',
-                  args=dict(service_name=service_name, host=host,
-                            capabilities=capabilities))
+       of the capabilities of this service. If full is False only the
+       changed capabilities and the names of removed ones are sent."""
+    args = dict(service_name=service_name, host=host,
+                capabilities=capabilities)
+    if sequence is not None:
+        args.update(sequence=sequence, full=full, removed=removed or [])
+    kwargs = dict(method='update_service_capabilities', args=args)
     return rpc.fanout_cast(context, 'scheduler', kwargs)
 
 
@@ -109,54 +122,126 @@ def _wrap_method(function, self):
     return _wrap
 
 
-def _process(func, zone):
-    """Worker stub for green thread pool. Give the worker
-    an authenticated nova client and zone info."""
+_ZONE_CLIENTS = {}  # { <zone id> : (<credentials>, [(<auth time>, client)]) }
+_ZONE_STATES = {}  # { <zone id> : zone_manager.ZoneState }
+
+
+def _zone_state(zone):
+    """Return the ZoneState counting the failures of calls to zone."""
+    state = _ZONE_STATES.get(zone.id)
+    if state is None:
+        state = _ZONE_STATES[zone.id] = zone_manager.ZoneState()
+    state.update_credentials(zone)
+    return state
+
+
+def _zone_available(zone):
+    """Zones marked offline are left alone for --zone_retry_interval."""
+    state = _zone_state(zone)
+    return state.is_active or \
+           utils.is_older_than(state.last_exception_time,
+                               FLAGS.zone_retry_interval)
+
+
+def _get_zone_client(zone):
+    """Check out an authenticated nova client for zone. Idle clients
+    authenticated less than --zone_client_ttl seconds ago are reused,
+    otherwise a new one is made. A client is only ever used by one
+    greenthread at a time since its http connection can't be shared;
+    hand it back with _put_zone_client once the call is done.
+
+    Returns (<auth time>, client)."""
+    credentials = (zone.api_url, zone.username, zone.password)
+    cached = _ZONE_CLIENTS.get(zone.id)
+    if cached and cached[0] == credentials:
+        idle = cached[1]
+        while idle:
+            auth_time, nova = idle.pop()
+            if not utils.is_older_than(auth_time, FLAGS.zone_client_ttl):
+                return auth_time, nova
+    else:
+        _ZONE_CLIENTS[zone.id] = (credentials, [])
     nova = novaclient.OpenStack(zone.username, zone.password, None,
                                 zone.api_url)
     nova.authenticate()
-    return func(nova, zone)
+    return utils.utcnow(), nova
+
+
+def _put_zone_client(zone, auth_time, nova):
+    """Return a client checked out with _get_zone_client to the idle
+    clients of zone, unless the zone credentials changed meanwhile."""
+    credentials = (zone.api_url, zone.username, zone.password)
+    cached = _ZONE_CLIENTS.get(zone.id)
+    if cached and cached[0] == credentials:
+        cached[1].append((auth_time, nova))
+
+
+def _call_zone(zone, func):
+    """Call func with an authenticated nova client for zone. Returns
+    (True, result), or (False, None) if the zone did not answer within
+    --zone_call_timeout seconds or refused our credentials.
+
+    The client is only handed back for reuse if the call completed; one
+    interrupted by the timeout may have a half read response left on
+    its connection and is thrown away."""
+    timeout = eventlet.Timeout(FLAGS.zone_call_timeout)
+    client = None
+    try:
+        client = _get_zone_client(zone)
+        result = func(client[1])
+    except eventlet.Timeout, e:
+        if e is not timeout:
+            raise
+        error = _("Timed out after %ds") % FLAGS.zone_call_timeout
+    except (novaclient.exceptions.BadRequest, IOError), e:
+        error = e
+    else:
+        _put_zone_client(zone, *client)
+        _zone_state(zone).reset_errors()
+        return True, result
+    finally:
+        timeout.cancel()
+    _zone_state(zone).log_error(error)
+    return False, None
+
+
+def _process(func, zone):
+    """Worker stub for green thread pool. Give the worker
+    an authenticated nova client and zone info. Returns None
+    if the zone does not answer."""
+    answered, result = _call_zone(zone, lambda nova: func(nova, zone))
+    return result
 
 
 def call_zone_method(context, method_name, errors_to_ignore=None,
                      novaclient_collection_name='zones', zones=None,
                      *args, **kwargs):
-    """Returns a list of (zone, call_result) objects."""
+    """Returns a list of (zone, call_result) objects. Zones which do
+    not answer are left out."""
     if not isinstance(errors_to_ignore, (list, tuple)):
         # This will also handle the default None
         errors_to_ignore = [errors_to_ignore]
 
-    pool = greenpool.GreenPool()
-    results = []
-    if zones is None:
-        zones = db.zone_get_all(context)
-    for zone in zones:
-        try:
-            nova = novaclient.OpenStack(zone.username, zone.password, None,
-                    zone.api_url)
-            nova.authenticate()
-        except novaclient.exceptions.BadRequest, e:
-            url = zone.api_url
-            LOG.warn(_("Failed request to zone; URL=%(url)s: %(e)s")
-                    % locals())
-            #TODO (dabo) - add logic for failure counts per zone,
-            # with escalation after a given number of failures.
-            continue
+    def _error_trap(nova):
         novaclient_collection = getattr(nova, novaclient_collection_name)
         collection_method = getattr(novaclient_collection, method_name)
+        try:
+            return collection_method(*args, **kwargs)
+        except Exception as e:
+            if type(e) in errors_to_ignore:
+                return None
+            raise
 
-        def _error_trap(*args, **kwargs):
-            try:
-                return collection_method(*args, **kwargs)
-            except Exception as e:
-                if type(e) in errors_to_ignore:
-                    return None
-                raise
+    def _call(zone):
+        return zone, _call_zone(zone, _error_trap)
 
-        res = pool.spawn(_error_trap, *args, **kwargs)
-        results.append((zone, res))
-    pool.waitall()
-    return [(zone.id, res.wait()) for zone, res in results]
+    if zones is None:
+        zones = db.zone_get_all(context)
+    zones = [zone for zone in zones if _zone_available(zone)]
+    pool = greenpool.GreenPool()
+    return [(zone.id, result)
+            for zone, (answered, result) in pool.imap(_call, zones)
+            if answered]
 
 
 def child_zone_helper(zone_list, func):
@@ -164,7 +249,9 @@ def child_zone_helper(zone_list, func):
     The return is [novaclient return objects] from each child zone.
     For example, if you are calling server.pause(), the list will
     be whatever the response from server.pause() is. One entry
-    per child zone called."""
+    per child zone called, None if the zone did not answer.
+    Zones marked offline are not called."""
+    zone_list = [zone for zone in zone_list if _zone_available(zone)]
     green_pool = greenpool.GreenPool()
     return [result for result in green_pool.imap(
                     _wrap_method(_process, func), zone_list)]
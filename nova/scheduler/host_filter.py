@@ -37,6 +37,7 @@ server affinity and customer separation).
 """
 
 import json
+import operator
 
 from nova import exception
 from nova import flags
@@ -51,6 +52,8 @@ FLAGS = flags.FLAGS
 flags.DEFINE_string('default_host_filter',
                     'nova.scheduler.host_filter.AllHostsFilter',
                     'Which filter to use for filtering hosts.')
+flags.DEFINE_integer('json_filter_cache_size', 100,
+                     'Number of compiled JsonFilter queries to keep.')
 
 
 class HostFilter(object):
@@ -82,8 +85,7 @@ class AllHostsFilter(HostFilter):
 
     def filter_hosts(self, zone_manager, query):
         """Return a list of hosts from ZoneManager list."""
-        return [(host, services)
-               for host, services in zone_manager.service_states.iteritems()]
+        return zone_manager.service_states.items()
 
 
 class InstanceTypeFilter(HostFilter):
@@ -93,43 +95,15 @@ class InstanceTypeFilter(HostFilter):
         """Use instance_type to filter hosts."""
         return (self._full_name(), instance_type)
 
-    def _satisfies_extra_specs(self, capabilities, instance_type):
-        """Check that the capabilities provided by the compute service
-        satisfy the extra specs associated with the instance type"""
-
-        if 'extra_specs' not in instance_type:
-            return True
-
-        # Note(lorinh): For now, we are just checking exact matching on the
-        # values. Later on, we  want to handle numerical
-        # values so we can represent things like number of GPU cards
-
-        try:
-            for key, value in instance_type['extra_specs'].iteritems():
-                if capabilities[key] != value:
-                    return False
-        except KeyError:
-            return False
-
-        return True
-
     def filter_hosts(self, zone_manager, query):
         """Return a list of hosts that can create instance_type."""
         instance_type = query
-        selected_hosts = []
-        for host, services in zone_manager.service_states.iteritems():
-            capabilities = services.get('compute', {})
-            host_ram_mb = capabilities['host_memory_free']
-            disk_bytes = capabilities['disk_available']
-            spec_ram = instance_type['memory_mb']
-            spec_disk = instance_type['local_gb']
-            extra_specs = instance_type['extra_specs']
-
-            if host_ram_mb >= spec_ram and \
-               disk_bytes >= spec_disk and \
-               self._satisfies_extra_specs(capabilities, instance_type):
-                selected_hosts.append((host, capabilities))
-        return selected_hosts
+        # Note(lorinh): For now, we are just checking exact matching on the
+        # values. Later on, we  want to handle numerical
+        # values so we can represent things like number of GPU cards
+        return zone_manager.get_compute_hosts(instance_type['memory_mb'],
+                                              instance_type['local_gb'],
+                                              instance_type.get('extra_specs'))
 
 #host entries (currently) are like:
 #    {'host_name-description': 'Default install of XenServer',
@@ -254,45 +228,118 @@ class JsonFilter(HostFilter):
                     ['>=', '$compute.disk_available', required_disk]]
         return (self._full_name(), json.dumps(query))
 
-    def _parse_string(self, string, host, services):
+    # Comparisons of a capability with one constant are compiled
+    # straight into these operators.
+    comparisons = {
+        '=': operator.eq,
+        '<': operator.lt,
+        '>': operator.gt,
+        '<=': operator.le,
+        '>=': operator.ge,
+    }
+
+    # { (<filter class>, <query text>) : <predicate> }, in least
+    # recently used order in _compiled_order.
+    _compiled = {}
+    _compiled_order = []
+
+    def _compile_string(self, string):
         """Strings prefixed with $ are capability lookups in the
-        form '$service.capability[.subcap*]'
+        form '$service.capability[.subcap*]'. Returns a function
+        doing the lookup in the services of a host, or None if
+        string is a constant.
         """
-        if not string:
+        if not string or string[0] != '$':
             return None
-        if string[0] != '$':
-            return string
-
         path = string[1:].split('.')
-        for item in path:
-            services = services.get(item, None)
-            if not services:
-                return None
-        return services
-
-    def _process_filter(self, zone_manager, query, host, services):
-        """Recursively parse the query structure."""
+
+        def lookup(services):
+            for item in path:
+                services = services.get(item, None)
+                if not services:
+                    return None
+            return services
+        return lookup
+
+    def _compile(self, query):
+        """Turn the query structure into a function of the services of
+        a host, giving the same result as interpreting the query."""
         if len(query) == 0:
-            return True
+            return lambda services: True
         cmd = query[0]
         method = self.commands[cmd]  # Let exception fly.
-        cooked_args = []
-        for arg in query[1:]:
+        args = query[1:]
+
+        # Constant args are cooked once, capability lookups and
+        # sub-queries are cooked for each host.
+        cooked = []
+        for arg in args:
             if isinstance(arg, list):
-                arg = self._process_filter(zone_manager, arg, host, services)
+                cooked.append((self._compile(arg), None))
             elif isinstance(arg, basestring):
-                arg = self._parse_string(arg, host, services)
-            if arg != None:
-                cooked_args.append(arg)
-        result = method(self, cooked_args)
-        return result
+                lookup = self._compile_string(arg)
+                if lookup:
+                    cooked.append((lookup, None))
+                elif arg:
+                    cooked.append((None, arg))
+            elif arg != None:
+                cooked.append((None, arg))
+
+        if cmd in self.comparisons and len(cooked) == 2 and \
+           cooked[0][0] and not cooked[1][0]:
+            compare = self.comparisons[cmd]
+            lookup, value = cooked[0][0], cooked[1][1]
+
+            def compare_capability(services):
+                lhs = lookup(services)
+                if lhs == None:
+                    return False
+                return compare(lhs, value)
+            return compare_capability
+
+        if cmd in ('and', 'or') and args and \
+           all(isinstance(arg, list) for arg in args):
+            # Sub-queries return a bool or, for 'not', a list, so only
+            # a False result decides 'and' and only True decides 'or'.
+            subqueries = [func for func, value in cooked]
+            if cmd == 'and':
+                return lambda services: not any(
+                        func(services) is False for func in subqueries)
+            return lambda services: any(
+                        func(services) is True for func in subqueries)
+
+        def evaluate(services):
+            cooked_args = []
+            for func, value in cooked:
+                if func:
+                    value = func(services)
+                if value != None:
+                    cooked_args.append(value)
+            return method(self, cooked_args)
+        return evaluate
+
+    def compile(self, query):
+        """Return a predicate on the services of a host for the JSON
+        query text, reusing the compiled form of recent queries."""
+        key = (self.__class__, query)
+        predicate = self._compiled.get(key)
+        if predicate:
+            self._compiled_order.remove(key)
+        else:
+            predicate = self._compile(json.loads(query))
+            self._compiled[key] = predicate
+            if self._compiled_order and \
+               len(self._compiled_order) >= FLAGS.json_filter_cache_size:
+                del self._compiled[self._compiled_order.pop(0)]
+        self._compiled_order.append(key)
+        return predicate
 
     def filter_hosts(self, zone_manager, query):
         """Return a list of hosts that can fulfill filter."""
-        expanded = json.loads(query)
+        predicate = self.compile(query)
         hosts = []
         for host, services in zone_manager.service_states.iteritems():
-            r = self._process_filter(zone_manager, expanded, host, services)
+            r = predicate(services)
             if isinstance(r, list):
                 r = True in r
             if r:
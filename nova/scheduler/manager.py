@@ -22,11 +22,13 @@ Scheduler Service
 """
 
 import functools
+import time
 
 from nova import db
 from nova import flags
 from nova import log as logging
 from nova import manager
+from nova import quota
 from nova import rpc
 from nova import utils
 from nova.scheduler import zone_manager
@@ -36,12 +38,21 @@ FLAGS = flags.FLAGS
 flags.DEFINE_string('scheduler_driver',
                     'nova.scheduler.chance.ChanceScheduler',
                     'Driver to use for the scheduler')
+flags.DEFINE_string('scheduler_snapshot_path',
+                    '$state_path/scheduler_snapshot.json',
+                    'File the scheduler saves host and zone states to, '
+                    'and restores them from at startup')
+flags.DEFINE_integer('scheduler_snapshot_interval', 60,
+                     'Seconds between scheduler state snapshots')
 
 
 class SchedulerManager(manager.Manager):
     """Chooses a host to run instances on."""
     def __init__(self, scheduler_driver=None, *args, **kwargs):
         self.zone_manager = zone_manager.ZoneManager()
+        self._last_snapshot = time.time()
+        if FLAGS.scheduler_snapshot_path:
+            self.zone_manager.load_snapshot(FLAGS.scheduler_snapshot_path)
         if not scheduler_driver:
             scheduler_driver = FLAGS.scheduler_driver
         self.driver = utils.import_object(scheduler_driver)
@@ -55,6 +66,20 @@ class SchedulerManager(manager.Manager):
     def periodic_tasks(self, context=None):
         """Poll child zones periodically to get status."""
         self.zone_manager.ping(context)
+        quota.expire(context)
+        self._save_snapshot()
+
+    def _save_snapshot(self):
+        """Snapshot the zone manager state if it is time to."""
+        now = time.time()
+        if not FLAGS.scheduler_snapshot_path or \
+           now - self._last_snapshot < FLAGS.scheduler_snapshot_interval:
+            return
+        self._last_snapshot = now
+        try:
+            self.zone_manager.save_snapshot(FLAGS.scheduler_snapshot_path)
+        except (IOError, OSError):
+            LOG.exception(_("Could not save the scheduler snapshot"))
 
     def get_host_list(self, context=None):
         """Get a list of hosts from the ZoneManager."""
@@ -69,10 +94,12 @@ class SchedulerManager(manager.Manager):
         return self.zone_manager.get_zone_capabilities(context)
 
     def update_service_capabilities(self, context=None, service_name=None,
-                                                host=None, capabilities={}):
+                                    host=None, capabilities={},
+                                    sequence=None, full=True, removed=None):
         """Process a capability update from a service node."""
         self.zone_manager.update_service_capabilities(service_name,
-                            host, capabilities)
+                            host, capabilities, sequence=sequence,
+                            full=full, removed=removed)
 
     def select(self, context=None, *args, **kwargs):
         """Select a list of hosts best matching the provided specs."""
@@ -82,6 +109,16 @@ class SchedulerManager(manager.Manager):
         """Ask the driver how requests should be made of it."""
         return self.driver.get_scheduler_rules(context, *args, **kwargs)
 
+    def run_instances(self, context, topic, instance_ids, **kwargs):
+        """Schedule each of a batch of instances created together."""
+        for instance_id in instance_ids:
+            try:
+                self._schedule('run_instance', context, topic,
+                               instance_id=instance_id, **kwargs)
+            except Exception:
+                LOG.exception(_("Failed to schedule instance %s"),
+                              instance_id)
+
     def _schedule(self, method, context, topic, *args, **kwargs):
         """Tries to call schedule_* method on the driver to retrieve host.
 
@@ -17,16 +17,20 @@
 ZoneManager oversees all communications with child Zones.
 """
 
+import bisect
 import datetime
 import novaclient
+import os
 import thread
 import traceback
 
 from eventlet import greenpool
 
+from nova import context
 from nova import db
 from nova import flags
 from nova import log as logging
+from nova import rpc
 from nova import utils
 
 FLAGS = flags.FLAGS
@@ -69,6 +73,11 @@ class ZoneState(object):
                     is_active=self.is_active, api_url=self.api_url,
                     id=self.zone_id)
 
+    def reset_errors(self):
+        """Communications with the child zone succeeded."""
+        self.attempt = 0
+        self.is_active = True
+
     def log_error(self, exception):
         """Something went wrong. Check to see if zone should be
            marked as offline."""
@@ -103,12 +112,115 @@ def _poll_zone(zone):
         zone.log_error(traceback.format_exc())
 
 
+def _sorted_remove(values, value):
+    """Remove value from the sorted list values."""
+    index = bisect.bisect_left(values, value)
+    if index < len(values) and values[index] == value:
+        del values[index]
+
+
+class CapabilityIndex(object):
+    """Secondary indexes over the capabilities in the ZoneManager, kept
+    up to date as capabilities arrive and expire. Capabilities must be
+    removed before they are changed, so the old values can be found."""
+    def __init__(self):
+        self.free_ram = []  # sorted [ (<host_memory_free>, <host>) ]
+        self.free_disk = []  # sorted [ (<disk_available>, <host>) ]
+        self.specs = {}  # { (<compute cap k>, <v>) : set([<host>]) }
+        self.rollup = {}  # { <service>_<cap> : sorted [ <v> ] }
+
+    def _spec_keys(self, capabilities):
+        for cap, value in capabilities.iteritems():
+            if cap == "timestamp":
+                continue
+            try:
+                hash(value)
+            except TypeError:
+                continue
+            yield (cap, value)
+
+    def add(self, host, service_name, capabilities):
+        if service_name == 'compute':
+            if 'host_memory_free' in capabilities:
+                bisect.insort(self.free_ram,
+                              (capabilities['host_memory_free'], host))
+            if 'disk_available' in capabilities:
+                bisect.insort(self.free_disk,
+                              (capabilities['disk_available'], host))
+            for key in self._spec_keys(capabilities):
+                self.specs.setdefault(key, set()).add(host)
+        if not capabilities.get("enabled", True):
+            return
+        for cap, value in capabilities.iteritems():
+            if cap == "timestamp":
+                continue
+            key = "%s_%s" % (service_name, cap)
+            bisect.insort(self.rollup.setdefault(key, []), value)
+
+    def remove(self, host, service_name, capabilities):
+        if service_name == 'compute':
+            if 'host_memory_free' in capabilities:
+                _sorted_remove(self.free_ram,
+                               (capabilities['host_memory_free'], host))
+            if 'disk_available' in capabilities:
+                _sorted_remove(self.free_disk,
+                               (capabilities['disk_available'], host))
+            for key in self._spec_keys(capabilities):
+                hosts = self.specs.get(key, set())
+                hosts.discard(host)
+                if not hosts:
+                    self.specs.pop(key, None)
+        if not capabilities.get("enabled", True):
+            return
+        for cap, value in capabilities.iteritems():
+            if cap == "timestamp":
+                continue
+            key = "%s_%s" % (service_name, cap)
+            values = self.rollup.get(key, [])
+            _sorted_remove(values, value)
+            if not values:
+                self.rollup.pop(key, None)
+
+    def compute_hosts(self, min_ram, min_disk, capabilities=None):
+        """Return the compute hosts which may have at least min_ram free
+        memory and min_disk free disk, and exactly the given capabilities.
+        Free memory and disk may be out of date, callers must check them.
+        """
+        if capabilities:
+            hosts = None
+            for key in capabilities.iteritems():
+                try:
+                    matches = self.specs.get(key, set())
+                except TypeError:
+                    return set()
+                if hosts is None:
+                    hosts = matches.copy()
+                else:
+                    hosts &= matches
+            return hosts
+        ram_index = bisect.bisect_left(self.free_ram, (min_ram,))
+        disk_index = bisect.bisect_left(self.free_disk, (min_disk,))
+        if len(self.free_ram) - ram_index <= \
+           len(self.free_disk) - disk_index:
+            return set(host for ram, host in self.free_ram[ram_index:])
+        return set(host for disk, host in self.free_disk[disk_index:])
+
+    def capabilities(self):
+        """Return { <service>_<cap> : (min, max) } over the enabled
+        services."""
+        return dict((key, (values[0], values[-1]))
+                    for key, values in self.rollup.iteritems())
+
+
 class ZoneManager(object):
     """Keeps the zone states updated."""
     def __init__(self):
         self.last_zone_db_check = datetime.datetime.min
         self.zone_states = {}  # { <zone_id> : ZoneState }
         self.service_states = {}  # { <host> : { <service> : { cap k : v }}}
+        self.service_sequences = {}  # { (<host>, <service>) : <sequence> }
+        self.full_update_requests = {}  # { (<host>, <service>) : <time> }
+        self.capability_index = CapabilityIndex()
         self.green_pool = greenpool.GreenPool()
 
     def get_zone_list(self):
@@ -118,50 +230,115 @@ class ZoneManager(object):
     def get_host_list(self):
         """Returns a list of dicts for each host that the Zone Manager
         knows about. Each dict contains the host_name and the service
-        for that host.
+        for that host, when the service last reported and whether that
+        report has gone stale.
         """
-        all_hosts = self.service_states.keys()
         ret = []
         for host in self.service_states:
-            for svc in self.service_states[host]:
-                ret.append({"service": svc, "host_name": host})
+            for svc, caps in self.service_states[host].iteritems():
+                ret.append({"service": svc, "host_name": host,
+                            "updated_at": caps["timestamp"],
+                            "stale": self.host_service_caps_stale(host, svc)})
         return ret
 
     def get_zone_capabilities(self, context):
         """Roll up all the individual host info to generic 'service'
            capabilities. Each capability is aggregated into
            <cap>_min and <cap>_max values."""
-        hosts_dict = self.service_states
-
-        # TODO(sandy) - be smarter about fabricating this structure.
-        # But it's likely to change once we understand what the Best-Match
-        # code will need better.
-        combined = {}  # { <service>_<cap> : (min, max), ... }
-        stale_host_services = {}  # { host1 : [svc1, svc2], host2 :[svc1]}
-        for host, host_dict in hosts_dict.iteritems():
-            for service_name, service_dict in host_dict.iteritems():
-                if not service_dict.get("enabled", True):
-                    # Service is disabled; do no include it
-                    continue
-
-                #Check if the service capabilities became stale
-                if self.host_service_caps_stale(host, service_name):
-                    if host not in stale_host_services:
-                        stale_host_services[host] = []  # Adding host key once
-                    stale_host_services[host].append(service_name)
-                    continue
-                for cap, value in service_dict.iteritems():
-                    if cap == "timestamp":  # Timestamp is not needed
-                        continue
-                    key = "%s_%s" % (service_name, cap)
-                    min_value, max_value = combined.get(key, (value, value))
-                    min_value = min(min_value, value)
-                    max_value = max(max_value, value)
-                    combined[key] = (min_value, max_value)
-
-        # Delete the expired host services
-        self.delete_expired_host_services(stale_host_services)
-        return combined
+        # The rollup is maintained as capabilities arrive, only the
+        # services that stopped reporting need dropping from it.
+        self.expire_stale_host_services()
+        return self.capability_index.capabilities()
+
+    def get_compute_hosts(self, min_ram, min_disk, capabilities=None):
+        """Return [(host, compute capabilities)] for the compute hosts with
+        at least min_ram free memory and min_disk free disk, which report
+        exactly the given capabilities."""
+        hosts = []
+        for host in self.capability_index.compute_hosts(min_ram, min_disk,
+                                                        capabilities):
+            caps = self.service_states[host]['compute']
+            if caps.get('host_memory_free') >= min_ram and \
+               caps.get('disk_available') >= min_disk:
+                hosts.append((host, caps))
+        return hosts
+
+    def save_snapshot(self, path):
+        """Write the host capabilities and zone states to path as JSON,
+        so a restarted scheduler can pick them up with load_snapshot."""
+        hosts = []
+        for host, host_dict in self.service_states.iteritems():
+            for service, caps in host_dict.iteritems():
+                caps = caps.copy()
+                updated_at = utils.isotime(caps.pop("timestamp"))
+                sequence = self.service_sequences.get((host, service))
+                hosts.append([host, service, sequence, updated_at, caps])
+        zones = []
+        for zone in self.zone_states.values():
+            last_seen = None
+            if zone.last_seen != datetime.datetime.min:
+                last_seen = utils.isotime(zone.last_seen)
+            # NOTE: credentials are left out, they are reloaded from the db.
+            zones.append(dict(id=zone.zone_id, api_url=zone.api_url,
+                              name=zone.name, is_active=zone.is_active,
+                              capabilities=zone.capabilities,
+                              last_seen=last_seen))
+        snapshot = dict(saved_at=utils.isotime(), hosts=hosts, zones=zones)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            f.write(utils.dumps(snapshot))
+        os.rename(tmp_path, path)
+
+    def load_snapshot(self, path):
+        """Restore the state written by save_snapshot. Each host service
+        keeps the time it last reported, so entries that are already stale
+        are dropped and the rest expire as usual."""
+        try:
+            with open(path) as f:
+                snapshot = utils.loads(f.read())
+        except IOError:
+            return
+        except ValueError:
+            logging.warning(_("Ignoring unreadable scheduler snapshot %s"),
+                            path)
+            return
+        # Read everything before using any of it, so a snapshot that
+        # doesn't have the expected layout is dropped as a whole.
+        try:
+            services = []
+            for host, service, sequence, updated_at, caps in \
+                    snapshot["hosts"]:
+                caps["timestamp"] = utils.parse_isotime(updated_at)
+                services.append((host, service, sequence, caps))
+            zones = []
+            for zone_dict in snapshot["zones"]:
+                zone = ZoneState()
+                zone.zone_id = zone_dict["id"]
+                zone.api_url = zone_dict["api_url"]
+                zone.username = zone.password = None
+                zone.name = zone_dict["name"]
+                zone.capabilities = zone_dict["capabilities"]
+                zone.is_active = zone_dict["is_active"]
+                if zone_dict["last_seen"]:
+                    zone.last_seen = utils.parse_isotime(
+                            zone_dict["last_seen"])
+                zones.append(zone)
+            saved_at = utils.parse_isotime(snapshot["saved_at"])
+        except (KeyError, TypeError, ValueError), e:
+            logging.warning(_("Ignoring malformed scheduler snapshot "
+                              "%(path)s: %(e)s") % locals())
+            return
+        for host, service, sequence, caps in services:
+            self.service_states.setdefault(host, {})[service] = caps
+            self.service_sequences[(host, service)] = sequence
+            self.capability_index.add(host, service, caps)
+        for zone in zones:
+            self.zone_states[zone.zone_id] = zone
+        self.expire_stale_host_services()
+        age = utils.utcnow() - saved_at
+        logging.info(_("Restored %(hosts)d host services and %(zones)d zones "
+                       "from a scheduler snapshot taken %(age)s ago") %
+                     dict(hosts=len(services), zones=len(zones), age=age))
 
     def _refresh_from_db(self, context):
         """Make our zone state map match the db."""
@@ -193,15 +370,66 @@ class ZoneManager(object):
             self.last_zone_db_check = utils.utcnow()
             self._refresh_from_db(context)
         self._poll_zones(context)
+        self.expire_stale_host_services()
+
+    def update_service_capabilities(self, service_name, host, capabilities,
+                                    sequence=None, full=True, removed=None):
+        """Update the per-service capabilities based on this notification.
 
-    def update_service_capabilities(self, service_name, host, capabilities):
-        """Update the per-service capabilities based on this notification."""
+        A full update replaces the capabilities of the service. Otherwise
+        capabilities holds only the changed values and removed the names
+        of capabilities the service no longer reports, and both are applied
+        to the known capabilities in place.
+        """
         logging.debug(_("Received %(service_name)s service update from "
                             "%(host)s: %(capabilities)s") % locals())
+        key = (host, service_name)
         service_caps = self.service_states.get(host, {})
+        caps = service_caps.get(service_name)
+        if not full:
+            if caps is None:
+                logging.debug(_("Ignoring %(service_name)s update from "
+                                "%(host)s until it sends all its "
+                                "capabilities") % locals())
+                self._request_full_update(host, service_name)
+                return
+            last_sequence = self.service_sequences.get(key)
+            if last_sequence is not None and sequence != last_sequence + 1:
+                logging.warning(_("Missed %(service_name)s updates from "
+                                  "%(host)s before #%(sequence)s, ignoring "
+                                  "it until it sends all its capabilities")
+                                % locals())
+                self.delete_expired_host_services({host: [service_name]})
+                self._request_full_update(host, service_name)
+                return
+        if caps is not None:
+            self.capability_index.remove(host, service_name, caps)
+        if not full:
+            for cap in removed or []:
+                caps.pop(cap, None)
+            caps.update(capabilities)
+            capabilities = caps
+        else:
+            self.full_update_requests.pop(key, None)
         capabilities["timestamp"] = utils.utcnow()  # Reported time
         service_caps[service_name] = capabilities
         self.service_states[host] = service_caps
+        self.service_sequences[key] = sequence
+        self.capability_index.add(host, service_name, capabilities)
+
+    def _request_full_update(self, host, service_name):
+        """Ask a service whose changes we can't apply to send all its
+        capabilities, at most once per --periodic_interval."""
+        key = (host, service_name)
+        requested = self.full_update_requests.get(key)
+        if requested and \
+           not utils.is_older_than(requested, FLAGS.periodic_interval):
+            return
+        self.full_update_requests[key] = utils.utcnow()
+        admin_context = context.get_admin_context()
+        rpc.cast(admin_context,
+                 db.queue_get_for(admin_context, service_name, host),
+                 {'method': 'resend_service_capabilities', 'args': {}})
 
     def host_service_caps_stale(self, host, service):
         """Check if host service capabilites are not recent enough."""
@@ -212,11 +440,25 @@ class ZoneManager(object):
             return False
         return True
 
+    def expire_stale_host_services(self):
+        """Forget the host services that have stopped reporting."""
+        stale_host_services = {}
+        for host, host_dict in self.service_states.iteritems():
+            services = [service for service in host_dict
+                        if self.host_service_caps_stale(host, service)]
+            if services:
+                stale_host_services[host] = services
+        self.delete_expired_host_services(stale_host_services)
+
     def delete_expired_host_services(self, host_services_dict):
         """Delete all the inactive host services information."""
         for host, services in host_services_dict.iteritems():
             service_caps = self.service_states[host]
             for service in services:
+                self.capability_index.remove(host, service,
+                                             service_caps[service])
                 del service_caps[service]
+                self.service_sequences.pop((host, service), None)
+                self.full_update_requests.pop((host, service), None)
                 if len(service_caps) == 0:  # Delete host if no services
                     del self.service_states[host]
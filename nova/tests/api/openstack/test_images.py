@@ -1571,6 +1571,8 @@ class ImageXMLSerializationTest(test.TestCase):
         }
 
         output = serializer.serialize(fixture, 'index')
+        self.assertEqual(''.join(serializer.serialize_iter(fixture, 'index')),
+                         output)
         actual = minidom.parseString(output.replace("  ", ""))
 
         expected_server_href = self.SERVER_HREF
@@ -1603,6 +1605,8 @@ class ImageXMLSerializationTest(test.TestCase):
         }
 
         output = serializer.serialize(fixtures, 'index')
+        self.assertEqual(''.join(serializer.serialize_iter(fixtures, 'index')),
+                         output)
         actual = minidom.parseString(output.replace("  ", ""))
 
         expected = minidom.parseString("""
@@ -1673,6 +1677,8 @@ class ImageXMLSerializationTest(test.TestCase):
         }
 
         output = serializer.serialize(fixture, 'detail')
+        self.assertEqual(''.join(serializer.serialize_iter(fixture, 'detail')),
+                         output)
         actual = minidom.parseString(output.replace("  ", ""))
 
         expected_server_href = self.SERVER_HREF
@@ -1128,6 +1128,14 @@ class ServersTest(test.TestCase):
         def server_update(context, id, params):
             return instance_create(context, id)
 
+        def instance_create_bulk(context, values_list, security_group_ids):
+            return [instance_create(context, values)
+                    for values in values_list]
+
+        def instance_update_bulk(context, updates):
+            return [server_update(context, instance_id, values)
+                    for instance_id, values in updates]
+
         def fake_method(*args, **kwargs):
             pass
 
@@ -1146,10 +1154,14 @@ class ServersTest(test.TestCase):
         self.stubs.Set(nova.db.api, 'project_get_networks',
                        project_get_networks)
         self.stubs.Set(nova.db.api, 'instance_create', instance_create)
+        self.stubs.Set(nova.db.api, 'instance_create_bulk',
+                       instance_create_bulk)
         self.stubs.Set(nova.rpc, 'cast', fake_method)
         self.stubs.Set(nova.rpc, 'call', fake_method)
         self.stubs.Set(nova.db.api, 'instance_update',
             server_update)
+        self.stubs.Set(nova.db.api, 'instance_update_bulk',
+            instance_update_bulk)
         self.stubs.Set(nova.db.api, 'queue_get_for', queue_get_for)
         self.stubs.Set(nova.network.manager.VlanManager, 'allocate_fixed_ip',
             fake_method)
@@ -2222,6 +2234,28 @@ class ServersTest(test.TestCase):
         body = json.loads(res.body)
         self.assertEqual(body['server']['status'], 'RESIZE-CONFIRM')
 
+    def test_resized_servers_detail_looks_up_migrations_once(self):
+        req = self.webreq('/detail', 'GET')
+        self.lookups = []
+
+        def fake_migration_get_all(context, instance_uuids, status):
+            self.lookups.append(instance_uuids)
+            return [{'instance_uuid': FAKE_UUID}]
+
+        def fake_migration_get(*args):
+            self.fail('migrations looked up per server')
+
+        self.stubs.Set(nova.db, 'migration_get_all_by_instances_and_status',
+                fake_migration_get_all)
+        self.stubs.Set(nova.db, 'migration_get_by_instance_and_status',
+                fake_migration_get)
+        res = req.get_response(fakes.wsgi_app())
+        body = json.loads(res.body)
+        self.assertEqual(len(self.lookups), 1)
+        self.assertEqual(len(self.lookups[0]), len(body['servers']))
+        for server in body['servers']:
+            self.assertEqual(server['status'], 'RESIZE-CONFIRM')
+
     def test_confirm_resize_server(self):
         req = self.webreq('/1/action', 'POST', dict(confirmResize=None))
 
@@ -3683,6 +3717,8 @@ class ServerXMLSerializationTest(test.TestCase):
         ]}
 
         output = serializer.serialize(fixture, 'index')
+        self.assertEqual(''.join(serializer.serialize_iter(fixture, 'index')),
+                         output)
         actual = minidom.parseString(output.replace("  ", ""))
 
         expected = minidom.parseString("""
@@ -3823,6 +3859,8 @@ class ServerXMLSerializationTest(test.TestCase):
         ]}
 
         output = serializer.serialize(fixture, 'detail')
+        self.assertEqual(''.join(serializer.serialize_iter(fixture, 'detail')),
+                         output)
         actual = minidom.parseString(output.replace("  ", ""))
 
         expected = minidom.parseString("""
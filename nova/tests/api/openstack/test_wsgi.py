@@ -2,6 +2,7 @@
 
 import json
 import webob
+from xml.dom import minidom
 
 from nova import exception
 from nova import test
@@ -128,6 +129,37 @@ class XMLDictSerializerTest(test.TestCase):
         result = result.replace('\n', '').replace(' ', '')
         self.assertEqual(result, expected_xml)
 
+    def _dom_xml(self, serializer, data):
+        doc = minidom.Document()
+        node = serializer._to_xml_node(doc, serializer.metadata, 'servers',
+                                       data['servers'])
+        return serializer.to_xml_string(node)
+
+    def test_xml_same_as_dom(self):
+        metadata = {'attributes': {'server': ['id', 'name']},
+                    'plurals': {'addresses': 'ip'},
+                    'list_collections': {
+                        'groups': {'item_name': 'group', 'item_key': 'id'}},
+                    'dict_collections': {
+                        'metadata': {'item_name': 'meta', 'item_key': 'key'}}}
+        input_dict = {'servers': [
+            {'id': 1, 'name': 'a & "b"', 'addresses': ['10.0.0.1'],
+             'groups': [1, 2], 'metadata': {'k': '<v>'}, 'flavor': {},
+             'status': ''},
+            {'id': 2, 'name': u'c', 'addresses': [], 'groups': []}]}
+        serializer = wsgi.XMLDictSerializer(metadata=metadata, xmlns="asdf")
+        self.assertEqual(serializer.serialize(input_dict),
+                         self._dom_xml(serializer, input_dict))
+
+    def test_serialize_iter(self):
+        self.stubs.Set(wsgi, 'XML_CHUNK_SIZE', 16)
+        input_dict = {'servers': [{'id': i} for i in range(10)]}
+        serializer = wsgi.XMLDictSerializer(xmlns="asdf")
+        chunks = list(serializer.serialize_iter(input_dict))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks),
+                         self._dom_xml(serializer, input_dict))
+
 
 class JSONDictSerializerTest(test.TestCase):
     def test_json(self):
@@ -256,6 +288,20 @@ class ResponseSerializerTest(test.TestCase):
         self.assertEqual(response.body, 'pew_json')
         self.assertEqual(response.status_int, 404)
 
+    def test_serialize_xml_response(self):
+        self.serializer.body_serializers['application/xml'] = \
+                wsgi.XMLDictSerializer()
+        response = self.serializer.serialize({'a': {'b': 1}},
+                                             'application/xml')
+        self.assertEqual(response.body, '<a>\n    <b>1</b>\n</a>\n')
+        self.assertEqual(response.content_length, len(response.body))
+
+    def test_serialize_xml_response_error(self):
+        self.serializer.body_serializers['application/xml'] = \
+                wsgi.XMLDictSerializer()
+        self.assertRaises(UnicodeEncodeError, self.serializer.serialize,
+                          {'a': {'b': u'\xe9'}}, 'application/xml')
+
     def test_serialize_response_None(self):
         response = self.serializer.serialize(None, 'application/json')
         print response
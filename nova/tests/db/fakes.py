@@ -185,6 +185,10 @@ def stub_out_db_network_api(stubs):
             ip[key] = values[key]
         return ip['address']
 
+    def fake_fixed_ip_create_bulk(context, values_iter):
+        for values in values_iter:
+            fake_fixed_ip_create(context, values)
+
     def fake_fixed_ip_disassociate(context, address):
         ips = filter(lambda i: i['address'] == address,
                      fixed_ips)
@@ -241,6 +245,14 @@ def stub_out_db_network_api(stubs):
             vif[key] = values[key]
         return FakeModel(vif)
 
+    def fake_virtual_interface_create_bulk(context, values_list):
+        for values in values_list:
+            fake_virtual_interface_create(context, values)
+
+    def fake_virtual_interface_get_used_addresses(context, addresses):
+        return set(m['address'] for m in virtual_interfacees
+                   if m['address'] in addresses)
+
     def fake_virtual_interface_delete_by_instance(context, instance_id):
         addresses = [m for m in virtual_interfacees \
                      if m['instance_id'] == instance_id]
@@ -254,6 +266,22 @@ def stub_out_db_network_api(stubs):
         return [FakeModel(m) for m in virtual_interfacees \
                 if m['instance_id'] == instance_id]
 
+    def fake_virtual_interface_get_by_instance_with_fixed_ips(context,
+                                                             instance_id):
+        result = []
+        for vif in fake_virtual_interface_get_by_instance(context,
+                                                          instance_id):
+            ips = [FakeModel(i) for i in fixed_ips
+                   if i['instance_id'] == instance_id and
+                      i['network_id'] == vif['network_id']]
+            result.append((vif, ips))
+        return result
+
+    def fake_virtual_interface_get_version_by_instance(context, instance_id):
+        return tuple((vif['id'], ip['id']) for vif, ips in
+                     fake_virtual_interface_get_by_instance_with_fixed_ips(
+                         context, instance_id) for ip in ips or [{'id': None}])
+
     def fake_virtual_interface_get_by_instance_and_network(context,
                                                            instance_id,
                                                            network_id):
@@ -317,6 +345,7 @@ def stub_out_db_network_api(stubs):
              fake_fixed_ip_associate,
              fake_fixed_ip_associate_pool,
              fake_fixed_ip_create,
+             fake_fixed_ip_create_bulk,
              fake_fixed_ip_disassociate,
              fake_fixed_ip_disassociate_all_by_timeout,
              fake_fixed_ip_get_by_instance,
@@ -325,8 +354,12 @@ def stub_out_db_network_api(stubs):
              fake_fixed_ip_update,
              fake_instance_type_get,
              fake_virtual_interface_create,
+             fake_virtual_interface_create_bulk,
              fake_virtual_interface_delete_by_instance,
              fake_virtual_interface_get_by_instance,
+             fake_virtual_interface_get_by_instance_with_fixed_ips,
+             fake_virtual_interface_get_version_by_instance,
+             fake_virtual_interface_get_used_addresses,
              fake_virtual_interface_get_by_instance_and_network,
              fake_network_create_safe,
              fake_network_get,
@@ -43,3 +43,9 @@ FLAGS['verbose'].SetDefault(True)
 FLAGS['sqlite_db'].SetDefault("tests.sqlite")
 FLAGS['use_ipv6'].SetDefault(True)
 FLAGS['flat_network_bridge'].SetDefault('br100')
+flags.DECLARE('quota_cache_ttl', 'nova.quota')
+FLAGS['quota_cache_ttl'].SetDefault(0)
+flags.DECLARE('glance_image_cache_ttl', 'nova.image.glance')
+FLAGS['glance_image_cache_ttl'].SetDefault(0)
+flags.DECLARE('scheduler_snapshot_path', 'nova.scheduler.manager')
+FLAGS['scheduler_snapshot_path'].SetDefault('')
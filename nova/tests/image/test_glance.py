@@ -16,10 +16,15 @@
 #    under the License.
 
 
+import copy
 import datetime
+import httplib
 import unittest
 
+from glance.common import exception as glance_exception
+
 from nova import context
+from nova import exception
 from nova import test
 from nova.image import glance
 
@@ -47,6 +52,40 @@ class StubGlanceClient(object):
         return self.update_response
 
 
+class CountingGlanceClient(StubGlanceClient):
+    """Records the calls made to it and raises NotFound like glance."""
+
+    def __init__(self, images):
+        super(CountingGlanceClient, self).__init__(images)
+        self.calls = []
+
+    def get_image_meta(self, image_id):
+        self.calls.append(('get_image_meta', image_id))
+        try:
+            return copy.deepcopy(self.images[image_id])
+        except KeyError:
+            raise glance_exception.NotFound()
+
+    def get_images_detailed(self, filters=None, marker=None, limit=None):
+        self.calls.append(('get_images_detailed', filters))
+        return [copy.deepcopy(image_meta)
+                for image_meta in self.images.itervalues()
+                if filters.get('name') in (None, image_meta['name'])]
+
+    def get_image(self, image_id):
+        self.calls.append(('get_image', image_id))
+        return copy.deepcopy(self.images[image_id]), iter(['ab', 'cd'])
+
+    def update_image(self, image_id, metadata, data):
+        self.calls.append(('update_image', image_id))
+        self.images[image_id].update(metadata)
+        return copy.deepcopy(self.images[image_id])
+
+    def delete_image(self, image_id):
+        self.calls.append(('delete_image', image_id))
+        del self.images[image_id]
+
+
 class NullWriter(object):
     """Used to test ImageService.get which takes a writer object"""
 
@@ -232,3 +271,134 @@ class TestMutatorDateTimeTests(BaseGlanceTest):
                    'updated_at': None,
                    'deleted_at': None}
         return fixture
+
+
+class TestPooledGlanceImageService(test.TestCase):
+    """Tests the client pool and metadata cache of the default service"""
+
+    def setUp(self):
+        super(TestPooledGlanceImageService, self).setUp()
+        self.flags(glance_api_servers=['glancehost:9292'])
+        self.stubs.Set(glance, '_CLIENT_POOLS', {})
+        self.stubs.Set(glance, '_IMAGE_META_CACHE', glance._ImageCache())
+        self.stubs.Set(glance, '_IMAGE_LIST_CACHE', glance._ImageCache())
+        self.client = CountingGlanceClient(
+                {'image1': {'id': 'image1', 'name': 'image1',
+                            'is_public': True},
+                 'image2': {'id': 'image2', 'name': 'image2',
+                            'is_public': True}})
+        self.clients_created = 0
+
+        def fake_client(host, port):
+            self.clients_created += 1
+            return self.client
+
+        self.stubs.Set(glance, '_KeepAliveGlanceClient', fake_client)
+        self.service = glance.GlanceImageService()
+        self.context = context.RequestContext(None, None)
+
+    def _calls(self, method):
+        return [args for name, args in self.client.calls if name == method]
+
+    def test_clients_are_reused(self):
+        self.service.show(self.context, 'image1')
+        self.service.show(self.context, 'image2')
+        self.service.detail(self.context)
+        self.assertEqual(self.clients_created, 1)
+        self.assertEqual(len(self.client.calls), 3)
+
+    def test_image_body_keeps_client_until_read(self):
+        client = glance.PooledGlanceClient('glancehost', 9292)
+        image_meta, image_chunks = client.get_image('image1')
+        pool = glance._get_client_pool('glancehost', 9292)
+        self.assertEqual(pool.free(), pool.max_size - 1)
+        self.assertEqual(list(image_chunks), ['ab', 'cd'])
+        self.assertEqual(pool.free(), pool.max_size)
+
+    def test_show_is_cached(self):
+        self.flags(glance_image_cache_ttl=60)
+        first = self.service.show(self.context, 'image1')
+        second = self.service.show(self.context, 'image1')
+        self.assertEqual(first, second)
+        self.assertEqual(self._calls('get_image_meta'), ['image1'])
+
+    def test_show_caches_not_found(self):
+        self.flags(glance_image_cache_ttl=60)
+        for i in range(2):
+            self.assertRaises(exception.ImageNotFound,
+                              self.service.show, self.context, 'missing')
+        self.assertEqual(self._calls('get_image_meta'), ['missing'])
+
+    def test_cache_disabled(self):
+        self.service.show(self.context, 'image1')
+        self.service.show(self.context, 'image1')
+        self.assertEqual(self._calls('get_image_meta'), ['image1', 'image1'])
+
+    def test_detail_is_cached(self):
+        self.flags(glance_image_cache_ttl=60)
+        self.service.detail(self.context)
+        self.service.index(self.context)
+        self.assertEqual(len(self._calls('get_images_detailed')), 1)
+
+    def test_update_invalidates_cache(self):
+        self.flags(glance_image_cache_ttl=60)
+        self.service.detail(self.context)
+        self.service.update(self.context, 'image1', {'name': 'renamed'})
+        image_meta = self.service.show(self.context, 'image1')
+        self.assertEqual(image_meta['name'], 'renamed')
+        names = [image_meta['name']
+                 for image_meta in self.service.detail(self.context)]
+        self.assertTrue('renamed' in names)
+
+    def test_delete_invalidates_cache(self):
+        self.flags(glance_image_cache_ttl=60)
+        self.service.show(self.context, 'image1')
+        self.service.delete(self.context, 'image1')
+        self.assertRaises(exception.ImageNotFound,
+                          self.service.show, self.context, 'image1')
+
+    def test_show_by_name_filters_by_name(self):
+        image_meta = self.service.show_by_name(self.context, 'image2')
+        self.assertEqual(image_meta['id'], 'image2')
+        filters = self._calls('get_images_detailed')[0]
+        self.assertEqual(filters['name'], 'image2')
+
+
+class FakeSocket(object):
+
+    def close(self):
+        pass
+
+
+class TestKeepAliveGlanceClient(test.TestCase):
+    """Tests requests broken off on a reused connection"""
+
+    def setUp(self):
+        super(TestKeepAliveGlanceClient, self).setUp()
+        self.requests = []
+
+        def fake_do_request(client, method, action, *args):
+            self.requests.append(method)
+            if len(self.requests) == 1:
+                raise httplib.BadStatusLine('')
+            return 'response'
+
+        self.stubs.Set(glance.GlanceClient, 'do_request', fake_do_request)
+        self.client = glance._KeepAliveGlanceClient('glancehost', 9292)
+        self.client._connection.sock = FakeSocket()
+
+    def test_idempotent_request_retried(self):
+        self.assertEqual(self.client.do_request('GET', '/images/1'),
+                         'response')
+        self.assertEqual(self.requests, ['GET', 'GET'])
+
+    def test_post_not_retried(self):
+        self.assertRaises(httplib.BadStatusLine, self.client.do_request,
+                          'POST', '/images', 'body')
+        self.assertEqual(self.requests, ['POST'])
+
+    def test_new_connection_not_retried(self):
+        self.client._connection.sock = None
+        self.assertRaises(httplib.BadStatusLine, self.client.do_request,
+                          'GET', '/images/1')
+        self.assertEqual(self.requests, ['GET'])
@@ -22,14 +22,11 @@ from nova import exception
 from nova import flags
 from nova import test
 from nova.scheduler import host_filter
+from nova.scheduler import zone_manager
 
 FLAGS = flags.FLAGS
 
 
-class FakeZoneManager:
-    pass
-
-
 class HostFilterTestCase(test.TestCase):
     """Test case for host filters."""
 
@@ -80,24 +77,27 @@ class HostFilterTestCase(test.TestCase):
                 extra_specs={'xpu_arch': 'fermi',
                              'xpu_info': 'Tesla 2050'})
 
-        self.zone_manager = FakeZoneManager()
         states = {}
         for x in xrange(10):
-            states['host%02d' % (x + 1)] = {'compute': self._host_caps(x)}
-        self.zone_manager.service_states = states
+            states['host%02d' % (x + 1)] = self._host_caps(x)
 
         # Add some extra capabilities to some hosts
-        host07 = self.zone_manager.service_states['host07']['compute']
+        host07 = states['host07']
         host07['xpu_arch'] = 'fermi'
         host07['xpu_info'] = 'Tesla 2050'
 
-        host08 = self.zone_manager.service_states['host08']['compute']
+        host08 = states['host08']
         host08['xpu_arch'] = 'radeon'
 
-        host09 = self.zone_manager.service_states['host09']['compute']
+        host09 = states['host09']
         host09['xpu_arch'] = 'fermi'
         host09['xpu_info'] = 'Tesla 2150'
 
+        self.zone_manager = zone_manager.ZoneManager()
+        for host, capabilities in states.iteritems():
+            self.zone_manager.update_service_capabilities('compute', host,
+                                                          capabilities)
+
     def tearDown(self):
         FLAGS.default_host_filter = self.old_flag
 
@@ -238,3 +238,34 @@ class HostFilterTestCase(test.TestCase):
 
         self.assertFalse(hf.filter_hosts(self.zone_manager,
                 json.dumps(['=', {}, ['>', '$missing....foo']])))
+
+    def test_json_filter_compiled_queries_are_reused(self):
+        old_cache_size = FLAGS.json_filter_cache_size
+        FLAGS.json_filter_cache_size = 2
+        host_filter.JsonFilter._compiled.clear()
+        del host_filter.JsonFilter._compiled_order[:]
+        hf = host_filter.JsonFilter()
+        query1 = json.dumps(['>', '$compute.host_memory_free', 30])
+        query2 = json.dumps(['<', '$compute.host_memory_free', 30])
+        query3 = json.dumps(['=', '$compute.host_memory_free', 30])
+
+        predicate = hf.compile(query1)
+        self.assertTrue(host_filter.JsonFilter().compile(query1) is predicate)
+        hf.compile(query2)
+        hf.compile(query1)
+        hf.compile(query3)
+        # query2 was the least recently used.
+        self.assertEquals(sorted(host_filter.JsonFilter._compiled.keys()),
+                          sorted([(host_filter.JsonFilter, query1),
+                                  (host_filter.JsonFilter, query3)]))
+        self.assertEquals(7, len(hf.filter_hosts(self.zone_manager, query1)))
+        FLAGS.json_filter_cache_size = old_cache_size
+
+    def test_json_filter_compiled_capability_comparison(self):
+        hf = host_filter.JsonFilter()
+        predicate = hf.compile(json.dumps(
+                ['>=', '$compute.host_memory_free', 50]))
+        self.assertTrue(predicate(dict(compute=dict(host_memory_free=50))))
+        self.assertFalse(predicate(dict(compute=dict(host_memory_free=49))))
+        self.assertFalse(predicate(dict(compute=dict())))
+        self.assertFalse(predicate(dict()))
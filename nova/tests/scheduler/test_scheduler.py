@@ -20,6 +20,7 @@ Tests For Scheduler
 """
 
 import datetime
+import eventlet
 import mox
 import novaclient.exceptions
 import stubout
@@ -237,6 +238,19 @@ class ZoneSchedulerTestCase(test.TestCase):
                                instance_id='i-ffffffff',
                                availability_zone='zone1')
 
+    def test_run_instances(self):
+        scheduler = manager.SchedulerManager()
+        ctxt = context.get_admin_context()
+        self.mox.StubOutWithMock(scheduler, '_schedule')
+        scheduler._schedule('run_instance', ctxt, 'compute', instance_id=1,
+                            availability_zone='zone1').AndRaise(
+                                    driver.NoValidHost('no host'))
+        scheduler._schedule('run_instance', ctxt, 'compute', instance_id=2,
+                            availability_zone='zone1')
+        self.mox.ReplayAll()
+        scheduler.run_instances(ctxt, 'compute', instance_ids=[1, 2],
+                                availability_zone='zone1')
+
 
 class SimpleDriverTestCase(test.TestCase):
     """Test case for simple driver"""
@@ -1101,13 +1115,18 @@ class FakeZonesProxy(object):
     def raises_exception(*args, **kwargs):
         raise Exception('testing')
 
+    def hang(*args, **kwargs):
+        eventlet.sleep(1)
+
 
 class FakeNovaClientOpenStack(object):
+    authentications = 0
+
     def __init__(self, *args, **kwargs):
         self.zones = FakeZonesProxy()
 
     def authenticate(self):
-        pass
+        FakeNovaClientOpenStack.authentications += 1
 
 
 class CallZoneMethodTest(test.TestCase):
@@ -1116,6 +1135,9 @@ class CallZoneMethodTest(test.TestCase):
         self.stubs = stubout.StubOutForTesting()
         self.stubs.Set(db, 'zone_get_all', zone_get_all)
         self.stubs.Set(novaclient, 'OpenStack', FakeNovaClientOpenStack)
+        self.stubs.Set(api, '_ZONE_CLIENTS', {})
+        self.stubs.Set(api, '_ZONE_STATES', {})
+        FakeNovaClientOpenStack.authentications = 0
 
     def tearDown(self):
         self.stubs.UnsetAll()
@@ -1138,3 +1160,57 @@ class CallZoneMethodTest(test.TestCase):
         context = {}
         method = 'raises_exception'
         self.assertRaises(Exception, api.call_zone_method, context, method)
+
+    def test_call_zone_method_reuses_clients(self):
+        api.call_zone_method({}, 'do_something')
+        api.call_zone_method({}, 'do_something')
+        self.assertEqual(FakeNovaClientOpenStack.authentications, 1)
+
+        FLAGS.zone_client_ttl = -1
+        try:
+            api.call_zone_method({}, 'do_something')
+        finally:
+            FLAGS.zone_client_ttl = 3600
+        self.assertEqual(FakeNovaClientOpenStack.authentications, 2)
+
+    def test_call_zone_method_concurrent_calls_use_own_clients(self):
+        clients = []
+
+        def slow(zones_proxy, *args, **kwargs):
+            clients.append(zones_proxy)
+            eventlet.sleep(0.01)
+            return 42
+
+        self.stubs.Set(FakeZonesProxy, 'do_something', slow)
+        pool = eventlet.GreenPool()
+        for i in xrange(2):
+            pool.spawn(api.call_zone_method, {}, 'do_something')
+        pool.waitall()
+        self.assertEqual(FakeNovaClientOpenStack.authentications, 2)
+        self.assertNotEqual(clients[0], clients[1])
+
+        # Both clients were handed back and are reused.
+        pool.spawn(api.call_zone_method, {}, 'do_something')
+        pool.spawn(api.call_zone_method, {}, 'do_something')
+        pool.waitall()
+        self.assertEqual(FakeNovaClientOpenStack.authentications, 2)
+        self.assertEqual(set(clients[2:]), set(clients[:2]))
+
+    def test_call_zone_method_leaves_out_zones_timing_out(self):
+        zones = [FakeZone(1, 'http://example.com', 'bob', 'xxx'),
+                 FakeZone(2, 'http://example.org', 'bob', 'xxx')]
+        FLAGS.zone_call_timeout = 0.01
+        try:
+            for i in xrange(FLAGS.zone_failures_to_offline):
+                self.assertEqual(api.call_zone_method({}, 'hang',
+                                                      zones=zones[1:]),
+                                 [])
+        finally:
+            FLAGS.zone_call_timeout = 30
+        self.assertFalse(api._ZONE_STATES[2].is_active)
+
+        # The zone is offline, it is not called again for a while.
+        self.assertEqual(api.call_zone_method({}, 'do_something',
+                                              zones=zones), [(1, 42)])
+        self.assertEqual(FakeNovaClientOpenStack.authentications,
+                         FLAGS.zone_failures_to_offline + 1)
@@ -677,6 +677,45 @@ class CloudTestCase(test.TestCase):
 
         self._tearDownBlockDeviceMapping(inst1, inst2, volumes)
 
+    def test_describe_instances_queries_do_not_grow(self):
+        """Make sure describe_instances looks up block devices, volumes
+        and availability zones for all the instances at once
+        """
+        (inst1, inst2, volumes) = self._setUpBlockDeviceMapping()
+
+        per_instance_calls = []
+
+        def counting(func):
+            def _call(*args, **kwargs):
+                per_instance_calls.append(func.__name__)
+                return func(*args, **kwargs)
+            return _call
+
+        for obj, name in ((db, 'block_device_mapping_get_all_by_instance'),
+                          (db, 'service_get_all_by_host'),
+                          (self.cloud.volume_api, 'get'),
+                          (self.cloud.compute_api, 'get')):
+            self.stubs.Set(obj, name, counting(getattr(obj, name)))
+
+        ec2_ids = [ec2utils.id_to_ec2_id(inst['id'])
+                   for inst in (inst1, inst2)]
+        result = self.cloud.describe_instances(self.context,
+                                               instance_id=ec2_ids)
+        self.assertEqual(per_instance_calls, [])
+        instances = dict((i['instanceId'], i)
+                         for r in result['reservationSet']
+                         for i in r['instancesSet'])
+        self.assertEqual(sorted(instances.keys()), sorted(ec2_ids))
+        self.assertSubDictMatch(self._expected_instance_bdm1,
+                                instances[ec2_ids[0]])
+        self._assertEqualBlockDeviceMapping(
+            self._expected_block_device_mapping0,
+            instances[ec2_ids[0]]['blockDeviceMapping'])
+        self.assertSubDictMatch(self._expected_instance_bdm2,
+                                instances[ec2_ids[1]])
+
+        self._tearDownBlockDeviceMapping(inst1, inst2, volumes)
+
     def test_describe_images(self):
         describe_images = self.cloud.describe_images
 
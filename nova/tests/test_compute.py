@@ -174,6 +174,134 @@ class ComputeTestCase(test.TestCase):
             finally:
                 db.instance_destroy(self.context, ref[0]['id'])
 
+    def test_create_multiple_instances(self):
+        """Make sure a batch of instances is created and scheduled at once"""
+        group = self._create_group()
+        granted_group = db.security_group_create(self.context,
+                                                 {'name': 'granted',
+                                                  'description': 'granted',
+                                                  'user_id': self.user.id,
+                                                  'project_id':
+                                                      self.project.id})
+        db.security_group_rule_create(self.context,
+                                      {'parent_group_id': granted_group['id'],
+                                       'group_id': group['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 22,
+                                       'to_port': 22})
+        for i in xrange(2):
+            instance_id = self._create_instance({'host': 'host1'})
+            db.instance_add_security_group(self.context.elevated(),
+                                           instance_id, granted_group['id'])
+
+        casts = []
+
+        def fake_cast(context, topic, msg):
+            casts.append((topic, msg))
+
+        self.stubs.Set(rpc, 'cast', fake_cast)
+        ref = self.compute_api.create(
+                self.context,
+                instance_type=instance_types.get_default_instance_type(),
+                image_href=None,
+                min_count=3,
+                display_name=None,
+                security_group=['testgroup'])
+        try:
+            self.assertEqual(len(ref), 3)
+            self.assertEqual([instance['launch_index'] for instance in ref],
+                             [0, 1, 2])
+            self.assertEqual(len(set(instance['hostname']
+                                     for instance in ref)), 3)
+            group = db.security_group_get(self.context, group['id'])
+            self.assertEqual(len(group.instances), 3)
+
+            # One members refresh for host1, one scheduler request.
+            self.assertEqual(len(casts), 2)
+            self.assertEqual(casts[0][1]['method'],
+                             'refresh_security_group_members')
+            self.assertEqual(casts[0][0],
+                             db.queue_get_for(self.context,
+                                              FLAGS.compute_topic, 'host1'))
+            self.assertEqual(casts[1][0], FLAGS.scheduler_topic)
+            self.assertEqual(casts[1][1]['method'], 'run_instances')
+            self.assertEqual(casts[1][1]['args']['instance_ids'],
+                             [instance['id'] for instance in ref])
+        finally:
+            for instance in ref:
+                db.instance_destroy(self.context, instance['id'])
+
+    def test_trigger_provider_fw_rules_refresh_fans_out_rules(self):
+        admin_ctxt = self.context.elevated()
+        db.provider_fw_rule_create(admin_ctxt, {'protocol': 'tcp',
+                                                'cidr': '10.99.99.99/32',
+                                                'from_port': 1,
+                                                'to_port': 65535})
+        casts = []
+
+        def fake_fanout_cast(context, topic, msg):
+            casts.append((topic, msg))
+
+        self.stubs.Set(rpc, 'fanout_cast', fake_fanout_cast)
+        self.compute_api.trigger_provider_fw_rules_refresh(admin_ctxt)
+
+        self.assertEqual(len(casts), 1)
+        topic, msg = casts[0]
+        self.assertEqual(topic, FLAGS.compute_topic)
+        self.assertEqual(msg['method'], 'refresh_provider_fw_rules')
+        self.assertEqual(msg['args']['rules'],
+                         [{'protocol': 'tcp', 'cidr': '10.99.99.99/32',
+                           'from_port': 1, 'to_port': 65535}])
+        version = msg['args']['version']
+
+        # Adding and deleting rules both move the version forward
+        rule = db.provider_fw_rule_create(admin_ctxt,
+                                          {'protocol': 'udp',
+                                           'cidr': '10.99.99.98/32',
+                                           'from_port': 53,
+                                           'to_port': 53})
+        self.compute_api.trigger_provider_fw_rules_refresh(admin_ctxt)
+        self.assertTrue(casts[1][1]['args']['version'] > version)
+        self.assertEqual(len(casts[1][1]['args']['rules']), 2)
+
+        db.provider_fw_rule_destroy(admin_ctxt, rule['id'])
+        self.compute_api.trigger_provider_fw_rules_refresh(admin_ctxt)
+        self.assertTrue(casts[2][1]['args']['version'] >
+                        casts[1][1]['args']['version'])
+        self.assertEqual(casts[2][1]['args']['rules'],
+                         msg['args']['rules'])
+
+    def test_refresh_provider_fw_rules_skips_old_versions(self):
+        rules = [{'protocol': 'tcp', 'cidr': '10.99.99.99/32',
+                  'from_port': 1, 'to_port': 65535}]
+        self.mox.StubOutWithMock(self.compute.driver,
+                                 'refresh_provider_fw_rules')
+        self.compute.driver.refresh_provider_fw_rules(rules=rules)
+        self.mox.ReplayAll()
+
+        self.compute.refresh_provider_fw_rules(self.context, rules=rules,
+                                               version=2)
+        self.compute.refresh_provider_fw_rules(self.context, rules=[],
+                                               version=1)
+        self.compute.refresh_provider_fw_rules(self.context, rules=[],
+                                               version=2)
+
+    def test_refresh_provider_fw_rules_retries_failed_version(self):
+        rules = [{'protocol': 'tcp', 'cidr': '10.99.99.99/32',
+                  'from_port': 1, 'to_port': 65535}]
+        self.mox.StubOutWithMock(self.compute.driver,
+                                 'refresh_provider_fw_rules')
+        self.compute.driver.refresh_provider_fw_rules(rules=rules).\
+                AndRaise(exception.ProcessExecutionError())
+        self.compute.driver.refresh_provider_fw_rules(rules=rules)
+        self.mox.ReplayAll()
+
+        self.assertRaises(exception.Error,
+                          self.compute.refresh_provider_fw_rules,
+                          self.context, rules=rules, version=2)
+        self.compute.refresh_provider_fw_rules(self.context, rules=rules,
+                                               version=2)
+
     def test_destroy_instance_disassociates_security_groups(self):
         """Make sure destroying disassociates security groups"""
         group = self._create_group()
@@ -242,6 +370,25 @@ class ComputeTestCase(test.TestCase):
         self.assert_(instance_ref['launched_at'] < terminate)
         self.assert_(instance_ref['deleted_at'] > terminate)
 
+    def test_terminate_shutoff_instance_releases_quota(self):
+        """Ensure destroying an already shut off instance frees its quota"""
+        instance_id = self._create_instance()
+        self.compute.run_instance(self.context, instance_id)
+        usages = db.quota_usage_get_all_by_project(self.context.elevated(),
+                                                   self.project.id,
+                                                   ['instances'])
+        self.assertEqual(usages['instances']['in_use'], 1)
+        db.instance_update(self.context, instance_id,
+                           {'state': power_state.SHUTOFF,
+                            'state_description': 'shutdown'})
+
+        self.assertRaises(exception.Error, self.compute.terminate_instance,
+                          self.context, instance_id)
+        usages = db.quota_usage_get_all_by_project(self.context.elevated(),
+                                                   self.project.id,
+                                                   ['instances'])
+        self.assertEqual(usages['instances']['in_use'], 0)
+
     def test_stop(self):
         """Ensure instance can be stopped"""
         instance_id = self._create_instance()
@@ -885,7 +1032,15 @@ class ComputeTestCase(test.TestCase):
 
         return bdm
 
-    def test_update_block_device_mapping(self):
+    def _create_block_device_mappings(self, instance_id, mappings):
+        db.block_device_mapping_create_bulk(self.context,
+                [dict(values, instance_id=instance_id)
+                 for values in mappings])
+        return [self._parse_db_block_device_mapping(bdm_ref)
+                for bdm_ref in db.block_device_mapping_get_all_by_instance(
+                    self.context, instance_id)]
+
+    def test_block_device_mapping(self):
         instance_id = self._create_instance()
         mappings = [
                 {'virtual': 'ami', 'device': 'sda1'},
@@ -935,12 +1090,10 @@ class ComputeTestCase(test.TestCase):
                 {'device_name': '/dev/sdd4',
                  'no_device': True}]
 
-        self.compute_api._update_image_block_device_mapping(
-            self.context, instance_id, mappings)
-
-        bdms = [self._parse_db_block_device_mapping(bdm_ref)
-                for bdm_ref in db.block_device_mapping_get_all_by_instance(
-                    self.context, instance_id)]
+        image_mappings = self.compute_api._image_block_device_mapping(
+            mappings)
+        bdms = self._create_block_device_mappings(instance_id,
+                                                  image_mappings)
         expected_result = [
             {'virtual_name': 'swap', 'device_name': '/dev/sdb1'},
             {'virtual_name': 'swap', 'device_name': '/dev/sdb2'},
@@ -953,11 +1106,12 @@ class ComputeTestCase(test.TestCase):
         expected_result.sort()
         self.assertDictListMatch(bdms, expected_result)
 
-        self.compute_api._update_block_device_mapping(
-            self.context, instance_id, block_device_mapping)
-        bdms = [self._parse_db_block_device_mapping(bdm_ref)
-                for bdm_ref in db.block_device_mapping_get_all_by_instance(
-                    self.context, instance_id)]
+        for bdm in db.block_device_mapping_get_all_by_instance(
+            self.context, instance_id):
+            db.block_device_mapping_destroy(self.context, bdm['id'])
+        bdms = self._create_block_device_mappings(instance_id,
+            self.compute_api._merge_block_device_mappings(image_mappings,
+                self.compute_api._block_device_mapping(block_device_mapping)))
         expected_result = [
             {'snapshot_id': 0x12345678, 'device_name': '/dev/sda1'},
 
@@ -16,6 +16,10 @@
 Tests for Crypto module.
 """
 
+import base64
+
+import eventlet
+import M2Crypto
 import mox
 import stubout
 
@@ -129,3 +133,57 @@ class RevokeCertsTest(test.TestCase):
         crypto.revoke_certs_by_project(project_id)
 
         self.mox.VerifyAll()
+
+
+class KeyPairTestCase(test.TestCase):
+    """Test case for in-process and pooled key pair generation"""
+    def _check_key_pair(self, key_pair):
+        private_key, public_key, fingerprint = key_pair
+        key = M2Crypto.RSA.load_key_string(private_key,
+                                           callback=lambda: None)
+        key_type, b64_blob, _comment = public_key.split(' ', 2)
+        self.assertEqual(key_type, 'ssh-rsa')
+        blob = base64.b64decode(b64_blob)
+        self.assertEqual(blob, crypto._rsa_to_ssh_blob(key))
+        self.assertEqual(fingerprint,
+                         crypto.generate_fingerprint_from_blob(blob))
+        self.assertEqual(len(fingerprint.split(':')), 16)
+
+    def test_generate_key_pair(self):
+        self._check_key_pair(crypto.generate_key_pair())
+
+    def test_generate_key_pair_in_native_thread(self):
+        executed = []
+
+        def fake_execute(method, *args):
+            executed.append(method)
+            return method(*args)
+
+        self.stubs.Set(crypto.tpool, 'execute', fake_execute)
+        self._check_key_pair(crypto.generate_key_pair())
+        self.assertEqual(executed, [crypto._generate_key_pair])
+
+    def test_key_pair_pool(self):
+        pool = crypto.KeyPairPool(2, workers=2)
+        try:
+            self.assertEqual(pool.pending, 2)
+            while pool.pending:
+                eventlet.sleep(0.05)
+            key_pair = pool.get()
+            self._check_key_pair(key_pair)
+            self.assertNotEqual(key_pair, pool.get())
+            self.assertEqual(pool.pending, 2)
+        finally:
+            pool.stop()
+
+    def test_generate_key_pair_falls_back_when_pool_is_empty(self):
+        self.flags(key_pair_pool_size=1)
+        pool = self.mox.CreateMock(crypto.KeyPairPool)
+        self.stubs.Set(crypto, '_KEY_PAIR_POOL', pool)
+        pool.get().AndReturn(None)
+        pool.get().AndReturn(('private', 'public', 'fingerprint'))
+        self.mox.ReplayAll()
+        self._check_key_pair(crypto.generate_key_pair())
+        self.assertEqual(crypto.generate_key_pair(),
+                         ('private', 'public', 'fingerprint'))
+        self.mox.VerifyAll()
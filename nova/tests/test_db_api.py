@@ -21,8 +21,10 @@
 from nova import test
 from nova import context
 from nova import db
+from nova import exception
 from nova import flags
 from nova.auth import manager
+from nova.db.sqlalchemy import api as sqlalchemy_api
 
 FLAGS = flags.FLAGS
 
@@ -84,3 +86,68 @@ class DbApiTestCase(test.TestCase):
         self.assertEqual(instance.id, result.id)
         self.assertEqual(result['fixed_ips'][0]['floating_ips'][0].address,
                          '1.2.1.2')
+
+    def test_fixed_ip_create_bulk(self):
+        self.stubs.Set(sqlalchemy_api, '_FIXED_IP_BULK_CHUNK_SIZE', 2)
+        ctxt = context.get_admin_context()
+        values = ({'address': '10.9.0.%d' % i,
+                   'reserved': i == 0} for i in xrange(5))
+        db.fixed_ip_create_bulk(ctxt, values)
+        for i in xrange(5):
+            fixed_ip = db.fixed_ip_get_by_address(ctxt, '10.9.0.%d' % i)
+            self.assertEqual(i == 0, fixed_ip['reserved'])
+            self.assertFalse(fixed_ip['deleted'])
+            self.assertFalse(fixed_ip['allocated'])
+
+    def test_virtual_interface_create_bulk(self):
+        ctxt = context.get_admin_context()
+        instance = db.instance_create(ctxt, {})
+        network = db.project_get_networks(ctxt, 'fake', associate=True)[0]
+        db.virtual_interface_create_bulk(ctxt,
+                [{'address': '02:16:3e:00:00:01',
+                  'instance_id': instance.id,
+                  'network_id': network['id']},
+                 {'address': '02:16:3e:00:00:02',
+                  'instance_id': instance.id,
+                  'network_id': network['id']}])
+        self.assertEqual(set(['02:16:3e:00:00:01', '02:16:3e:00:00:02']),
+                         db.virtual_interface_get_used_addresses(ctxt,
+                                ['02:16:3e:00:00:01', '02:16:3e:00:00:02',
+                                 '02:16:3e:00:00:03']))
+
+        # a taken address fails the whole batch
+        self.assertRaises(exception.VirtualInterfaceCreateException,
+                          db.virtual_interface_create_bulk, ctxt,
+                          [{'address': '02:16:3e:00:00:03',
+                            'instance_id': instance.id,
+                            'network_id': network['id']},
+                           {'address': '02:16:3e:00:00:01',
+                            'instance_id': instance.id,
+                            'network_id': network['id']}])
+        self.assertEqual(set(),
+                         db.virtual_interface_get_used_addresses(ctxt,
+                                ['02:16:3e:00:00:03']))
+
+    def test_virtual_interface_get_version_by_instance(self):
+        ctxt = context.get_admin_context()
+        instance = db.instance_create(ctxt, {})
+        network = db.project_get_networks(ctxt, 'fake', associate=True)[0]
+        versions = [db.virtual_interface_get_version_by_instance(ctxt,
+                                                                 instance.id)]
+        db.virtual_interface_create_bulk(ctxt,
+                [{'address': '02:16:3e:00:00:04',
+                  'instance_id': instance.id,
+                  'network_id': network['id']}])
+        versions.append(db.virtual_interface_get_version_by_instance(ctxt,
+                                                                instance.id))
+        db.fixed_ip_create(ctxt, {'address': '10.9.1.1',
+                                  'instance_id': instance.id,
+                                  'network_id': network['id']})
+        versions.append(db.virtual_interface_get_version_by_instance(ctxt,
+                                                                instance.id))
+        db.virtual_interface_delete_by_instance(ctxt, instance.id)
+        versions.append(db.virtual_interface_get_version_by_instance(ctxt,
+                                                                instance.id))
+        self.assertEqual(versions[0], ())
+        self.assertEqual(versions[3], ())
+        self.assertEqual(len(set(versions[:3])), 3)
@@ -22,14 +22,11 @@ from nova import exception
 from nova import flags
 from nova import test
 from nova.scheduler import host_filter
+from nova.scheduler import zone_manager
 
 FLAGS = flags.FLAGS
 
 
-class FakeZoneManager:
-    pass
-
-
 class HostFilterTestCase(test.TestCase):
     """Test case for host filters."""
 
@@ -70,11 +67,14 @@ class HostFilterTestCase(test.TestCase):
                 rxtx_cap=200,
                 extra_specs={})
 
-        self.zone_manager = FakeZoneManager()
         states = {}
         for x in xrange(10):
-            states['host%02d' % (x + 1)] = {'compute': self._host_caps(x)}
-        self.zone_manager.service_states = states
+            states['host%02d' % (x + 1)] = self._host_caps(x)
+
+        self.zone_manager = zone_manager.ZoneManager()
+        for host, capabilities in states.iteritems():
+            self.zone_manager.update_service_capabilities('compute', host,
+                                                          capabilities)
 
     def tearDown(self):
         FLAGS.default_host_filter = self.old_flag
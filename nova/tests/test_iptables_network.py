@@ -92,6 +92,19 @@ class IptablesManagerTestCase(test.TestCase):
         self.assertTrue('-A run_tests.py-FORWARD '
                         '-s 1.2.3.4/5 -j DROP' not in new_lines)
 
+    def test_remove_chain_keeps_jumps_to_similar_chains(self):
+        table = self.manager.ipv4['filter']
+        for chain in ('sg-1', 'sg-12', 'inst-5'):
+            table.add_chain(chain)
+        table.add_rule('inst-5', '-j $sg-1')
+        table.add_rule('inst-5', '-j $sg-12')
+        table.add_rule('inst-5', '-s 1.2.3.4 -j $sg-1')
+
+        table.remove_chain('sg-1')
+        self.assertEqual(['-j %s-sg-12' % linux_net.binary_name],
+                         [rule.rule for rule in table.rules
+                                    if rule.chain == 'inst-5'])
+
     def test_nat_rules(self):
         current_lines = self.sample_nat
         new_lines = self.manager._modify_rules(current_lines,
@@ -162,3 +175,27 @@ class IptablesManagerTestCase(test.TestCase):
             self.assertTrue('-A %s -j run_tests.py-%s' \
                             % (chain, chain) in new_lines,
                             "Built-in chain %s not wrapped" % (chain,))
+
+
+class LinuxNetBatchTestCase(test.TestCase):
+    def setUp(self):
+        super(LinuxNetBatchTestCase, self).setUp()
+        self.flags(fake_network=False)
+        self.batches = []
+        self.stubs.Set(linux_net.utils, 'execute_batch',
+                       lambda *cmds: self.batches.append(cmds))
+        self.stubs.Set(linux_net, '_device_exists', lambda device: False)
+        self.stubs.Set(linux_net, 'iptables_manager',
+                       linux_net.IptablesManager())
+
+    def test_ensure_vlan_runs_one_batch(self):
+        linux_net.ensure_vlan(100, 'eth0')
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(self.batches[0][-1],
+                         ('sudo', 'ip', 'link', 'set', 'vlan100', 'up'))
+
+    def test_ensure_bridge_runs_one_batch(self):
+        linux_net.ensure_bridge('br100', None)
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(self.batches[0][0],
+                         ('sudo', 'brctl', 'addbr', 'br100'))
@@ -34,6 +34,7 @@ from nova import utils
 from nova.api.ec2 import cloud
 from nova.auth import manager
 from nova.compute import power_state
+from nova.network import linux_net
 from nova.virt.libvirt import connection
 from nova.virt.libvirt import firewall
 
@@ -148,6 +149,157 @@ class CacheConcurrencyTestCase(test.TestCase):
             eventlet.sleep(0)
 
 
+class CacheImageTestCase(test.TestCase):
+
+    def setUp(self):
+        super(CacheImageTestCase, self).setUp()
+        self.executed = []
+        self.reflink = True
+        self.copy_fails = False
+
+        def fake_exists(fname):
+            return fname == os.path.join(FLAGS.instances_path, '_base')
+
+        def fake_execute(*args, **kwargs):
+            if '--reflink=auto' in args and not self.reflink:
+                raise exception.ProcessExecutionError(
+                        stderr="cp: unrecognized option '--reflink=auto'")
+            if args[0] == 'cp' and self.copy_fails:
+                raise exception.ProcessExecutionError(
+                        stderr='cp: No space left on device')
+            self.executed.append(args)
+
+        self.stubs.Set(os.path, 'exists', fake_exists)
+        self.stubs.Set(utils, 'execute', fake_execute)
+        self.stubs.Set(connection, '_cp_reflink', True)
+
+    def _cache_image(self, cow):
+        connection.LibvirtConnection._cache_image(lambda target: None,
+                                                  'target', 'fname', cow)
+        return self.executed[-1]
+
+    def test_cow_overlay(self):
+        self.flags(libvirt_cow_cluster_size='64K')
+        base = os.path.join(FLAGS.instances_path, '_base', 'fname')
+        self.assertEqual(self._cache_image(True),
+                         ('qemu-img', 'create', '-f', 'qcow2', '-o',
+                          'cluster_size=64K,backing_file=%s' % base,
+                          'target'))
+
+    def test_preallocated_cow_overlay(self):
+        self.flags(libvirt_cow_preallocation='metadata')
+        options = self._cache_image(True)[5]
+        self.assertTrue(options.endswith(',preallocation=metadata'))
+
+    def test_copy_uses_reflink(self):
+        self.assertEqual(self._cache_image(False)[:3],
+                         ('cp', '--reflink=auto', '--sparse=always'))
+
+    def test_copy_without_reflink(self):
+        self.reflink = False
+        self.assertEqual(self._cache_image(False)[:2],
+                         ('cp', '--sparse=always'))
+        self.assertFalse(connection._cp_reflink)
+
+    def test_failed_copy_keeps_reflink(self):
+        self.copy_fails = True
+        self.assertRaises(exception.ProcessExecutionError,
+                          self._cache_image, False)
+        self.assertEqual(self.executed, [])
+        self.assertTrue(connection._cp_reflink)
+
+    def test_unsupported_preallocation(self):
+        self.flags(libvirt_cow_preallocation='everything')
+        self.assertRaises(exception.Error, connection.LibvirtConnection,
+                          False)
+
+    def test_images_are_cached_at_once(self):
+        conn = connection.LibvirtConnection
+        wait1 = eventlet.event.Event()
+        done1 = eventlet.event.Event()
+        wait2 = eventlet.event.Event()
+        done2 = eventlet.event.Event()
+        eventlet.spawn(conn._cache_images, conn(False),
+                       [dict(fn=_concurrency, target='target1',
+                             fname='fname1', wait=wait1, done=done1),
+                        dict(fn=_concurrency, target='target2',
+                             fname='fname2', wait=wait2, done=done2)])
+        eventlet.sleep(0)
+        wait2.send()
+        eventlet.sleep(0)
+        try:
+            self.assertTrue(done2.ready())
+            self.assertFalse(done1.ready())
+        finally:
+            wait1.send()
+            eventlet.sleep(0)
+
+
+class FakeLibvirtDomain(object):
+
+    def info(self):
+        return [power_state.RUNNING, 2048, 2048, 1, 0]
+
+# Proxies wrap what the calls return from the libvirt module
+FakeLibvirtDomain.__module__ = 'libvirt'
+
+
+class LibvirtCallPoolTestCase(test.TestCase):
+
+    def setUp(self):
+        super(LibvirtCallPoolTestCase, self).setUp()
+        self.pool = connection._LibvirtCallPool(1)
+        self.seen = []
+        test_case = self
+
+        class FakeLibvirtConnection(object):
+
+            def getInfo(self):
+                # Block the native thread, not just the greenthread
+                eventlet.patcher.original('time').sleep(0.1)
+                test_case.seen.append((test_case.pool.in_flight,
+                                       test_case.pool.waiting))
+
+            def lookupByName(self, name):
+                if name == 'missing':
+                    raise exception.NotFound()
+                return FakeLibvirtDomain()
+
+        self.proxy = connection._LibvirtProxy(FakeLibvirtConnection(),
+                                              self.pool)
+
+    def test_calls_do_not_block_greenthreads(self):
+        eventlet.spawn_n(self.seen.append, 'greenthread')
+        self.proxy.getInfo()
+        self.assertEqual(self.seen, ['greenthread', (1, 0)])
+
+    def test_calls_are_bounded(self):
+        calls = [eventlet.spawn(self.proxy.getInfo) for i in xrange(2)]
+        for call in calls:
+            call.wait()
+        self.assertEqual(self.seen, [(1, 1), (1, 0)])
+
+    def test_domains_are_proxied(self):
+        domain = self.proxy.lookupByName('instance-1')
+        self.assertTrue(isinstance(domain, connection._LibvirtProxy))
+        self.assertEqual(domain.info()[0], power_state.RUNNING)
+        self.assertRaises(exception.NotFound,
+                          self.proxy.lookupByName, 'missing')
+
+        stats = self.pool.get_stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['methods']['lookupByName']['calls'], 2)
+        self.assertEqual(stats['methods']['info']['calls'], 1)
+
+    def test_inline_calls(self):
+        self.pool = connection._LibvirtCallPool(0)
+        self.proxy._pool = self.pool
+        self.proxy.getInfo()
+        self.assertEqual(self.seen, [(0, 0)])
+        self.assertEqual(self.pool.get_stats()['methods'], {})
+
+
 class LibvirtConnTestCase(test.TestCase):
 
     def setUp(self):
@@ -440,6 +592,164 @@ class LibvirtConnTestCase(test.TestCase):
         self.assertEquals(parameters[1].get('name'), 'DHCPSERVER')
         self.assertEquals(parameters[1].get('value'), 'fake')
 
+    def test_to_xml_renders_only_changes(self):
+        renders = []
+        compile_template = connection._compile_template
+
+        def fake_compile_template(source):
+            template_class = compile_template(source)
+
+            def render(searchList):
+                renders.append(searchList)
+                return template_class(searchList=searchList)
+            return render
+
+        self.stubs.Set(connection, '_compile_template', fake_compile_template)
+        conn = connection.LibvirtConnection(True)
+        instance_ref = db.instance_create(self.context, self.test_instance)
+        xml = conn.to_xml(instance_ref, False, _create_network_info(1))
+        self.assertEqual(conn.to_xml(instance_ref, False,
+                                     _create_network_info(1)), xml)
+        self.assertEqual(len(renders), 1)
+
+        xml = conn.to_xml(instance_ref, False, _create_network_info(2))
+        self.assertEqual(len(xml_to_tree(xml).findall(
+                "./devices/interface")), 2)
+        self.assertEqual(len(renders), 2)
+
+    def test_domain_snapshot_shared(self):
+        calls = []
+
+        class FakeDomain(object):
+
+            def __init__(self, name, state, vcpus):
+                self._name = name
+                self._info = [state, 2048, 2048, vcpus, 0]
+
+            def name(self):
+                return self._name
+
+            def info(self):
+                calls.append('info')
+                return self._info
+
+        class FakeLibvirtConnection(object):
+
+            def __init__(self):
+                self.domains = [FakeDomain('instance-1', power_state.RUNNING,
+                                           1),
+                                FakeDomain('instance-2', power_state.PAUSED,
+                                           2)]
+
+            def listDomainsID(self):
+                calls.append('listDomainsID')
+                return range(len(self.domains))
+
+            def lookupByID(self, domain_id):
+                return self.domains[domain_id]
+
+            def createXML(self, xml, flags):
+                domain = FakeDomain('instance-3', power_state.RUNNING, 4)
+                self.domains.append(domain)
+                return domain
+
+        self.flags(libvirt_domain_snapshot_ttl=60)
+        self.stubs.Set(connection.LibvirtConnection, '_conn',
+                       FakeLibvirtConnection())
+        conn = connection.LibvirtConnection(False)
+
+        infos = conn.list_instances_detail()
+        self.assertEqual([(info.name, info.state) for info in infos],
+                         [('instance-1', power_state.RUNNING),
+                          ('instance-2', power_state.PAUSED)])
+        self.assertEqual(conn.get_vcpu_used(), 3)
+        self.assertEqual(calls, ['listDomainsID', 'info', 'info'])
+
+        # Existence checks never use the snapshot
+        del calls[:]
+        self.assertEqual(conn.list_instances(), ['instance-1', 'instance-2'])
+        self.assertEqual(calls, ['listDomainsID'])
+
+        del calls[:]
+        conn._create_new_domain('<domain/>', persistent=False)
+        self.assertEqual(conn.get_vcpu_used(), 7)
+        self.assertEqual(calls, ['listDomainsID', 'info', 'info', 'info'])
+
+    def test_domain_snapshot_dropped_on_state_changes(self):
+        test = self
+
+        class FakeDomain(object):
+
+            def __init__(self):
+                self.state = power_state.RUNNING
+                self.on_info = None
+
+            def name(self):
+                return 'instance-1'
+
+            def info(self):
+                info = [self.state, 2048, 2048, 1, 0]
+                if self.on_info:
+                    on_info, self.on_info = self.on_info, None
+                    on_info()
+                return info
+
+            def suspend(self):
+                self.state = power_state.PAUSED
+
+            def resume(self):
+                self.state = power_state.RUNNING
+
+            def destroy(self):
+                # a poll of the domains while libvirt tears this one down
+                test.conn.list_instances_detail()
+                test.domains.remove(self)
+
+            def undefine(self):
+                pass
+
+        class FakeInstance(object):
+            name = 'instance-1'
+
+        class FakeLibvirtConnection(object):
+
+            def listDomainsID(self):
+                return range(len(test.domains))
+
+            def lookupByID(self, domain_id):
+                return test.domains[domain_id]
+
+        def fake_get_info(instance_name):
+            raise exception.NotFound()
+
+        domain = FakeDomain()
+        self.domains = [domain]
+        self.flags(libvirt_domain_snapshot_ttl=60)
+        self.stubs.Set(connection.LibvirtConnection, '_conn',
+                       FakeLibvirtConnection())
+        self.conn = connection.LibvirtConnection(False)
+        self.stubs.Set(self.conn, '_lookup_by_name', lambda name: domain)
+        self.stubs.Set(self.conn, 'get_info', fake_get_info)
+        self.stubs.Set(self.conn.firewall_driver, 'unfilter_instance',
+                       lambda instance, network_info: None)
+
+        def states():
+            return [info.state for info in self.conn.list_instances_detail()]
+
+        instance = FakeInstance()
+        self.assertEqual(states(), [power_state.RUNNING])
+        self.conn.pause(instance, None)
+        self.assertEqual(states(), [power_state.PAUSED])
+        self.conn.unpause(instance, None)
+        # the next walk of the domains overlaps a pause
+        domain.on_info = lambda: self.conn.pause(instance, None)
+        self.assertEqual(states(), [power_state.RUNNING])
+        self.assertEqual(states(), [power_state.PAUSED])
+        self.conn.unpause(instance, None)
+
+        self.conn.destroy({'name': 'instance-1'}, [], cleanup=False)
+        self.assertEqual(states(), [])
+
     def _check_xml_and_container(self, instance):
         user_context = context.RequestContext(project=self.project,
                                               user=self.user)
@@ -1016,16 +1326,192 @@ class IptablesFirewallTestCase(test.TestCase):
         self.assertEquals(ipv6_network_rules,
                           ipv6_rules_per_network * networks_count)
 
+    def _group_chain_rules(self, security_group_id):
+        chain_name = self.fw._security_group_chain_name(security_group_id)
+        return [rule.rule for rule in self.fw.iptables.ipv4['filter'].rules
+                          if rule.chain == chain_name]
+
     def test_do_refresh_security_group_rules(self):
+        admin_ctxt = context.get_admin_context()
         instance_ref = self._create_instance_ref()
-        self.mox.StubOutWithMock(self.fw,
-                                 'add_filters_for_instance',
-                                 use_mock_anything=True)
-        self.fw.add_filters_for_instance(instance_ref, mox.IgnoreArg())
-        self.fw.instances[instance_ref['id']] = instance_ref
+        other_ref = self._create_instance_ref()
+        secgroup = db.security_group_create(admin_ctxt,
+                                            {'user_id': 'fake',
+                                             'project_id': 'fake',
+                                             'name': 'testgroup',
+                                             'description': 'test group'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 80,
+                                       'to_port': 80,
+                                       'cidr': '192.168.10.0/24'})
+        for inst in (instance_ref, other_ref):
+            db.instance_add_security_group(admin_ctxt, inst['id'],
+                                           secgroup['id'])
+            self.fw.add_filters_for_instance(inst, _create_network_info(1))
+
+        self.assertEqual(set([instance_ref['id'], other_ref['id']]),
+                         self.fw.security_group_instances[secgroup['id']])
+        self.assertEqual(['-p tcp -s 192.168.10.0/24 --dport 80 -j ACCEPT'],
+                         self._group_chain_rules(secgroup['id']))
+
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'udp',
+                                       'from_port': 53,
+                                       'to_port': 53,
+                                       'cidr': '192.168.10.0/24'})
+
+        # A rule change must not rebuild any instance chain
+        self.mox.StubOutWithMock(self.fw, 'add_filters_for_instance')
+        self.mox.StubOutWithMock(self.fw, 'remove_filters_for_instance')
         self.mox.ReplayAll()
+        self.fw.do_refresh_security_group_rules(secgroup['id'])
         self.fw.do_refresh_security_group_rules("fake")
 
+        self.assertEqual(['-p tcp -s 192.168.10.0/24 --dport 80 -j ACCEPT',
+                          '-p udp -s 192.168.10.0/24 --dport 53 -j ACCEPT'],
+                         self._group_chain_rules(secgroup['id']))
+
+    def test_security_group_chain_removed_with_last_instance(self):
+        admin_ctxt = context.get_admin_context()
+        instance_ref = self._create_instance_ref()
+        other_ref = self._create_instance_ref()
+        secgroup = db.security_group_create(admin_ctxt,
+                                            {'user_id': 'fake',
+                                             'project_id': 'fake',
+                                             'name': 'testgroup',
+                                             'description': 'test group'})
+        chain_name = self.fw._security_group_chain_name(secgroup['id'])
+        for inst in (instance_ref, other_ref):
+            db.instance_add_security_group(admin_ctxt, inst['id'],
+                                           secgroup['id'])
+            self.fw.add_filters_for_instance(inst, _create_network_info(1))
+
+        self.fw.remove_filters_for_instance(instance_ref)
+        self.assertTrue(chain_name in self.fw.iptables.ipv4['filter'].chains)
+
+        self.fw.remove_filters_for_instance(other_ref)
+        self.assertFalse(chain_name in self.fw.iptables.ipv4['filter'].chains)
+        self.assertFalse(secgroup['id'] in self.fw.security_group_instances)
+        self.assertFalse(secgroup['id'] in self.fw.security_group_rules)
+
+    def test_release_group_keeps_jumps_to_similar_groups(self):
+        admin_ctxt = context.get_admin_context()
+        instance_ref = self._create_instance_ref()
+        other_ref = self._create_instance_ref()
+        group = db.security_group_create(admin_ctxt,
+                                         {'user_id': 'fake',
+                                          'project_id': 'fake',
+                                          'name': 'short',
+                                          'description': 'short id'})
+        # make the other group's chain name start with the first one's
+        similar = db.security_group_create(admin_ctxt,
+                                           {'id': int('%s2' % group['id']),
+                                            'user_id': 'fake',
+                                            'project_id': 'fake',
+                                            'name': 'long',
+                                            'description': 'long id'})
+        db.instance_add_security_group(admin_ctxt, instance_ref['id'],
+                                       group['id'])
+        db.instance_add_security_group(admin_ctxt, other_ref['id'],
+                                       similar['id'])
+        for inst in (instance_ref, other_ref):
+            self.fw.add_filters_for_instance(inst, _create_network_info(1))
+
+        self.fw.remove_filters_for_instance(instance_ref)
+        table = self.fw.iptables.ipv4['filter']
+        self.assertFalse(self.fw._security_group_chain_name(group['id'])
+                         in table.chains)
+        instance_chain = self.fw._instance_chain_name(other_ref)
+        similar_chain = self.fw._security_group_chain_name(similar['id'])
+        self.assertTrue('-j %s-%s' % (linux_net.binary_name, similar_chain) in
+                        [rule.rule for rule in table.rules
+                                   if rule.chain == instance_chain])
+
+    def test_security_group_grant_uses_ipset(self):
+        self.flags(use_ipset=True, use_ipv6=False)
+        admin_ctxt = context.get_admin_context()
+        executed = []
+
+        def fake_execute(*cmd, **kwargs):
+            executed.append((cmd, kwargs.get('process_input')))
+            return '', ''
+        self.fw._execute = fake_execute
+
+        web = db.security_group_create(admin_ctxt,
+                                       {'user_id': 'fake',
+                                        'project_id': 'fake',
+                                        'name': 'web',
+                                        'description': 'web servers'})
+        lb = db.security_group_create(admin_ctxt,
+                                      {'user_id': 'fake',
+                                       'project_id': 'fake',
+                                       'name': 'lb',
+                                       'description': 'load balancers'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': web['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 80,
+                                       'to_port': 80,
+                                       'group_id': lb['id']})
+
+        lb_ref = self._create_instance_ref()
+        db.instance_add_security_group(admin_ctxt, lb_ref['id'], lb['id'])
+        db.fixed_ip_create(admin_ctxt, {'address': '10.9.0.2',
+                                        'allocated': True,
+                                        'instance_id': lb_ref['id']})
+
+        web_ref = self._create_instance_ref()
+        db.instance_add_security_group(admin_ctxt, web_ref['id'], web['id'])
+        self.fw.add_filters_for_instance(web_ref, _create_network_info(1))
+
+        ipset = self.fw._ipset_name(lb['id'], 4)
+        self.assertEqual(['-p tcp -m set --match-set %s src --dport 80 '
+                          '-j ACCEPT' % ipset],
+                         self._group_chain_rules(web['id']))
+        # The set is created and filled with one ipset restore
+        self.assertEqual([(('sudo', 'ipset', 'restore', '-exist'),
+                           'create %(set)s hash:ip family inet\n'
+                           'flush %(set)s\n'
+                           'add %(set)s 10.9.0.2\n' % {'set': ipset})],
+                         executed)
+
+        # Members joining and leaving only add and delete their addresses.
+        # A deallocated address leaves even before the instance is gone.
+        other_ref = self._create_instance_ref()
+        db.instance_add_security_group(admin_ctxt, other_ref['id'], lb['id'])
+        db.fixed_ip_create(admin_ctxt, {'address': '10.9.0.3',
+                                        'allocated': True,
+                                        'instance_id': other_ref['id']})
+        db.fixed_ip_update(admin_ctxt, '10.9.0.2', {'allocated': False})
+        del executed[:]
+        self.mox.StubOutWithMock(self.fw.iptables, 'apply')
+        self.fw.iptables.apply()
+        self.mox.ReplayAll()
+        self.fw.refresh_security_group_members(lb['id'])
+        self.assertEqual([(('sudo', 'ipset', 'restore', '-exist'),
+                           'add %(set)s 10.9.0.3\n'
+                           'del %(set)s 10.9.0.2\n' % {'set': ipset})],
+                         executed)
+
+        # Recompiling the granting group catches up on missed changes
+        db.fixed_ip_update(admin_ctxt, '10.9.0.2', {'allocated': True})
+        del executed[:]
+        self.fw.refresh_security_group_rules(web['id'])
+        self.assertEqual([(('sudo', 'ipset', 'restore', '-exist'),
+                           'add %s 10.9.0.2\n' % ipset)],
+                         executed)
+
+        # Once no chain references the set it is destroyed
+        del executed[:]
+        self.fw.remove_filters_for_instance(web_ref)
+        self.fw._destroy_stale_ipsets()
+        self.assertEqual([(('sudo', 'ipset', 'destroy', ipset), None)],
+                         executed)
+        self.assertFalse(lb['id'] in self.fw.ipsets)
+
     def test_unfilter_instance_undefines_nwfilter(self):
         # Skip if non-libvirt environment
         if not self.lazy_load_library_exists():
@@ -1111,6 +1597,18 @@ class IptablesFirewallTestCase(test.TestCase):
                       if rule.chain == 'provider']
         self.assertEqual(1, len(rules))
 
+    def test_provider_firewall_rules_from_message(self):
+        self.mox.StubOutWithMock(db, 'provider_fw_rule_get_all')
+        self.mox.ReplayAll()
+
+        rules = [{'protocol': 'tcp', 'cidr': '10.99.99.99/32',
+                  'from_port': 1, 'to_port': 65535}]
+        self.fw._do_refresh_provider_fw_rules(rules)
+        rules = [rule.rule for rule in self.fw.iptables.ipv4['filter'].rules
+                           if rule.chain == 'provider']
+        self.assertEqual(['-p tcp -s 10.99.99.99/32 -m multiport '
+                          '--dports 1:65535 -j DROP'], rules)
+
 
 class NWFilterTestCase(test.TestCase):
     def setUp(self):
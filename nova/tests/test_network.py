@@ -126,17 +126,27 @@ class FlatNetworkTestCase(test.TestCase):
         self.network = network_manager.FlatManager(host=HOST)
         self.network.db = db
 
-    def test_get_instance_nw_info(self):
-        self.mox.StubOutWithMock(db, 'fixed_ip_get_by_instance')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
+    def _stub_nw_info_db(self, lookups=1, versions=None):
+        self.mox.StubOutWithMock(db,
+                            'virtual_interface_get_by_instance_with_fixed_ips')
+        self.mox.StubOutWithMock(db,
+                            'virtual_interface_get_version_by_instance')
         self.mox.StubOutWithMock(db, 'instance_type_get')
 
-        db.fixed_ip_get_by_instance(mox.IgnoreArg(),
-                                    mox.IgnoreArg()).AndReturn(fixed_ips)
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg()).AndReturn(vifs)
+        vifs_with_ips = [(vif, [ip for ip in fixed_ips
+                                if ip['network_id'] == vif['network_id']])
+                         for vif in vifs]
+        for version in versions or []:
+            db.virtual_interface_get_version_by_instance(
+                    mox.IgnoreArg(), mox.IgnoreArg()).AndReturn(version)
         db.instance_type_get(mox.IgnoreArg(),
-                                   mox.IgnoreArg()).AndReturn(flavor)
+                             mox.IgnoreArg()).AndReturn(flavor)
+        for i in xrange(lookups):
+            db.virtual_interface_get_by_instance_with_fixed_ips(
+                    mox.IgnoreArg(), mox.IgnoreArg()).AndReturn(vifs_with_ips)
+
+    def test_get_instance_nw_info(self):
+        self._stub_nw_info_db(versions=[()])
         self.mox.ReplayAll()
 
         nw_info = self.network.get_instance_nw_info(None, 0, 0, None)
@@ -180,6 +190,86 @@ class FlatNetworkTestCase(test.TestCase):
                       'netmask': '255.255.255.0'}]
             self.assertDictListMatch(nw[1]['ips'], check)
 
+    def test_get_instance_nw_info_is_cached(self):
+        self._stub_nw_info_db(versions=[(), ()])
+        self.mox.ReplayAll()
+
+        nw_info = self.network.get_instance_nw_info(None, 0, 0, None)
+        # served from the cache, the db is only hit once
+        self.assertEqual(nw_info,
+                         self.network.get_instance_nw_info(None, 0, 0, None))
+
+    def test_get_instance_nw_info_cache_invalidated(self):
+        self._stub_nw_info_db(lookups=2, versions=[(), ()])
+        self.mox.ReplayAll()
+
+        self.network.get_instance_nw_info(None, 0, 0, None)
+        self.network._invalidate_nw_info(0)
+        self.network.get_instance_nw_info(None, 0, 0, None)
+
+    def test_get_instance_nw_info_changed_elsewhere(self):
+        # another network host allocated an ip for the instance
+        self._stub_nw_info_db(lookups=2,
+                              versions=[((0, 0), (1, 1)),
+                                        ((0, 0), (1, 1), (1, 2))])
+        self.mox.ReplayAll()
+
+        self.network.get_instance_nw_info(None, 0, 0, None)
+        self.network.get_instance_nw_info(None, 0, 0, None)
+
+    def test_get_instance_nw_info_cache_disabled(self):
+        self.flags(network_info_cache_ttl=0)
+        self._stub_nw_info_db(lookups=2)
+        db.instance_type_get(mox.IgnoreArg(),
+                             mox.IgnoreArg()).AndReturn(flavor)
+        self.mox.ReplayAll()
+
+        self.network.get_instance_nw_info(None, 0, 0, None)
+        self.network.get_instance_nw_info(None, 0, 0, None)
+
+    def _stub_mac_addresses(self):
+        addresses = ('02:16:3e:00:00:%02x' % i for i in xrange(256))
+        self.stubs.Set(self.network, 'generate_mac_address',
+                       addresses.next)
+
+    def test_allocate_mac_addresses_replaces_used(self):
+        self._stub_mac_addresses()
+        self.mox.StubOutWithMock(db, 'virtual_interface_get_used_addresses')
+        self.mox.StubOutWithMock(db, 'virtual_interface_create_bulk')
+
+        db.virtual_interface_get_used_addresses(mox.IgnoreArg(),
+                ['02:16:3e:00:00:00', '02:16:3e:00:00:01']).\
+                AndReturn(set(['02:16:3e:00:00:00']))
+        db.virtual_interface_get_used_addresses(mox.IgnoreArg(),
+                ['02:16:3e:00:00:02', '02:16:3e:00:00:01']).\
+                AndReturn(set())
+        db.virtual_interface_create_bulk(mox.IgnoreArg(),
+                [{'instance_id': 7, 'network_id': 0,
+                  'address': '02:16:3e:00:00:02'},
+                 {'instance_id': 7, 'network_id': 1,
+                  'address': '02:16:3e:00:00:01'}])
+        self.mox.ReplayAll()
+
+        self.network._allocate_mac_addresses(None, 7, networks)
+
+    def test_allocate_mac_addresses_gives_up(self):
+        self.flags(create_unique_mac_address_attempts=2)
+        self._stub_mac_addresses()
+        self.mox.StubOutWithMock(db, 'virtual_interface_get_used_addresses')
+        self.mox.StubOutWithMock(db, 'virtual_interface_create_bulk')
+
+        for i in xrange(2):
+            db.virtual_interface_get_used_addresses(mox.IgnoreArg(),
+                    mox.IgnoreArg()).AndReturn(set())
+            db.virtual_interface_create_bulk(mox.IgnoreArg(),
+                    mox.IgnoreArg()).AndRaise(
+                            exception.VirtualInterfaceCreateException())
+        self.mox.ReplayAll()
+
+        self.assertRaises(exception.VirtualInterfaceMacAddressException,
+                          self.network._allocate_mac_addresses,
+                          None, 7, networks)
+
 
 class VlanNetworkTestCase(test.TestCase):
     def setUp(self):
@@ -227,6 +317,26 @@ class VlanNetworkTestCase(test.TestCase):
         network['vpn_private_address'] = '192.168.0.2'
         self.network.allocate_fixed_ip(None, 0, network)
 
+    def test_create_fixed_ips(self):
+        self.mox.StubOutWithMock(db, 'network_get')
+        db.network_get(mox.IgnoreArg(), 5).AndReturn(
+                {'id': 5, 'cidr': '192.168.0.0/29'})
+        self.mox.ReplayAll()
+
+        created = []
+
+        def fake_fixed_ip_create_bulk(context, values_iter):
+            created.extend(values_iter)
+        self.stubs.Set(db, 'fixed_ip_create_bulk', fake_fixed_ip_create_bulk)
+
+        self.network._create_fixed_ips(None, 5)
+        self.assertEqual(['192.168.0.%d' % i for i in xrange(8)],
+                         [values['address'] for values in created])
+        self.assertEqual([True] * 3 + [False] * 5,
+                         [values['reserved'] for values in created])
+        self.assertTrue(all(values['network_id'] == 5
+                            for values in created))
+
     def test_create_networks_too_big(self):
         self.assertRaises(ValueError, self.network.create_networks, None,
                           num_networks=4094, vlan_start=1)
@@ -249,9 +359,14 @@ class CommonNetworkTestCase(test.TestCase):
                 return [dict(address='10.0.0.0'),  dict(address='10.0.0.1'),
                         dict(address='10.0.0.2')]
 
+            def security_group_get_by_instance(self, context, instance_id):
+                return []
+
         def __init__(self):
             self.db = self.FakeDB()
             self.deallocate_called = None
+            self._nw_info_cache = {}
+            self._nw_info_epoch = 0
 
         def deallocate_fixed_ip(self, context, address):
             self.deallocate_called = address
@@ -262,6 +377,22 @@ class CommonNetworkTestCase(test.TestCase):
 
         self.assertEquals(manager.deallocate_called, '10.0.0.1')
 
+    def test_remove_fixed_ip_refreshes_security_group_members(self):
+        manager = self.FakeNetworkManager()
+        refreshed = []
+
+        class FakeComputeAPI(object):
+
+            def trigger_security_group_members_refresh(self, context,
+                                                       group_ids):
+                refreshed.append((manager.deallocate_called, group_ids))
+
+        manager.compute_api = FakeComputeAPI()
+        self.stubs.Set(manager.db, 'security_group_get_by_instance',
+                       lambda context, instance_id: [{'id': 1}, {'id': 2}])
+        manager.remove_fixed_ip_from_instance(None, 99, '10.0.0.1')
+        self.assertEqual(refreshed, [('10.0.0.1', [1, 2])])
+
     def test_remove_fixed_ip_from_instance_bad_input(self):
         manager = self.FakeNetworkManager()
         self.assertRaises(exception.FixedIpNotFoundForSpecificInstance,
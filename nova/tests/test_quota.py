@@ -16,17 +16,24 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import time
+
 from nova import compute
 from nova import context
 from nova import db
+from nova import exception
 from nova import flags
 from nova import network
 from nova import quota
+from nova import rpc
 from nova import test
 from nova import utils
 from nova import volume
 from nova.auth import manager
 from nova.compute import instance_types
+from nova.db.sqlalchemy import api as sqlalchemy_api
+from nova.db.sqlalchemy import models
+from nova.db.sqlalchemy.session import get_session
 
 
 FLAGS = flags.FLAGS
@@ -280,6 +287,130 @@ class QuotaTestCase(test.TestCase):
                           self.project.id)
         db.floating_ip_destroy(context.get_admin_context(), address)
 
+    def _get_usages(self, *resources):
+        usages = db.quota_usage_get_all_by_project(self.context,
+                                                   self.project.id,
+                                                   resources)
+        return [(usages[r]['in_use'], usages[r]['reserved'])
+                for r in resources]
+
+    def test_usages_sync_from_existing_rows(self):
+        self._create_instance(cores=2)
+        self._create_volume(size=5)
+        self.assertEqual(self._get_usages('instances', 'cores', 'gigabytes'),
+                         [(1, 0), (2, 0), (5, 0)])
+
+    def test_usages_sync_counts_auto_assigned_floating_ips(self):
+        admin_ctxt = context.get_admin_context()
+        for address, auto_assigned in (('192.168.0.100', False),
+                                       ('192.168.0.101', True)):
+            db.floating_ip_create(admin_ctxt,
+                                  {'address': address,
+                                   'project_id': self.project.id,
+                                   'auto_assigned': auto_assigned})
+        self.assertEqual(self._get_usages('floating_ips'), [(2, 0)])
+
+    def test_usages_created_concurrently(self):
+        self._create_instance(cores=2)
+        real_create = sqlalchemy_api._quota_usage_create
+
+        def racing_create(project_id, resource):
+            # another request inserts the row first
+            real_create(project_id, resource)
+            real_create(project_id, resource)
+
+        self.stubs.Set(sqlalchemy_api, '_quota_usage_create', racing_create)
+        self.assertEqual(self._get_usages('instances', 'cores'),
+                         [(1, 0), (2, 0)])
+        rows = get_session().query(models.QuotaUsage).\
+                             filter_by(project_id=self.project.id).\
+                             all()
+        self.assertEqual(sorted(row.resource for row in rows),
+                         ['cores', 'instances'])
+
+    def test_reserve_commit(self):
+        reservations = quota.reserve(self.context, instances=1, cores=2)
+        self.assertEqual(self._get_usages('instances', 'cores'),
+                         [(0, 1), (0, 2)])
+        quota.commit(self.context, reservations)
+        self.assertEqual(self._get_usages('instances', 'cores'),
+                         [(1, 0), (2, 0)])
+        # committing twice is a no-op
+        quota.commit(self.context, reservations)
+        self.assertEqual(self._get_usages('instances', 'cores'),
+                         [(1, 0), (2, 0)])
+
+    def test_reserve_rollback(self):
+        reservations = quota.reserve(self.context, instances=1, cores=2)
+        quota.rollback(self.context, reservations)
+        self.assertEqual(self._get_usages('instances', 'cores'),
+                         [(0, 0), (0, 0)])
+
+    def test_reserve_counts_pending_reservations(self):
+        quota.reserve(self.context, instances=1, cores=2)
+        quota.reserve(self.context, instances=1, cores=2)
+        self.assertRaises(exception.OverQuota, quota.reserve, self.context,
+                          instances=1, cores=1)
+        self.assertEqual(quota.allowed_instances(self.context, 1,
+                              self._get_instance_type('m1.tiny')), 0)
+
+    def test_release_applies_on_commit(self):
+        quota.commit(self.context, quota.reserve(self.context, instances=2))
+        reservations = quota.reserve(self.context, instances=-1)
+        self.assertRaises(exception.OverQuota, quota.reserve, self.context,
+                          instances=1)
+        quota.commit(self.context, reservations)
+        self.assertEqual(self._get_usages('instances'), [(1, 0)])
+
+    def test_expire_reservations(self):
+        self.flags(reservation_expire=-1)
+        quota.reserve(self.context, instances=1, cores=2)
+        quota.expire(self.context)
+        self.assertEqual(self._get_usages('instances', 'cores'),
+                         [(0, 0), (0, 0)])
+
+    def test_create_and_delete_track_usage(self):
+        FLAGS.image_service = 'nova.image.fake.FakeImageService'
+        api = compute.API(image_service=self.StubImageService())
+        inst_type = instance_types.get_instance_type_by_name('m1.small')
+        instances = api.create(self.context, instance_type=inst_type,
+                               image_href='3')
+        self.assertEqual(self._get_usages('instances', 'cores', 'ram'),
+                         [(1, 0), (1, 0), (inst_type['memory_mb'], 0)])
+        api.delete(self.context, instances[0]['id'])
+        self.assertEqual(self._get_usages('instances', 'cores', 'ram'),
+                         [(0, 0), (0, 0), (0, 0)])
+
+    def test_create_all_at_once_charges_scheduled_instances(self):
+        FLAGS.image_service = 'nova.image.fake.FakeImageService'
+        api = compute.API(image_service=self.StubImageService())
+        inst_type = instance_types.get_instance_type_by_name('m1.small')
+        casts = []
+        self.stubs.Set(rpc, 'cast', lambda *args: casts.append(args))
+        api.create_all_at_once(self.context, instance_type=inst_type,
+                               image_href='3', min_count=2, max_count=2)
+        self.assertEqual(self._get_usages('instances', 'cores'),
+                         [(0, 0), (0, 0)])
+
+        # the scheduler only builds one of them in this zone
+        request_spec = casts[0][2]['args']['request_spec']
+        api.create_db_entry_for_new_instance(self.context,
+                {'properties': {}}, request_spec['instance_properties'],
+                None, [])
+        self.assertEqual(self._get_usages('instances', 'cores'),
+                         [(1, 0), (1, 0)])
+
+    def test_quota_cache(self):
+        self.flags(quota_cache_ttl=3600)
+        self.stubs.Set(quota, '_QUOTA_CACHE', {})
+        now = time.time()
+        self.stubs.Set(time, 'time', lambda: now)
+        self.assertEqual(quota.allowed_floating_ips(self.context, 10), 1)
+        db.quota_create(self.context, self.project.id, 'floating_ips', 5)
+        self.assertEqual(quota.allowed_floating_ips(self.context, 10), 1)
+        now += 3600
+        self.assertEqual(quota.allowed_floating_ips(self.context, 10), 5)
+
     def test_too_many_metadata_items(self):
         metadata = {}
         for i in range(FLAGS.quota_metadata_items + 1):
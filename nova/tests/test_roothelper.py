@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+
+import eventlet
+
+from nova import exception
+from nova import roothelper
+from nova import test
+from nova import utils
+
+
+class RootHelperTestCase(test.TestCase):
+    def setUp(self):
+        super(RootHelperTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'roothelper.sock')
+        self.server = roothelper.RootHelperServer(path,
+                                                  ['echo', 'cat', 'false'])
+        self.sock = self.server.listen()
+        self.server_thread = eventlet.spawn(self._serve)
+        self.client = roothelper.RootHelperClient(path)
+        self.flags(root_helper_socket=path)
+
+    def _serve(self):
+        pool = eventlet.GreenPool()
+        while True:
+            conn, _addr = self.sock.accept()
+            pool.spawn_n(self.server.handle_connection, conn)
+
+    def tearDown(self):
+        self.client.close()
+        self.server_thread.kill()
+        self.sock.close()
+        shutil.rmtree(self.tmpdir)
+        roothelper._CLIENT = None
+        super(RootHelperTestCase, self).tearDown()
+
+    def test_execute(self):
+        self.assertEqual(self.client.execute(['echo', 'foo']),
+                         (0, 'foo\n', ''))
+        self.assertEqual(self.client.execute(['cat'], 'bar'),
+                         (0, 'bar', ''))
+
+    def test_refuses_unlisted_command(self):
+        self.assertRaises(roothelper.RootHelperError,
+                          self.client.execute, ['rm', '-rf', '/'])
+        # the connection is still usable afterwards
+        self.assertEqual(self.client.execute(['echo', 'ok'])[1], 'ok\n')
+
+    def test_pipelined_requests(self):
+        results = self.client.submit([([['echo', str(i)]], None)
+                                      for i in range(20)])
+        self.assertEqual([r[0][1] for r in results],
+                         ['%d\n' % i for i in range(20)])
+
+    def test_batch_stops_at_first_failure(self):
+        results = self.client.execute_batch([['echo', 'a'], ['false'],
+                                             ['echo', 'b']])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1][0], 1)
+
+    def test_refuses_input_for_batches(self):
+        self.assertRaises(roothelper.RootHelperError,
+                          self.client.submit,
+                          [([['cat'], ['cat']], 'twice')])
+
+    def test_unreachable_helper(self):
+        client = roothelper.RootHelperClient(os.path.join(self.tmpdir,
+                                                          'missing.sock'))
+        self.assertRaises(roothelper.RootHelperUnavailable,
+                          client.execute, ['echo', 'a'])
+
+    def _lose_connection_after_request(self):
+        handled = []
+
+        def handle_request(request):
+            handled.append(request)
+            raise socket.error('helper died')
+        self.server.handle_request = handle_request
+        return handled
+
+    def test_sent_request_is_not_resent(self):
+        handled = self._lose_connection_after_request()
+        self.assertRaises(roothelper.RootHelperConnectionLost,
+                          self.client.execute, ['echo', 'a'])
+        self.assertEqual(len(handled), 1)
+
+    def test_utils_execute_does_not_fall_back_after_send(self):
+        handled = self._lose_connection_after_request()
+        self.mox.StubOutWithMock(utils, '_popen')
+        self.mox.ReplayAll()
+        self.assertRaises(exception.ProcessExecutionError,
+                          utils.execute, 'sudo', 'echo', 'a', attempts=3)
+        self.assertEqual(len(handled), 1)
+
+    def test_reconnects_after_close(self):
+        self.client.execute(['echo', 'a'])
+        self.client._sock.close()
+        self.assertEqual(self.client.execute(['echo', 'b'])[1], 'b\n')
+
+    def test_utils_execute_uses_helper(self):
+        self.mox.StubOutWithMock(utils, '_popen')
+        self.mox.ReplayAll()
+        out, err = utils.execute('sudo', 'echo', 'via', 'helper')
+        self.assertEqual(out, 'via helper\n')
+        self.assertRaises(exception.ProcessExecutionError,
+                          utils.execute, 'sudo', 'false')
+
+    def test_utils_execute_batch(self):
+        results = utils.execute_batch(('sudo', 'echo', 'a'),
+                                      ('sudo', 'echo', 'b'))
+        self.assertEqual(results, [('a\n', ''), ('b\n', '')])
+        self.assertRaises(exception.ProcessExecutionError,
+                          utils.execute_batch, ('sudo', 'echo', 'a'),
+                          ('sudo', 'false'))
+
+    def test_utils_execute_falls_back_to_sudo(self):
+        self.mox.StubOutWithMock(utils, '_popen')
+        utils._popen(['sudo', 'uname'], None, None).AndReturn((0, ('x', '')))
+        self.mox.ReplayAll()
+        self.assertEqual(utils.execute('sudo', 'uname'), ('x', ''))
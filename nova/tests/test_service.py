@@ -32,6 +32,7 @@ from nova import service
 from nova import manager
 from nova import wsgi
 from nova.compute import manager as compute_manager
+from nova.scheduler import api as scheduler_api
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string("fake_manager", "nova.tests.test_service.FakeManager",
@@ -69,6 +70,59 @@ class ServiceManagerTestCase(test.TestCase):
         self.assertEqual(serv.test_method(), 'service')
 
 
+class SchedulerDependentManagerTestCase(test.TestCase):
+    """Test cases for capability updates sent to the Schedulers"""
+
+    def test_periodic_tasks_sends_full_then_deltas(self):
+        mgr = manager.SchedulerDependentManager(host='host1',
+                                                service_name='svc')
+        self.mox.StubOutWithMock(scheduler_api, 'update_service_capabilities')
+        scheduler_api.update_service_capabilities(None, 'svc', 'host1',
+                                                  dict(a=1, b=2, c=3),
+                                                  sequence=1)
+        scheduler_api.update_service_capabilities(None, 'svc', 'host1',
+                                                  dict(b=4, d=5),
+                                                  sequence=2, full=False,
+                                                  removed=['c'])
+        scheduler_api.update_service_capabilities(None, 'svc', 'host1', {},
+                                                  sequence=3, full=False,
+                                                  removed=[])
+        self.mox.ReplayAll()
+        mgr.update_service_capabilities(dict(a=1, b=2, c=3))
+        mgr.periodic_tasks()
+        mgr.update_service_capabilities(dict(a=1, b=4, d=5))
+        mgr.periodic_tasks()
+        mgr.periodic_tasks()
+
+    def test_periodic_tasks_sends_full_sync(self):
+        self.flags(capabilities_full_sync_interval=0)
+        mgr = manager.SchedulerDependentManager(host='host1',
+                                                service_name='svc')
+        self.mox.StubOutWithMock(scheduler_api, 'update_service_capabilities')
+        scheduler_api.update_service_capabilities(None, 'svc', 'host1',
+                                                  dict(a=1), sequence=1)
+        scheduler_api.update_service_capabilities(None, 'svc', 'host1',
+                                                  dict(a=1), sequence=2)
+        self.mox.ReplayAll()
+        mgr.update_service_capabilities(dict(a=1))
+        mgr.periodic_tasks()
+        mgr.periodic_tasks()
+
+    def test_resend_service_capabilities(self):
+        mgr = manager.SchedulerDependentManager(host='host1',
+                                                service_name='svc')
+        self.mox.StubOutWithMock(scheduler_api, 'update_service_capabilities')
+        scheduler_api.update_service_capabilities(None, 'svc', 'host1',
+                                                  dict(a=1), sequence=1)
+        scheduler_api.update_service_capabilities(None, 'svc', 'host1',
+                                                  dict(a=1), sequence=2)
+        self.mox.ReplayAll()
+        mgr.update_service_capabilities(dict(a=1))
+        mgr.periodic_tasks()
+        mgr.resend_service_capabilities()
+        mgr.periodic_tasks()
+
+
 class ServiceFlagsTestCase(test.TestCase):
     def test_service_enabled_on_create_based_on_flag(self):
         self.flags(enable_new_services=True)
@@ -0,0 +1,220 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import httplib
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+
+from nova import exception
+from nova import test
+from nova.virt import images
+
+
+class FakeResponse(StringIO.StringIO):
+
+    def __init__(self, status, data, content_range=None, ranges=False):
+        StringIO.StringIO.__init__(self, data)
+        self.status = status
+        self.content_range = content_range
+        self.ranges = ranges
+
+    def getheader(self, name, default=None):
+        if name == 'content-range' and self.content_range:
+            return self.content_range
+        if name == 'accept-ranges' and self.ranges:
+            return 'bytes'
+        return default
+
+
+class FakeGlanceServer(object):
+    """Serves ranges of an image, failing the ranges listed in broken and
+    answering the ones in whole with the whole image."""
+
+    def __init__(self, data, ranges=True):
+        self.data = data
+        self.ranges = ranges
+        self.head_status = httplib.OK
+        self.broken = set()
+        self.whole = set()
+        self.requests = []
+
+    def respond(self, method, byte_range):
+        if method == 'HEAD':
+            self.requests.append(method)
+            return FakeResponse(self.head_status, '', ranges=self.ranges)
+        self.requests.append(byte_range)
+        if not self.ranges or byte_range in self.whole:
+            return FakeResponse(httplib.OK, self.data)
+        if byte_range in self.broken:
+            raise socket.error('connection reset')
+        start, end = [int(i) for i in byte_range[6:].split('-')]
+        return FakeResponse(httplib.PARTIAL_CONTENT,
+                            self.data[start:end + 1],
+                            'bytes %d-%d/%d' % (start, end, len(self.data)))
+
+
+class FakeConnection(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.method = None
+        self.byte_range = None
+
+    def request(self, method, url, headers=None):
+        self.method = method
+        self.byte_range = (headers or {}).get('Range')
+
+    def getresponse(self):
+        return self.server.respond(self.method, self.byte_range)
+
+    def close(self):
+        pass
+
+
+class RangeFetcherTestCase(test.TestCase):
+
+    def setUp(self):
+        super(RangeFetcherTestCase, self).setUp()
+        self.flags(image_fetch_chunk_size=4, image_fetch_workers=3)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'image')
+        self.data = 'abcdefghijklmnopqrstuvwxyz'
+        self.server = FakeGlanceServer(self.data)
+        self.stubs.Set(images, '_connect',
+                       lambda host, port: FakeConnection(self.server))
+        self.stubs.Set(images, '_RANGE_SERVERS', {})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(RangeFetcherTestCase, self).tearDown()
+
+    def _fetcher(self, checksum=None):
+        metadata = {'size': len(self.data),
+                    'checksum': checksum or hashlib.md5(self.data).hexdigest()}
+        return images._RangeFetcher('glancehost', 9292, 1, metadata,
+                                    self.path)
+
+    def test_fetch_in_ranges(self):
+        self.assertTrue(self._fetcher().fetch())
+        self.assertEqual(open(self.path).read(), self.data)
+        self.assertEqual(len(self.server.requests), 7)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['image'])
+
+    def test_resume_after_interruption(self):
+        self.server.broken.add('bytes=12-15')
+        self.assertRaises(socket.error, self._fetcher().fetch)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(self.path + '.part'))
+
+        self.server.broken.clear()
+        self.server.requests = []
+        self.assertTrue(self._fetcher().fetch())
+        self.assertEqual(open(self.path).read(), self.data)
+        self.assertTrue('bytes=12-15' in self.server.requests)
+        self.assertFalse('bytes=0-3' in self.server.requests)
+
+    def test_checksum_mismatch(self):
+        self.assertRaises(exception.ImageUnacceptable,
+                          self._fetcher(checksum='bad').fetch)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_ranges_unsupported(self):
+        self.server.ranges = False
+        self.assertFalse(self._fetcher().fetch())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_ranges_refused_after_first_chunk(self):
+        self.server.whole.add('bytes=12-15')
+        self.assertFalse(self._fetcher().fetch())
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertFalse(images._serves_ranges('glancehost', 9292, 1))
+
+    def test_ranges_support_probed_once(self):
+        self.assertTrue(images._serves_ranges('glancehost', 9292, 1))
+        self.assertTrue(images._serves_ranges('glancehost', 9292, 2))
+        self.assertEqual(self.server.requests, ['HEAD'])
+
+        self.server.ranges = False
+        self.assertFalse(images._serves_ranges('otherhost', 9292, 1))
+        self.assertFalse(images._serves_ranges('otherhost', 9292, 1))
+        self.assertEqual(self.server.requests, ['HEAD', 'HEAD'])
+
+    def test_ranges_probe_failure_remembered(self):
+        self.server.head_status = httplib.NOT_FOUND
+        self.assertFalse(images._serves_ranges('glancehost', 9292, 1))
+        self.assertFalse(images._serves_ranges('glancehost', 9292, 2))
+        self.assertEqual(self.server.requests, ['HEAD'])
+
+    def test_ranges_refused_remembered(self):
+        images._RANGE_SERVERS[('glancehost', 9292)] = True
+        self.server.ranges = False
+        self.assertFalse(self._fetcher().fetch())
+        self.assertFalse(images._serves_ranges('glancehost', 9292, 1))
+
+
+class FakeImageService(object):
+
+    def __init__(self, data, metadata):
+        self.data = data
+        self.metadata = metadata
+
+    def get(self, context, image_id, image_file):
+        image_file.write(self.data[:10])
+        image_file.write(self.data[10:])
+        return self.metadata
+
+
+class StreamTestCase(test.TestCase):
+
+    def setUp(self):
+        super(StreamTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'image')
+        self.data = 'abcdefghijklmnopqrstuvwxyz'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(StreamTestCase, self).tearDown()
+
+    def _stream(self, **metadata):
+        image_service = FakeImageService(self.data, metadata)
+        return images._stream(image_service, None, 1, self.path, 'label')
+
+    def test_stream(self):
+        checksum = hashlib.md5(self.data).hexdigest()
+        metadata = self._stream(size=len(self.data), checksum=checksum)
+        self.assertEqual(metadata['checksum'], checksum)
+        self.assertEqual(open(self.path).read(), self.data)
+
+    def test_stream_without_checksum(self):
+        self._stream()
+        self.assertEqual(open(self.path).read(), self.data)
+
+    def test_stream_checksum_mismatch(self):
+        self.assertRaises(exception.ImageUnacceptable, self._stream,
+                          size=len(self.data), checksum='bad')
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_stream_truncated(self):
+        self.assertRaises(exception.ImageUnacceptable, self._stream,
+                          size=len(self.data) + 1)
+        self.assertEqual(os.listdir(self.tmpdir), [])
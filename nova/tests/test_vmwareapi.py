@@ -30,6 +30,8 @@ from nova.tests.vmwareapi import db_fakes
 from nova.tests.vmwareapi import stubs
 from nova.virt import vmwareapi_conn
 from nova.virt.vmwareapi import fake as vmwareapi_fake
+from nova.virt.vmwareapi import io_util
+from nova.virt.vmwareapi import vmware_images
 
 
 FLAGS = flags.FLAGS
@@ -265,3 +267,70 @@ class VMWareAPIVMTestCase(test.TestCase):
         Dummy callback function to be passed to suspend, resume, etc., calls.
         """
         pass
+
+
+class FakeTransferFile(object):
+    """Reads the given chunks, or collects what is written to it."""
+
+    def __init__(self, chunks=None):
+        self.chunks = list(chunks or [])
+        self.written = []
+
+    def read(self, chunk_size):
+        if self.chunks:
+            return self.chunks.pop(0)
+        return ""
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        pass
+
+
+class FakeGlanceUploadClient(object):
+    """Accepts an upload and reports the given image statuses after it."""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.uploaded = None
+
+    def update_image(self, image_id, image_meta=None, image_data=None):
+        self.uploaded = []
+        while True:
+            data = image_data.read(64)
+            if not data:
+                break
+            self.uploaded.append(data)
+
+    def get_image_meta(self, image_id):
+        return {'status': self.statuses.pop(0)}
+
+
+class VMWareAPITransferTestCase(test.TestCase):
+    """Unit tests for moving image data between VMware and glance."""
+
+    def test_transfer_to_datastore(self):
+        self.flags(vmwareapi_transfer_queue_size=2)
+        chunks = ['chunk%d' % i for i in range(20)]
+        reader = FakeTransferFile(chunks)
+        writer = FakeTransferFile()
+        size = len(''.join(chunks))
+        stats = vmware_images.start_transfer(reader, size,
+                                             write_file_handle=writer)
+        self.assertEqual(writer.written, chunks)
+        self.assertEqual(stats['bytes'], size)
+        self.assertTrue(stats['reader_waits'] > 0)
+
+    def test_transfer_to_glance_polls_until_active(self):
+        sleeps = []
+        self.stubs.Set(io_util.greenthread, 'sleep', sleeps.append)
+        chunks = ['chunk%d' % i for i in range(5)]
+        glance_client = FakeGlanceUploadClient(['saving', 'saving',
+                                                'saving', 'active'])
+        vmware_images.start_transfer(FakeTransferFile(chunks),
+                                     len(''.join(chunks)),
+                                     glance_client=glance_client,
+                                     image_id=1)
+        self.assertEqual(glance_client.uploaded, chunks)
+        self.assertEqual(sleeps, [.5, 1, 2])
@@ -19,6 +19,9 @@ Tests For ZoneManager
 import datetime
 import mox
 import novaclient
+import os
+import shutil
+import tempfile
 
 from nova import context
 from nova import db
@@ -373,3 +376,219 @@ class ZoneManagerTestCase(test.TestCase):
         utils.set_time_override(time_future)
         caps = zm.get_zone_capabilities(None)
         self.assertEquals(caps, {})
+        utils.clear_time_override()
+
+    def test_service_capabilities_delta(self):
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2, c=3),
+                                       sequence=1)
+        caps = zm.service_states["host1"]["svc1"]
+        zm.update_service_capabilities("svc1", "host1", dict(b=4),
+                                       sequence=2, full=False, removed=["c"])
+        self.assertTrue(zm.service_states["host1"]["svc1"] is caps)
+        self.assertEquals(zm.get_zone_capabilities(None),
+                          dict(svc1_a=(1, 1), svc1_b=(4, 4)))
+        self.assertEquals(zm.service_sequences[("host1", "svc1")], 2)
+
+    def _stub_full_update_requests(self):
+        requests = []
+
+        def fake_cast(context, topic, msg):
+            requests.append((topic, msg['method']))
+
+        self.stubs.Set(rpc, 'cast', fake_cast)
+        return requests
+
+    def test_service_capabilities_delta_without_full_update(self):
+        requests = self._stub_full_update_requests()
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("svc1", "host1", dict(a=1),
+                                       sequence=5, full=False, removed=[])
+        self.assertEquals(zm.service_states, {})
+        self.assertEquals(requests,
+                          [("svc1.host1", "resend_service_capabilities")])
+
+        # Asked once per periodic interval only.
+        zm.update_service_capabilities("svc1", "host1", dict(a=1),
+                                       sequence=6, full=False, removed=[])
+        self.assertEquals(len(requests), 1)
+
+        zm.update_service_capabilities("svc1", "host1", dict(a=1),
+                                       sequence=7)
+        self.assertEquals(zm.full_update_requests, {})
+        self.assertEquals(zm.get_zone_capabilities(None),
+                          dict(svc1_a=(1, 1)))
+
+    def test_service_capabilities_delta_after_missed_update(self):
+        requests = self._stub_full_update_requests()
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2),
+                                       sequence=1)
+        zm.update_service_capabilities("svc1", "host1", dict(a=3),
+                                       sequence=3, full=False, removed=[])
+        self.assertEquals(zm.service_states, {})
+        self.assertEquals(zm.get_zone_capabilities(None), {})
+        self.assertEquals(requests,
+                          [("svc1.host1", "resend_service_capabilities")])
+
+        zm.update_service_capabilities("svc1", "host1", dict(a=3, b=2),
+                                       sequence=4)
+        zm.update_service_capabilities("svc1", "host1", dict(b=5),
+                                       sequence=5, full=False, removed=[])
+        self.assertEquals(zm.get_zone_capabilities(None),
+                          dict(svc1_a=(3, 3), svc1_b=(5, 5)))
+        self.assertEquals(len(requests), 1)
+
+    def test_service_capabilities_delta_refreshes_timestamp(self):
+        zm = zone_manager.ZoneManager()
+        expiry_time = (FLAGS.periodic_interval * 3) + 1
+        zm.update_service_capabilities("svc1", "host1", dict(a=1),
+                                       sequence=1)
+        caps = zm.service_states["host1"]["svc1"]
+        caps["timestamp"] = utils.utcnow() - \
+                               datetime.timedelta(seconds=expiry_time)
+        self.assertTrue(zm.host_service_caps_stale("host1", "svc1"))
+        zm.update_service_capabilities("svc1", "host1", {},
+                                       sequence=2, full=False, removed=[])
+        self.assertFalse(zm.host_service_caps_stale("host1", "svc1"))
+
+    def test_get_host_list_shows_staleness(self):
+        zm = zone_manager.ZoneManager()
+        expiry_time = (FLAGS.periodic_interval * 3) + 1
+        zm.update_service_capabilities("svc1", "host1", dict(a=1))
+        zm.update_service_capabilities("svc1", "host2", dict(a=2))
+        old = utils.utcnow() - datetime.timedelta(seconds=expiry_time)
+        zm.service_states["host2"]["svc1"]["timestamp"] = old
+        hosts = dict((h["host_name"], h) for h in zm.get_host_list())
+        self.assertFalse(hosts["host1"]["stale"])
+        self.assertTrue(hosts["host2"]["stale"])
+        self.assertEquals(hosts["host2"]["updated_at"], old)
+
+    def test_expire_stale_host_services(self):
+        zm = zone_manager.ZoneManager()
+        expiry_time = (FLAGS.periodic_interval * 3) + 1
+        zm.update_service_capabilities("svc1", "host1", dict(a=1),
+                                       sequence=1)
+        zm.update_service_capabilities("svc1", "host2", dict(a=2),
+                                       sequence=1)
+        zm.service_states["host2"]["svc1"]["timestamp"] = utils.utcnow() - \
+                               datetime.timedelta(seconds=expiry_time)
+        zm.expire_stale_host_services()
+        self.assertEquals(zm.service_states.keys(), ["host1"])
+        self.assertEquals(zm.service_sequences.keys(), [("host1", "svc1")])
+
+    def test_snapshot_round_trip(self):
+        zm = zone_manager.ZoneManager()
+        expiry_time = (FLAGS.periodic_interval * 3) + 1
+        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2),
+                                       sequence=7)
+        zm.update_service_capabilities("svc1", "host2", dict(a=3, b=4))
+        zm.service_states["host2"]["svc1"]["timestamp"] = utils.utcnow() - \
+                               datetime.timedelta(seconds=expiry_time)
+        zone_state = zone_manager.ZoneState()
+        zone_state.update_credentials(FakeZone(id=1, api_url='http://foo.com',
+                                               username='user1',
+                                               password='pass1'))
+        zone_state.update_metadata(dict(name='child', x=1))
+        zm.zone_states[1] = zone_state
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'snapshot.json')
+            zm.save_snapshot(path)
+            restored = zone_manager.ZoneManager()
+            restored.load_snapshot(path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEquals(restored.get_zone_capabilities(None),
+                          dict(svc1_a=(1, 1), svc1_b=(2, 2)))
+        self.assertEquals(restored.service_sequences[("host1", "svc1")], 7)
+        self.assertFalse("host2" in restored.service_states)
+        self.assertEquals(restored.zone_states[1].to_dict(),
+                          zone_state.to_dict())
+        self.assertEquals(restored.zone_states[1].password, None)
+
+        # Deltas continue from the restored sequence.
+        restored.update_service_capabilities("svc1", "host1", dict(a=5),
+                                             sequence=8, full=False,
+                                             removed=[])
+        self.assertEquals(restored.get_zone_capabilities(None),
+                          dict(svc1_a=(5, 5), svc1_b=(2, 2)))
+
+    def test_load_snapshot_missing_file(self):
+        zm = zone_manager.ZoneManager()
+        zm.load_snapshot('/nonexistent/snapshot.json')
+        self.assertEquals(zm.service_states, {})
+        self.assertEquals(zm.zone_states, {})
+
+    def test_load_snapshot_malformed(self):
+        now = utils.isotime()
+        host = ["host1", "svc1", 1, now, dict(a=1)]
+        snapshots = [dict(saved_at=now, hosts=[host]),
+                     dict(saved_at=now, hosts=[host], zones=[dict(id=1)]),
+                     dict(saved_at=now, hosts=[host, ["host2"]], zones=[]),
+                     dict(saved_at=now, hosts=[host, None], zones=[]),
+                     []]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'snapshot.json')
+            for snapshot in snapshots:
+                with open(path, 'w') as f:
+                    f.write(utils.dumps(snapshot))
+                zm = zone_manager.ZoneManager()
+                zm.load_snapshot(path)
+                self.assertEquals(zm.service_states, {})
+                self.assertEquals(zm.service_sequences, {})
+                self.assertEquals(zm.zone_states, {})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_compute_hosts(self):
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("compute", "host1",
+                dict(host_memory_free=512, disk_available=10, arch="x86_64"))
+        zm.update_service_capabilities("compute", "host2",
+                dict(host_memory_free=2048, disk_available=5, arch="x86_64"))
+        zm.update_service_capabilities("compute", "host3",
+                dict(host_memory_free=4096, disk_available=40, arch="arm"))
+        zm.update_service_capabilities("volume", "host4",
+                dict(host_memory_free=8192, disk_available=80))
+
+        def hosts(*args):
+            return sorted(host for host, caps in zm.get_compute_hosts(*args))
+
+        self.assertEquals(hosts(1024, 0), ["host2", "host3"])
+        self.assertEquals(hosts(1024, 10), ["host3"])
+        self.assertEquals(hosts(0, 0, dict(arch="x86_64")),
+                          ["host1", "host2"])
+        self.assertEquals(hosts(1024, 0, dict(arch="x86_64")), ["host2"])
+        self.assertEquals(hosts(0, 0, dict(arch="sparc")), [])
+        self.assertEquals(hosts(0, 0, dict(arch=["x86_64"])), [])
+
+        # The indexes follow the capabilities as they change.
+        zm.update_service_capabilities("compute", "host3",
+                dict(host_memory_free=256, arch="x86_64"), sequence=2,
+                full=False, removed=["disk_available"])
+        self.assertEquals(hosts(1024, 0), ["host2"])
+        self.assertEquals(hosts(0, 0, dict(arch="x86_64")),
+                          ["host1", "host2"])
+        zm.delete_expired_host_services({"host2": ["compute"]})
+        self.assertEquals(hosts(1024, 0), [])
+        self.assertEquals(zm.capability_index.specs[("arch", "x86_64")],
+                          set(["host1", "host3"]))
+
+    def test_service_capabilities_rollup_follows_deltas(self):
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2),
+                                       sequence=1)
+        zm.update_service_capabilities("svc1", "host2", dict(a=5, b=6),
+                                       sequence=1)
+        zm.update_service_capabilities("svc1", "host1", dict(a=7),
+                                       sequence=2, full=False, removed=["b"])
+        self.assertEquals(zm.get_zone_capabilities(None),
+                          dict(svc1_a=(5, 7), svc1_b=(6, 6)))
+        zm.update_service_capabilities("svc1", "host2",
+                                       dict(a=5, b=6, enabled=False))
+        self.assertEquals(zm.get_zone_capabilities(None),
+                          dict(svc1_a=(7, 7)))
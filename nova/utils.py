@@ -46,6 +46,7 @@ from eventlet.green import subprocess
 from nova import exception
 from nova import flags
 from nova import log as logging
+from nova import roothelper
 from nova import version
 
 
@@ -126,6 +127,33 @@ def fetchfile(url, target):
     execute('curl', '--fail', url, '-o', target)
 
 
+def _popen(cmd, process_input, addl_env):
+    """Fork cmd, returning (returncode, (stdout, stderr))."""
+    env = os.environ.copy()
+    if addl_env:
+        env.update(addl_env)
+    _PIPE = subprocess.PIPE  # pylint: disable=E1101
+    obj = subprocess.Popen(cmd,
+                           stdin=_PIPE,
+                           stdout=_PIPE,
+                           stderr=_PIPE,
+                           env=env)
+    result = None
+    if process_input is not None:
+        result = obj.communicate(process_input)
+    else:
+        result = obj.communicate()
+    obj.stdin.close()  # pylint: disable=E1101
+    return obj.returncode, result  # pylint: disable=E1101
+
+
+def _get_root_helper(cmd):
+    """Return the root helper client if cmd can be sent to it."""
+    if len(cmd) < 2 or cmd[0] != 'sudo' or cmd[1].startswith('-'):
+        return None
+    return roothelper.get_client()
+
+
 def execute(*cmd, **kwargs):
     process_input = kwargs.pop('process_input', None)
     addl_env = kwargs.pop('addl_env', None)
@@ -136,27 +164,34 @@ def execute(*cmd, **kwargs):
         raise exception.Error(_('Got unknown keyword args '
                                 'to utils.execute: %r') % kwargs)
     cmd = map(str, cmd)
+    helper = _get_root_helper(cmd)
 
     while attempts > 0:
         attempts -= 1
         try:
-            LOG.debug(_('Running cmd (subprocess): %s'), ' '.join(cmd))
-            env = os.environ.copy()
-            if addl_env:
-                env.update(addl_env)
-            _PIPE = subprocess.PIPE  # pylint: disable=E1101
-            obj = subprocess.Popen(cmd,
-                                   stdin=_PIPE,
-                                   stdout=_PIPE,
-                                   stderr=_PIPE,
-                                   env=env)
-            result = None
-            if process_input is not None:
-                result = obj.communicate(process_input)
-            else:
-                result = obj.communicate()
-            obj.stdin.close()  # pylint: disable=E1101
-            _returncode = obj.returncode  # pylint: disable=E1101
+            _returncode = None
+            if helper is not None:
+                LOG.debug(_('Running cmd (roothelper): %s'), ' '.join(cmd))
+                try:
+                    _returncode, stdout, stderr = helper.execute(
+                                                    cmd[1:], process_input)
+                    result = (stdout, stderr)
+                except roothelper.RootHelperError, e:
+                    LOG.warn(_('nova-roothelper could not run %(cmd)s: '
+                               '%(e)s, falling back to sudo') %
+                             {'cmd': ' '.join(cmd), 'e': e})
+                    helper = None
+                except roothelper.RootHelperConnectionLost, e:
+                    # The command may have run, so it is not retried
+                    attempts = 0
+                    raise exception.ProcessExecutionError(
+                            stderr=str(e),
+                            cmd=' '.join(cmd),
+                            description=_('Lost nova-roothelper while it '
+                                          'ran the command'))
+            if helper is None:
+                LOG.debug(_('Running cmd (subprocess): %s'), ' '.join(cmd))
+                _returncode, result = _popen(cmd, process_input, addl_env)
             if _returncode:
                 LOG.debug(_('Result was %s') % _returncode)
                 if type(check_exit_code) == types.IntType \
@@ -182,6 +217,46 @@ def execute(*cmd, **kwargs):
             greenthread.sleep(0)
 
 
+def execute_batch(*cmds):
+    """Run several commands in order, stopping at the first failure.
+
+    When every command is a 'sudo' command and nova-roothelper is in use,
+    the whole batch is sent as a single request. Otherwise this is the
+    same as calling execute() for each command.
+
+    :param cmds: sequences of command arguments, as passed to execute()
+    :returns: a list of (stdout, stderr) for each command
+    :raises: ProcessExecutionError for the first command exiting non-zero
+
+    """
+    cmds = [map(str, cmd) for cmd in cmds]
+    helpers = [_get_root_helper(cmd) for cmd in cmds]
+    if cmds and None not in helpers:
+        LOG.debug(_('Running cmds (roothelper): %s'),
+                  '; '.join(' '.join(cmd) for cmd in cmds))
+        try:
+            results = helpers[0].execute_batch([cmd[1:] for cmd in cmds])
+        except roothelper.RootHelperError, e:
+            LOG.warn(_('nova-roothelper could not run batch: %s, falling '
+                       'back to sudo'), e)
+        except roothelper.RootHelperConnectionLost, e:
+            raise exception.ProcessExecutionError(
+                    stderr=str(e),
+                    cmd='; '.join(' '.join(cmd) for cmd in cmds),
+                    description=_('Lost nova-roothelper while it ran the '
+                                  'commands'))
+        else:
+            for cmd, (_returncode, stdout, stderr) in zip(cmds, results):
+                if _returncode:
+                    raise exception.ProcessExecutionError(
+                            exit_code=_returncode,
+                            stdout=stdout,
+                            stderr=stderr,
+                            cmd=' '.join(cmd))
+            return [(stdout, stderr) for _rc, stdout, stderr in results]
+    return [execute(*cmd) for cmd in cmds]
+
+
 def ssh_execute(ssh, cmd, process_input=None,
                 addl_env=None, check_exit_code=True):
     LOG.debug(_('Running cmd (SSH): %s'), ' '.join(cmd))
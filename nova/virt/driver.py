@@ -191,7 +191,7 @@ class ComputeDriver(object):
     def refresh_security_group_members(self, security_group_id):
         raise NotImplementedError()
 
-    def refresh_provider_fw_rules(self, security_group_id):
+    def refresh_provider_fw_rules(self, rules=None):
         """See: nova/virt/fake.py for docs."""
         raise NotImplementedError()
 
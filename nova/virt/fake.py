@@ -466,12 +466,13 @@ class FakeConnection(driver.ComputeDriver):
         """
         return True
 
-    def refresh_provider_fw_rules(self):
+    def refresh_provider_fw_rules(self, rules=None):
         """This triggers a firewall update based on database changes.
 
         When this is called, rules have either been added or removed from the
-        datastore.  You can retrieve rules with
-        :method:`nova.db.api.provider_fw_rule_get_all`.
+        datastore.  `rules` is the complete list of rules as dicts with
+        protocol, cidr, from_port and to_port keys; if it is None, retrieve
+        the rules with :method:`nova.db.api.provider_fw_rule_get_all`.
 
         Provider rules take precedence over security group rules.  If an IP
         would be allowed by a security group ingress rule, but blocked by
@@ -21,7 +21,15 @@
 Handling of VM disk images.
 """
 
+import hashlib
+import httplib
+import json
+import os
+
+from eventlet import greenpool
+
 from nova import context
+from nova import exception
 from nova import flags
 from nova.image import glance as glance_image_service
 import nova.image
@@ -30,16 +38,348 @@ from nova import utils
 
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('image_fetch_workers', 4,
+                     'number of range requests to download a glance image '
+                     'with in parallel, 1 streams it in a single request')
+flags.DEFINE_integer('image_fetch_chunk_size', 64 * 1024 * 1024,
+                     'bytes of a glance image fetched per range request')
 LOG = logging.getLogger('nova.virt.images')
 
+# bytes read from a response at a time
+READ_SIZE = 64 * 1024
+# tries at each chunk before the download gives up
+CHUNK_ATTEMPTS = 3
+# bytes streamed between progress reports when the size isn't known
+REPORT_SIZE = 256 * 1024 * 1024
+
+# { (<glance host>, <glance port>) : whether it serves ranges of images }
+_RANGE_SERVERS = {}
 
-def fetch(image_href, path, _user, _project):
+
+def fetch(image_href, path, _user, _project, instance_name=None):
     # TODO(vish): Improve context handling and add owner and auth data
     #             when it is added to glance.  Right now there is no
     #             auth checking in glance, so we assume that access was
     #             checked before we got here.
     (image_service, image_id) = nova.image.get_image_service(image_href)
-    with open(path, "wb") as image_file:
-        elevated = context.get_admin_context()
-        metadata = image_service.get(elevated, image_id, image_file)
+    elevated = context.get_admin_context()
+    if (FLAGS.image_fetch_workers > 1 and
+        isinstance(image_service, glance_image_service.GlanceImageService)):
+        glance_client, glance_id = nova.image.get_glance_client(image_href)
+        if _serves_ranges(glance_client.host, glance_client.port,
+                          glance_id):
+            metadata = image_service.show(elevated, image_id)
+            fetcher = _RangeFetcher(glance_client.host, glance_client.port,
+                                    glance_id, metadata, path,
+                                    instance_name)
+            if fetcher.fetch():
+                return metadata
+    return _stream(image_service, elevated, image_id, path,
+                   instance_name or path)
+
+
+def _connect(host, port):
+    return httplib.HTTPConnection(host, port)
+
+
+def _serves_ranges(host, port, image_id):
+    """Whether glance at host:port serves byte ranges of images.
+
+    Asked once per server, with a HEAD request for image_id looking for
+    an Accept-Ranges header, and remembered for the next fetches whatever
+    the answer was.
+
+    """
+    server = (host, port)
+    if server not in _RANGE_SERVERS:
+        connection = _connect(host, port)
+        try:
+            connection.request('HEAD', '/v1/images/%s' % image_id)
+            response = connection.getresponse()
+            response.read()
+        except (httplib.HTTPException, IOError), e:
+            LOG.debug(_('Could not ask glance at %(host)s:%(port)s about '
+                        'range requests: %(e)s'),
+                      {'host': host, 'port': port, 'e': e})
+            return False
+        finally:
+            connection.close()
+        accept_ranges = response.getheader('accept-ranges', '')
+        _RANGE_SERVERS[server] = (response.status == httplib.OK and
+                                  'bytes' in accept_ranges.split(','))
+    return _RANGE_SERVERS[server]
+
+
+def _stream(image_service, context, image_id, path, label):
+    """Download an image in a single request, checking its size and
+    checksum once it has all arrived."""
+    try:
+        with open(path, 'wb') as image_file:
+            writer = _StreamWriter(image_file, image_id, label)
+            metadata = image_service.get(context, image_id, writer)
+        writer.verify(metadata)
+    except Exception:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
     return metadata
+
+
+class _StreamWriter(object):
+    """File wrapper hashing and reporting on a streamed image."""
+
+    def __init__(self, image_file, image_id, label):
+        self.image_file = image_file
+        self.image_id = image_id
+        self.label = label
+        self.md5 = hashlib.md5()
+        self.written = 0
+
+    def write(self, data):
+        self.image_file.write(data)
+        self.md5.update(data)
+        reported = self.written / REPORT_SIZE
+        self.written += len(data)
+        if self.written / REPORT_SIZE > reported:
+            LOG.info(_('%(label)s: fetched %(mb)d MB of image '
+                       '%(image_id)s'),
+                     {'label': self.label,
+                      'mb': self.written / (1024 * 1024),
+                      'image_id': self.image_id})
+
+    def verify(self, metadata):
+        size = metadata.get('size')
+        checksum = metadata.get('checksum')
+        if size is not None and size != self.written:
+            reason = (_('got %(actual)d bytes, expected %(expected)d') %
+                      {'actual': self.written, 'expected': size})
+        elif checksum and self.md5.hexdigest() != checksum:
+            reason = (_('checksum %(actual)s does not match %(expected)s') %
+                      {'actual': self.md5.hexdigest(), 'expected': checksum})
+        else:
+            return
+        raise exception.ImageUnacceptable(image_id=self.image_id,
+                                          reason=reason)
+
+
+class _RangesUnsupported(Exception):
+    """Glance answered a range request with the whole image."""
+    pass
+
+
+class _RangeFetcher(object):
+    """Downloads a glance image in chunks with parallel range requests.
+
+    Chunks are written into a sparse file next to path as they arrive and
+    the ones done are recorded beside it, so an interrupted download picks
+    up where it stopped.  The checksum is updated as the run of finished
+    chunks at the front of the file grows.
+
+    """
+
+    def __init__(self, host, port, image_id, metadata, path,
+                 instance_name=None):
+        self.host = host
+        self.port = port
+        self.url = '/v1/images/%s' % image_id
+        self.image_id = image_id
+        self.size = metadata.get('size') or 0
+        self.checksum = metadata.get('checksum')
+        self.path = path
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.state'
+        self.label = instance_name or path
+        self.chunk_size = FLAGS.image_fetch_chunk_size
+        self.chunk_count = ((self.size + self.chunk_size - 1) /
+                            self.chunk_size)
+        self.done = set()
+        self.hashed = 0
+        self.md5 = hashlib.md5()
+        self.reported = 0
+        self.fd = None
+
+    def fetch(self):
+        """Download the image to path.
+
+        Returns False, having written nothing, if glance doesn't serve
+        ranges of the image.
+
+        """
+        if not self.size:
+            return False
+        self._load_state()
+        self.fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(self.fd, self.size)
+            self._hash_done_chunks()
+            pending = [chunk for chunk in xrange(self.chunk_count)
+                       if chunk not in self.done]
+            if pending:
+                try:
+                    connection = self._fetch_chunk(None, pending.pop(0))
+                    self._fetch_chunks(pending, connection)
+                except _RangesUnsupported:
+                    _RANGE_SERVERS[(self.host, self.port)] = False
+                    LOG.debug(_('Glance does not serve ranges of image '
+                                '%s, streaming it instead'), self.image_id)
+                    self._remove_files()
+                    return False
+        finally:
+            os.close(self.fd)
+
+        if self.checksum and self.md5.hexdigest() != self.checksum:
+            self._remove_files()
+            raise exception.ImageUnacceptable(image_id=self.image_id,
+                    reason=_('checksum %(actual)s does not match '
+                             '%(expected)s') %
+                           {'actual': self.md5.hexdigest(),
+                            'expected': self.checksum})
+        os.rename(self.part_path, self.path)
+        os.unlink(self.state_path)
+        return True
+
+    def _fetch_chunks(self, pending, connection):
+        errors = []
+        pool = greenpool.GreenPool(FLAGS.image_fetch_workers)
+        pool.spawn_n(self._worker, pending, connection, errors)
+        for i in xrange(FLAGS.image_fetch_workers - 1):
+            pool.spawn_n(self._worker, pending, None, errors)
+        pool.waitall()
+        if errors:
+            raise errors[0]
+
+    def _worker(self, pending, connection, errors):
+        try:
+            while pending:
+                connection = self._fetch_chunk(connection, pending.pop(0))
+        except Exception, e:
+            # stop the other workers, the download is left for a resume
+            # unless glance stopped serving ranges
+            if not isinstance(e, _RangesUnsupported):
+                LOG.exception(_('%(label)s: fetching image %(image_id)s '
+                                'failed'),
+                              {'label': self.label,
+                               'image_id': self.image_id})
+            errors.append(e)
+            del pending[:]
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _connect(self):
+        return _connect(self.host, self.port)
+
+    def _fetch_chunk(self, connection, chunk):
+        """Fetch chunk, returning the connection to use for the next one."""
+        for attempt in xrange(CHUNK_ATTEMPTS):
+            if connection is None:
+                connection = self._connect()
+            try:
+                self._read_chunk(connection, chunk)
+                break
+            except (httplib.HTTPException, IOError), e:
+                connection.close()
+                connection = None
+                if attempt == CHUNK_ATTEMPTS - 1:
+                    raise
+                LOG.warn(_('%(label)s: retrying chunk %(chunk)d of image '
+                           '%(image_id)s: %(e)s'),
+                         {'label': self.label, 'chunk': chunk,
+                          'image_id': self.image_id, 'e': e})
+        self._chunk_done(chunk)
+        return connection
+
+    def _read_chunk(self, connection, chunk):
+        start = chunk * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        connection.request('GET', self.url,
+                           headers={'Range': 'bytes=%d-%d' % (start, end)})
+        response = connection.getresponse()
+        if response.status == httplib.OK:
+            connection.close()
+            raise _RangesUnsupported()
+        content_range = response.getheader('content-range', '')
+        expected_range = 'bytes %d-%d/' % (start, end)
+        if (response.status != httplib.PARTIAL_CONTENT or
+            not content_range.startswith(expected_range)):
+            response.read()
+            raise httplib.HTTPException(_('Unexpected response %(status)s '
+                                          '%(content_range)s to range '
+                                          'request for %(url)s') %
+                                        {'status': response.status,
+                                         'content_range': content_range,
+                                         'url': self.url})
+        offset = start
+        while offset <= end:
+            data = response.read(min(READ_SIZE, end + 1 - offset))
+            if not data:
+                raise httplib.IncompleteRead('')
+            self._write(offset, data)
+            offset += len(data)
+
+    def _write(self, offset, data):
+        # there is no pwrite, but nothing here yields to another worker
+        # between the seek and the write
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def _chunk_done(self, chunk):
+        self.done.add(chunk)
+        self._hash_done_chunks()
+        self._save_state()
+        percent = len(self.done) * 100 / self.chunk_count
+        if percent >= self.reported + 10:
+            self.reported = percent - percent % 10
+            LOG.info(_('%(label)s: fetched %(percent)d%% of image '
+                       '%(image_id)s'),
+                     {'label': self.label, 'percent': percent,
+                      'image_id': self.image_id})
+
+    def _hash_done_chunks(self):
+        while self.hashed in self.done:
+            start = self.hashed * self.chunk_size
+            end = min(start + self.chunk_size, self.size)
+            os.lseek(self.fd, start, os.SEEK_SET)
+            while start < end:
+                data = os.read(self.fd, min(READ_SIZE, end - start))
+                self.md5.update(data)
+                start += len(data)
+            self.hashed += 1
+
+    def _state(self):
+        return {'size': self.size,
+                'checksum': self.checksum,
+                'chunk_size': self.chunk_size}
+
+    def _load_state(self):
+        if not os.path.exists(self.part_path):
+            return
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            state = {}
+        done = state.pop('done', [])
+        if state != self._state():
+            LOG.debug(_('Discarding partial download of image %s'),
+                      self.image_id)
+            self._remove_files()
+            return
+        self.done = set(done)
+        LOG.info(_('%(label)s: resuming download of image %(image_id)s '
+                   'with %(done)d of %(count)d chunks'),
+                 {'label': self.label, 'image_id': self.image_id,
+                  'done': len(self.done), 'count': self.chunk_count})
+
+    def _save_state(self):
+        state = self._state()
+        state['done'] = sorted(self.done)
+        with open(self.state_path + '.tmp', 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def _remove_files(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.unlink(path)
@@ -51,7 +51,9 @@ import uuid
 from xml.dom import minidom
 from xml.etree import ElementTree
 
+from eventlet import greenpool
 from eventlet import greenthread
+from eventlet import semaphore
 from eventlet import tpool
 
 from nova import context
@@ -102,6 +104,28 @@ flags.DEFINE_bool('allow_project_net_traffic',
 flags.DEFINE_bool('use_cow_images',
                   True,
                   'Whether to use cow images')
+flags.DEFINE_string('libvirt_cow_cluster_size', '2M',
+                    'Cluster size of the qcow2 overlays made over base '
+                    'images for instance disks')
+flags.DEFINE_string('libvirt_cow_preallocation', 'off',
+                    'Preallocation of the qcow2 overlays made for instance '
+                    'disks, off or metadata. metadata makes first writes '
+                    'cheaper but needs a qemu-img that allows it together '
+                    'with a backing file')
+# values of --libvirt_cow_preallocation qemu-img accepts for qcow2 overlays
+COW_PREALLOCATION_MODES = ('off', 'metadata')
+flags.DEFINE_integer('libvirt_domain_snapshot_ttl', 2,
+                     'Seconds the state of the running domains gathered by '
+                     'one periodic task is reused by the next, 0 to query '
+                     'libvirt every time')
+flags.DEFINE_integer('libvirt_call_threads', 8,
+                     'Most libvirt calls run at once in native threads, so '
+                     'a slow call only holds up the greenthread making it. '
+                     'Keep it below the eventlet thread pool size, '
+                     'EVENTLET_THREADPOOL_SIZE or 20. 0 makes the calls '
+                     'from the greenthreads')
+flags.DEFINE_integer('libvirt_slow_call_time', 10,
+                     'Seconds after which a libvirt call is logged as slow')
 flags.DEFINE_string('ajaxterm_portrange',
                     '10000-12000',
                     'Range of ports that ajaxterm should randomly try to bind')
@@ -153,18 +177,169 @@ def _late_load_cheetah():
         Template = t.Template
 
 
+_template_classes = {}
+
+
+def _compile_template(source):
+    """Return the Cheetah template class for source, compiling it only the
+    first time it is asked for."""
+    template_class = _template_classes.get(source)
+    if template_class is None:
+        _late_load_cheetah()
+        template_class = Template.compile(source=source)
+        _template_classes[source] = template_class
+    return template_class
+
+
+# Whether cp knows --reflink, until it turns out not to
+_cp_reflink = True
+
+
+def _copy_image(base, target):
+    """Copy base to target, sparsely and sharing its blocks where the
+    filesystem supports reflinks."""
+    global _cp_reflink
+    if _cp_reflink:
+        try:
+            utils.execute('cp', '--reflink=auto', '--sparse=always',
+                          base, target)
+            return
+        except exception.ProcessExecutionError, e:
+            # only an old cp that doesn't know the option is a reason to
+            # stop asking for reflinks, any other failure is the copy's
+            if 'reflink' not in (e.stderr or ''):
+                raise
+            LOG.debug(_('cp does not support --reflink, copying images '
+                        'without it'))
+            _cp_reflink = False
+    utils.execute('cp', '--sparse=always', base, target)
+
+
 def _strip_dev(mount_path):
         return re.sub(r'^/dev/', '', mount_path)
 
 
+def _call_catching(method, *args, **kwargs):
+    """Return (True, method's result) or (False, what it raised).
+
+    tpool prints a traceback for everything raised in its threads, and
+    libvirtError is routine, lookupByName raises it for a missing domain.
+
+    """
+    try:
+        return True, method(*args, **kwargs)
+    except Exception:
+        return False, sys.exc_info()
+
+
+class _LibvirtCallPool(object):
+    """Runs blocking libvirt calls in eventlet's native thread pool.
+
+    At most size calls run at once, later callers wait their turn without
+    blocking other greenthreads.  The pool counts the calls running and
+    waiting, and keeps the number, total and longest time of the calls of
+    each method.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._semaphore = semaphore.Semaphore(size)
+        self.in_flight = 0
+        self.waiting = 0
+        # method name -> (calls, total seconds, longest seconds)
+        self.calls = {}
+
+    def execute(self, name, method, *args, **kwargs):
+        if not self.size:
+            return method(*args, **kwargs)
+
+        self.waiting += 1
+        with self._semaphore:
+            self.waiting -= 1
+            self.in_flight += 1
+            start = time.time()
+            try:
+                succeeded, result = tpool.execute(_call_catching, method,
+                                                  *args, **kwargs)
+            finally:
+                self.in_flight -= 1
+                self._record(name, time.time() - start)
+
+        if not succeeded:
+            raise result[0], result[1], result[2]
+        return result
+
+    def _record(self, name, elapsed):
+        calls, total, longest = self.calls.get(name, (0, 0.0, 0.0))
+        self.calls[name] = (calls + 1, total + elapsed, max(longest, elapsed))
+        if elapsed >= FLAGS.libvirt_slow_call_time:
+            LOG.warn(_('libvirt %(name)s took %(elapsed).1f seconds, '
+                       '%(in_flight)d other calls running and %(waiting)d '
+                       'waiting'),
+                     {'name': name, 'elapsed': elapsed,
+                      'in_flight': self.in_flight, 'waiting': self.waiting})
+
+    def get_stats(self):
+        """Return the calls running and waiting and, for each method, the
+        number of calls and their average and longest time in seconds."""
+        methods = {}
+        for name, (calls, total, longest) in self.calls.iteritems():
+            methods[name] = {'calls': calls,
+                             'average': total / calls,
+                             'max': longest}
+        return {'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'methods': methods}
+
+
+class _LibvirtProxy(object):
+    """Makes the method calls of a libvirt object through a _LibvirtCallPool.
+
+    Objects of the libvirt module the calls return, like the virDomain
+    from lookupByName, come back wrapped in a proxy as well.
+
+    """
+
+    def __init__(self, obj, pool):
+        self._obj = obj
+        self._pool = pool
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = self._pool.execute(name, attr, *args, **kwargs)
+            if type(result).__module__ == 'libvirt':
+                result = _LibvirtProxy(result, self._pool)
+            return result
+        return call
+
+
 class LibvirtConnection(driver.ComputeDriver):
 
     def __init__(self, read_only):
         super(LibvirtConnection, self).__init__()
         self.libvirt_uri = self.get_uri()
+        if FLAGS.libvirt_cow_preallocation not in COW_PREALLOCATION_MODES:
+            raise exception.Error(_('Unsupported libvirt_cow_preallocation '
+                                    '%(mode)s, use one of %(modes)s') %
+                                  {'mode': FLAGS.libvirt_cow_preallocation,
+                                   'modes': ', '.join(
+                                       COW_PREALLOCATION_MODES)})
 
         self.libvirt_xml = open(FLAGS.libvirt_xml_template).read()
         self.cpuinfo_xml = open(FLAGS.cpuinfo_xml_template).read()
+        # instance name -> (digest of its xml_info, rendered xml)
+        self._rendered_xml = {}
+        # (time taken, [(name, domain.info())]) of the running domains
+        self._domain_snapshot = None
+        # bumped whenever the snapshot is dropped, so a walk of the domains
+        # that overlapped a state change does not store what it saw
+        self._domain_snapshot_generation = 0
+        self._call_pool = _LibvirtCallPool(FLAGS.libvirt_call_threads)
         self._wrapped_conn = None
         self.read_only = read_only
 
@@ -231,16 +406,54 @@ class LibvirtConnection(driver.ComputeDriver):
                 None]
 
         if read_only:
-            return libvirt.openReadOnly(uri)
+            conn = self._call_pool.execute('openReadOnly',
+                                           libvirt.openReadOnly, uri)
         else:
-            return libvirt.openAuth(uri, auth, 0)
+            conn = self._call_pool.execute('openAuth', libvirt.openAuth,
+                                           uri, auth, 0)
+        return _LibvirtProxy(conn, self._call_pool)
+
+    def _list_domains(self):
+        """Return the virDomain of every running domain."""
+        return [self._conn.lookupByID(domain_id)
+                for domain_id in self._conn.listDomainsID()]
+
+    def _get_domain_snapshot(self):
+        """Return (name, info) for every running domain.
+
+        The domains are only enumerated and asked for their info() once
+        every libvirt_domain_snapshot_ttl seconds, so the periodic tasks
+        polling instance states and host resources share one walk of the
+        domains instead of each making a few libvirt calls per domain.
+        Changing the state of a domain through this connection drops the
+        snapshot, and a walk that was under way at the time is returned
+        to its caller but not kept.
+
+        """
+        now = time.time()
+        if self._domain_snapshot is not None:
+            taken, records = self._domain_snapshot
+            if now - taken < FLAGS.libvirt_domain_snapshot_ttl:
+                return records
+
+        generation = self._domain_snapshot_generation
+        records = [(domain.name(), domain.info())
+                   for domain in self._list_domains()]
+        if generation == self._domain_snapshot_generation:
+            self._domain_snapshot = (now, records)
+        return records
+
+    def _invalidate_domain_snapshot(self):
+        self._domain_snapshot = None
+        self._domain_snapshot_generation += 1
 
     def list_instances(self):
-        return [self._conn.lookupByID(x).name()
-                for x in self._conn.listDomainsID()]
+        # Callers check whether an instance exists with this, so it
+        # always asks libvirt rather than using the snapshot.
+        return [domain.name() for domain in self._list_domains()]
 
-    def _map_to_instance_info(self, domain):
-        """Gets info from a virsh domain object into an InstanceInfo"""
+    def _map_to_instance_info(self, name, info):
+        """Gets a virsh domain's name and info() into an InstanceInfo"""
 
         # domain.info() returns a list of:
         #    state:       one of the state values (virDomainState)
@@ -249,18 +462,13 @@ class LibvirtConnection(driver.ComputeDriver):
         #    nbVirtCPU:   the number of virtual CPU
         #    puTime:      the time used by the domain in nanoseconds
 
-        (state, _max_mem, _mem, _num_cpu, _cpu_time) = domain.info()
-        name = domain.name()
+        (state, _max_mem, _mem, _num_cpu, _cpu_time) = info
 
         return driver.InstanceInfo(name, state)
 
     def list_instances_detail(self):
-        infos = []
-        for domain_id in self._conn.listDomainsID():
-            domain = self._conn.lookupByID(domain_id)
-            info = self._map_to_instance_info(domain)
-            infos.append(info)
-        return infos
+        return [self._map_to_instance_info(name, info)
+                for name, info in self._get_domain_snapshot()]
 
     def plug_vifs(self, instance, network_info):
         """Plugin VIFs into networks."""
@@ -269,6 +477,7 @@ class LibvirtConnection(driver.ComputeDriver):
 
     def destroy(self, instance, network_info, cleanup=True):
         instance_name = instance['name']
+        self._rendered_xml.pop(instance_name, None)
 
         try:
             virt_dom = self._lookup_by_name(instance_name)
@@ -297,6 +506,9 @@ class LibvirtConnection(driver.ComputeDriver):
                                   "Error=%(e)s") %
                                 locals())
                     raise
+            # only now, a snapshot taken while the domain was going down
+            # could still show it running
+            self._invalidate_domain_snapshot()
 
             try:
                 # NOTE(justinsb): We remove the domain definition. We probably
@@ -518,24 +730,28 @@ class LibvirtConnection(driver.ComputeDriver):
         """Pause VM instance"""
         dom = self._lookup_by_name(instance.name)
         dom.suspend()
+        self._invalidate_domain_snapshot()
 
     @exception.wrap_exception()
     def unpause(self, instance, callback):
         """Unpause paused VM instance"""
         dom = self._lookup_by_name(instance.name)
         dom.resume()
+        self._invalidate_domain_snapshot()
 
     @exception.wrap_exception()
     def suspend(self, instance, callback):
         """Suspend the specified instance"""
         dom = self._lookup_by_name(instance.name)
         dom.managedSave(0)
+        self._invalidate_domain_snapshot()
 
     @exception.wrap_exception()
     def resume(self, instance, callback):
         """resume the specified instance"""
         dom = self._lookup_by_name(instance.name)
         dom.create()
+        self._invalidate_domain_snapshot()
 
     @exception.wrap_exception()
     def rescue(self, instance, callback, network_info):
@@ -763,15 +979,44 @@ class LibvirtConnection(driver.ComputeDriver):
             call_if_not_exists(base, fn, *args, **kwargs)
 
             if cow:
+                options = ['cluster_size=%s' % FLAGS.libvirt_cow_cluster_size,
+                           'backing_file=%s' % base]
+                if FLAGS.libvirt_cow_preallocation != 'off':
+                    options.append('preallocation=%s' %
+                                   FLAGS.libvirt_cow_preallocation)
                 utils.execute('qemu-img', 'create', '-f', 'qcow2', '-o',
-                              'cluster_size=2M,backing_file=%s' % base,
-                              target)
+                              ','.join(options), target)
             else:
-                utils.execute('cp', base, target)
+                _copy_image(base, target)
 
-    def _fetch_image(self, target, image_id, user, project, size=None):
+    def _cache_images(self, images):
+        """Run _cache_image for each dict of arguments in images at once.
+
+        The images must not depend on each other.  Raises the first error
+        once they have all finished.
+        """
+        errors = []
+
+        def _cache(kwargs):
+            try:
+                self._cache_image(**kwargs)
+            except Exception, e:
+                LOG.exception(_('Caching image %s failed'),
+                              kwargs.get('target'))
+                errors.append(e)
+
+        pool = greenpool.GreenPool()
+        for kwargs in images:
+            pool.spawn_n(_cache, kwargs)
+        pool.waitall()
+        if errors:
+            raise errors[0]
+
+    def _fetch_image(self, target, image_id, user, project, size=None,
+                     instance_name=None):
         """Grab image and optionally attempt to resize it"""
-        images.fetch(image_id, target, user, project)
+        images.fetch(image_id, target, user, project,
+                     instance_name=instance_name)
         if size:
             disk.extend(target, size)
 
@@ -817,22 +1062,27 @@ class LibvirtConnection(driver.ComputeDriver):
                            'kernel_id': inst['kernel_id'],
                            'ramdisk_id': inst['ramdisk_id']}
 
+        # The disks don't depend on each other, so they are all fetched or
+        # copied at once.
+        disks = []
         if disk_images['kernel_id']:
             fname = '%08x' % int(disk_images['kernel_id'])
-            self._cache_image(fn=self._fetch_image,
+            disks.append(dict(fn=self._fetch_image,
                               target=basepath('kernel'),
                               fname=fname,
                               image_id=disk_images['kernel_id'],
                               user=user,
-                              project=project)
+                              project=project,
+                              instance_name=inst['name']))
             if disk_images['ramdisk_id']:
                 fname = '%08x' % int(disk_images['ramdisk_id'])
-                self._cache_image(fn=self._fetch_image,
+                disks.append(dict(fn=self._fetch_image,
                                   target=basepath('ramdisk'),
                                   fname=fname,
                                   image_id=disk_images['ramdisk_id'],
                                   user=user,
-                                  project=project)
+                                  project=project,
+                                  instance_name=inst['name']))
 
         root_fname = hashlib.sha1(disk_images['image_id']).hexdigest()
         size = FLAGS.minimum_root_size
@@ -845,22 +1095,25 @@ class LibvirtConnection(driver.ComputeDriver):
 
         if not self._volume_in_mapping(self.root_mount_device,
                                        block_device_mapping):
-            self._cache_image(fn=self._fetch_image,
+            disks.append(dict(fn=self._fetch_image,
                               target=basepath('disk'),
                               fname=root_fname,
                               cow=FLAGS.use_cow_images,
                               image_id=disk_images['image_id'],
                               user=user,
                               project=project,
-                              size=size)
+                              size=size,
+                              instance_name=inst['name']))
 
         if inst_type['local_gb'] and not self._volume_in_mapping(
             self.local_mount_device, block_device_mapping):
-            self._cache_image(fn=self._create_local,
+            disks.append(dict(fn=self._create_local,
                               target=basepath('disk.local'),
                               fname="local_%s" % inst_type['local_gb'],
                               cow=FLAGS.use_cow_images,
-                              local_gb=inst_type['local_gb'])
+                              local_gb=inst_type['local_gb']))
+
+        self._cache_images(disks)
 
         # For now, we assume that if we're not using a kernel, we're using a
         # partitioned disk image where the target partition is the first
@@ -911,9 +1164,10 @@ class LibvirtConnection(driver.ComputeDriver):
             nets.append(net_info)
 
         if have_injected_networks:
-            net = str(Template(ifc_template,
-                               searchList=[{'interfaces': nets,
-                                            'use_ipv6': FLAGS.use_ipv6}]))
+            template_class = _compile_template(ifc_template)
+            net = str(template_class(searchList=[{
+                    'interfaces': nets,
+                    'use_ipv6': FLAGS.use_ipv6}]))
 
         if key or net:
             inst_name = inst['name']
@@ -1024,11 +1278,19 @@ class LibvirtConnection(driver.ComputeDriver):
     def to_xml(self, instance, rescue=False, network_info=None,
                block_device_mapping=None):
         block_device_mapping = block_device_mapping or []
-        # TODO(termie): cache?
         LOG.debug(_('instance %s: starting toXML method'), instance['name'])
+        # xml_info is built every time, since that plugs the vifs, but the
+        # xml is only rendered again when xml_info has changed
         xml_info = self._prepare_xml_info(instance, rescue, network_info,
                                           block_device_mapping)
-        xml = str(Template(self.libvirt_xml, searchList=[xml_info]))
+        digest = hashlib.sha1(repr(xml_info)).hexdigest()
+        cached = self._rendered_xml.get(instance['name'])
+        if cached is not None and cached[0] == digest:
+            xml = cached[1]
+        else:
+            template_class = _compile_template(self.libvirt_xml)
+            xml = str(template_class(searchList=[xml_info]))
+            self._rendered_xml[instance['name']] = (digest, xml)
         LOG.debug(_('instance %s: finished toXML method'), instance['name'])
         return xml
 
@@ -1082,6 +1344,7 @@ class LibvirtConnection(driver.ComputeDriver):
             # createXML call creates a transient domain
             domain = self._conn.createXML(xml, launch_flags)
 
+        self._invalidate_domain_snapshot()
         return domain
 
     def get_diagnostics(self, instance_name):
@@ -1223,11 +1486,8 @@ class LibvirtConnection(driver.ComputeDriver):
 
         """
 
-        total = 0
-        for dom_id in self._conn.listDomainsID():
-            dom = self._conn.lookupByID(dom_id)
-            total += len(dom.vcpus()[1])
-        return total
+        # nbVirtCPU of domain.info(), see _map_to_instance_info
+        return sum(info[3] for _name, info in self._get_domain_snapshot())
 
     def get_memory_mb_used(self):
         """Get the free memory size(MB) of physical computer.
@@ -1376,8 +1636,8 @@ class LibvirtConnection(driver.ComputeDriver):
     def refresh_security_group_members(self, security_group_id):
         self.firewall_driver.refresh_security_group_members(security_group_id)
 
-    def refresh_provider_fw_rules(self):
-        self.firewall_driver.refresh_provider_fw_rules()
+    def refresh_provider_fw_rules(self, rules=None):
+        self.firewall_driver.refresh_provider_fw_rules(rules=rules)
 
     def update_available_resource(self, ctxt, host):
         """Updates compute manager resource info on ComputeNode table.
@@ -1432,7 +1692,7 @@ class LibvirtConnection(driver.ComputeDriver):
 
         LOG.info(_('Instance launched has CPU info:\n%s') % cpu_info)
         dic = utils.loads(cpu_info)
-        xml = str(Template(self.cpuinfo_xml, searchList=dic))
+        xml = str(_compile_template(self.cpuinfo_xml)(searchList=dic))
         LOG.info(_('to xml...\n:%s ' % xml))
 
         u = "http://libvirt.org/html/libvirt-libvirt.html#virCPUCompareResult"
@@ -17,9 +17,6 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-
-from eventlet import tpool
-
 from nova import context
 from nova import db
 from nova import flags
@@ -30,6 +27,9 @@ from nova.virt.libvirt import netutils
 
 LOG = logging.getLogger("nova.virt.libvirt.firewall")
 FLAGS = flags.FLAGS
+flags.DEFINE_bool('use_ipset', False,
+                  'Use ipsets to match traffic from instances of security '
+                  'groups that are granted access by another group')
 
 
 try:
@@ -76,11 +76,12 @@ class FirewallDriver(object):
         the security group."""
         raise NotImplementedError()
 
-    def refresh_provider_fw_rules(self):
-        """Refresh common rules for all hosts/instances from data store.
+    def refresh_provider_fw_rules(self, rules=None):
+        """Refresh common rules for all hosts/instances.
 
         Gets called when a rule has been added to or removed from
-        the list of rules (via admin api).
+        the list of rules (via admin api). The rules come in as a list
+        of dicts, or are read from the data store if rules is None.
 
         """
         raise NotImplementedError()
@@ -297,8 +298,7 @@ class NWFilterFirewall(FirewallDriver):
     def _define_filter(self, xml):
         if callable(xml):
             xml = xml()
-        # execute in a native thread and block current greenthread until done
-        tpool.execute(self._conn.nwfilterDefineXML, xml)
+        self._conn.nwfilterDefineXML(xml)
 
     def unfilter_instance(self, instance, network_info=None):
         """Clear out the nwfilter rules."""
@@ -407,7 +407,7 @@ class NWFilterFirewall(FirewallDriver):
         return self._define_filter(
                    self.security_group_to_nwfilter_xml(security_group_id))
 
-    def refresh_provider_fw_rules(self):
+    def refresh_provider_fw_rules(self, rules=None):
         """Update rules for all instances.
 
         This is part of the FirewallDriver API and is called when the
@@ -417,7 +417,7 @@ class NWFilterFirewall(FirewallDriver):
         by changing that filter we update them all.
 
         """
-        xml = self.provider_fw_to_nwfilter_xml()
+        xml = self.provider_fw_to_nwfilter_xml(rules)
         return self._define_filter(xml)
 
     def security_group_to_nwfilter_xml(self, security_group_id):
@@ -458,33 +458,34 @@ class NWFilterFirewall(FirewallDriver):
             xml += "chain='ipv4'>%s</filter>" % rule_xml
         return xml
 
-    def provider_fw_to_nwfilter_xml(self):
+    def provider_fw_to_nwfilter_xml(self, rules=None):
         """Compose a filter of drop rules from specified cidrs."""
         rule_xml = ""
         v6protocol = {'tcp': 'tcp-ipv6', 'udp': 'udp-ipv6', 'icmp': 'icmpv6'}
-        rules = db.provider_fw_rule_get_all(context.get_admin_context())
+        if rules is None:
+            rules = db.provider_fw_rule_get_all(context.get_admin_context())
         for rule in rules:
             rule_xml += "<rule action='block' direction='in' priority='150'>"
-            version = netutils.get_ip_version(rule.cidr)
+            version = netutils.get_ip_version(rule['cidr'])
             if(FLAGS.use_ipv6 and version == 6):
-                net, prefixlen = netutils.get_net_and_prefixlen(rule.cidr)
+                net, prefixlen = netutils.get_net_and_prefixlen(rule['cidr'])
                 rule_xml += "<%s srcipaddr='%s' srcipmask='%s' " % \
-                            (v6protocol[rule.protocol], net, prefixlen)
+                            (v6protocol[rule['protocol']], net, prefixlen)
             else:
-                net, mask = netutils.get_net_and_mask(rule.cidr)
+                net, mask = netutils.get_net_and_mask(rule['cidr'])
                 rule_xml += "<%s srcipaddr='%s' srcipmask='%s' " % \
-                            (rule.protocol, net, mask)
-            if rule.protocol in ['tcp', 'udp']:
+                            (rule['protocol'], net, mask)
+            if rule['protocol'] in ['tcp', 'udp']:
                 rule_xml += "dstportstart='%s' dstportend='%s' " % \
-                            (rule.from_port, rule.to_port)
-            elif rule.protocol == 'icmp':
+                            (rule['from_port'], rule['to_port'])
+            elif rule['protocol'] == 'icmp':
                 LOG.info('rule.protocol: %r, rule.from_port: %r, '
-                         'rule.to_port: %r', rule.protocol,
-                         rule.from_port, rule.to_port)
-                if rule.from_port != -1:
-                    rule_xml += "type='%s' " % rule.from_port
-                if rule.to_port != -1:
-                    rule_xml += "code='%s' " % rule.to_port
+                         'rule.to_port: %r', rule['protocol'],
+                         rule['from_port'], rule['to_port'])
+                if rule['from_port'] != -1:
+                    rule_xml += "type='%s' " % rule['from_port']
+                if rule['to_port'] != -1:
+                    rule_xml += "code='%s' " % rule['to_port']
 
                 rule_xml += '/>\n'
             rule_xml += "</rule>\n"
@@ -521,6 +522,21 @@ class IptablesFirewallDriver(FirewallDriver):
         from nova.network import linux_net
         self.iptables = linux_net.iptables_manager
         self.instances = {}
+        # security group id -> set of instance ids filtered on this host
+        self.security_group_instances = {}
+        # instance id -> list of security group ids it was filtered with
+        self.instance_security_groups = {}
+        # security group id -> (ipv4_rules, ipv6_rules) compiled from its rules
+        self.security_group_rules = {}
+        # security group id -> ids of the groups its rules grant access to
+        self.security_group_sources = {}
+        # granted group id -> {ip version: member addresses in its ipset}
+        self.ipsets = {}
+        # granted group id -> ids of the groups whose rules use its ipset
+        self.ipset_users = {}
+        # ipsets no longer used, destroyed once iptables stops using them
+        self.stale_ipsets = set()
+        self._execute = execute or linux_net._execute
         self.nwfilter = NWFilterFirewall(kwargs['get_connection'])
         self.basicly_filtered = False
 
@@ -547,6 +563,7 @@ class IptablesFirewallDriver(FirewallDriver):
         if self.instances.pop(instance['id'], None):
             self.remove_filters_for_instance(instance)
             self.iptables.apply()
+            self._destroy_stale_ipsets()
             self.nwfilter.unfilter_instance(instance, network_info)
         else:
             LOG.info(_('Attempted to unfilter instance %s which is not '
@@ -558,6 +575,7 @@ class IptablesFirewallDriver(FirewallDriver):
         self.instances[instance['id']] = instance
         self.add_filters_for_instance(instance, network_info)
         self.iptables.apply()
+        self._destroy_stale_ipsets()
 
     def _create_filter(self, ips, chain_name):
         return ['-d %s -j $%s' % (ip, chain_name) for ip in ips]
@@ -591,7 +609,17 @@ class IptablesFirewallDriver(FirewallDriver):
         ipv4_rules, ipv6_rules = self._filters_for_instance(chain_name,
                                                             network_info)
         self._add_filters('local', ipv4_rules, ipv6_rules)
-        ipv4_rules, ipv6_rules = self.instance_rules(instance, network_info)
+
+        ctxt = context.get_admin_context()
+        security_groups = db.security_group_get_by_instance(ctxt,
+                                                            instance['id'])
+        security_group_ids = [group['id'] for group in security_groups]
+        self._index_instance(instance['id'], security_group_ids)
+        for security_group_id in security_group_ids:
+            self._add_security_group_chain(security_group_id)
+
+        ipv4_rules, ipv6_rules = self.instance_rules(instance, network_info,
+                                                     security_groups)
         self._add_filters(chain_name, ipv4_rules, ipv6_rules)
 
     def remove_filters_for_instance(self, instance):
@@ -601,7 +629,268 @@ class IptablesFirewallDriver(FirewallDriver):
         if FLAGS.use_ipv6:
             self.iptables.ipv6['filter'].remove_chain(chain_name)
 
-    def instance_rules(self, instance, network_info=None):
+        self._unindex_instance(instance['id'])
+
+    def _index_instance(self, instance_id, security_group_ids):
+        """Record which security groups an instance is filtered with.
+
+        Groups the instance has left since it was last indexed lose it as
+        a member, and their chains go away once nobody uses them.
+
+        """
+        previous = self.instance_security_groups.get(instance_id, [])
+        for security_group_id in previous:
+            if security_group_id not in security_group_ids:
+                self._release_security_group(security_group_id, instance_id)
+
+        self.instance_security_groups[instance_id] = security_group_ids
+        for security_group_id in security_group_ids:
+            members = self.security_group_instances.setdefault(
+                    security_group_id, set())
+            members.add(instance_id)
+
+    def _unindex_instance(self, instance_id):
+        security_group_ids = self.instance_security_groups.pop(instance_id,
+                                                               [])
+        for security_group_id in security_group_ids:
+            self._release_security_group(security_group_id, instance_id)
+
+    def _release_security_group(self, security_group_id, instance_id):
+        members = self.security_group_instances.get(security_group_id)
+        if members is None:
+            return
+        members.discard(instance_id)
+        if not members:
+            del self.security_group_instances[security_group_id]
+            self.security_group_rules.pop(security_group_id, None)
+            self._remove_security_group_chain(security_group_id)
+            self._set_security_group_sources(security_group_id, set())
+
+    def _add_security_group_chain(self, security_group_id):
+        """Make sure the shared chain for a security group exists.
+
+        The chain is only filled in the first time it is needed on this
+        host; instances joining a group that already has a chain just
+        jump to it.
+
+        """
+        if security_group_id in self.security_group_rules:
+            return
+        self._compile_security_group(security_group_id)
+        chain_name = self._security_group_chain_name(security_group_id)
+        self.iptables.ipv4['filter'].add_chain(chain_name)
+        if FLAGS.use_ipv6:
+            self.iptables.ipv6['filter'].add_chain(chain_name)
+        self._fill_security_group_chain(security_group_id)
+
+    def _remove_security_group_chain(self, security_group_id):
+        chain_name = self._security_group_chain_name(security_group_id)
+        self.iptables.ipv4['filter'].remove_chain(chain_name)
+        if FLAGS.use_ipv6:
+            self.iptables.ipv6['filter'].remove_chain(chain_name)
+
+    def _fill_security_group_chain(self, security_group_id):
+        """Replace the contents of a group chain with its compiled rules."""
+        chain_name = self._security_group_chain_name(security_group_id)
+        self.iptables.ipv4['filter'].empty_chain(chain_name)
+        if FLAGS.use_ipv6:
+            self.iptables.ipv6['filter'].empty_chain(chain_name)
+        ipv4_rules, ipv6_rules = self.security_group_rules[security_group_id]
+        self._add_filters(chain_name, ipv4_rules, ipv6_rules)
+
+    def _compile_security_group(self, security_group_id):
+        """Compile the rules of a security group and cache the result.
+
+        Any group the rules grant access to gets an ipset holding the
+        addresses of its members before the rules referencing it are
+        handed to iptables.
+
+        """
+        ipv4_rules, ipv6_rules, source_ids = \
+                self._compile_security_group_rules(security_group_id)
+        self._set_security_group_sources(security_group_id, source_ids)
+        self.security_group_rules[security_group_id] = (ipv4_rules,
+                                                        ipv6_rules)
+
+    def _compile_security_group_rules(self, security_group_id):
+        """Turn the rules of a security group into iptables rules.
+
+        Returns the ipv4 rules, the ipv6 rules and the ids of the groups
+        that are granted access through an ipset.
+
+        """
+        ctxt = context.get_admin_context()
+        rules = db.security_group_rule_get_by_security_group(ctxt,
+                                                             security_group_id)
+
+        ipv4_rules = []
+        ipv6_rules = []
+        source_ids = set()
+        for rule in rules:
+            LOG.debug(_('Adding security group rule: %r'), rule)
+
+            if rule.cidr:
+                version = netutils.get_ip_version(rule.cidr)
+                sources = [(version, ['-s', rule.cidr])]
+            elif rule.group_id and FLAGS.use_ipset:
+                source_ids.add(rule.group_id)
+                sources = [(version,
+                            ['-m', 'set', '--match-set',
+                             self._ipset_name(rule.group_id, version), 'src'])
+                           for version in self._ipset_versions()]
+            else:
+                # Without ipsets there is no way to match the members
+                # of the granted group.
+                continue
+
+            for version, source_args in sources:
+                if version == 4:
+                    fw_rules = ipv4_rules
+                else:
+                    fw_rules = ipv6_rules
+                fw_rules += [' '.join(self._rule_args(rule, version,
+                                                      source_args))]
+
+        return ipv4_rules, ipv6_rules, source_ids
+
+    def _rule_args(self, rule, version, source_args):
+        protocol = rule.protocol
+        if version == 6 and rule.protocol == 'icmp':
+            protocol = 'icmpv6'
+
+        args = ['-p', protocol] + source_args
+
+        if rule.protocol in ['udp', 'tcp']:
+            if rule.from_port == rule.to_port:
+                args += ['--dport', '%s' % (rule.from_port,)]
+            else:
+                args += ['-m', 'multiport',
+                         '--dports', '%s:%s' % (rule.from_port,
+                                                rule.to_port)]
+        elif rule.protocol == 'icmp':
+            icmp_type = rule.from_port
+            icmp_code = rule.to_port
+
+            if icmp_type == -1:
+                icmp_type_arg = None
+            else:
+                icmp_type_arg = '%s' % icmp_type
+                if not icmp_code == -1:
+                    icmp_type_arg += '/%s' % icmp_code
+
+            if icmp_type_arg:
+                if version == 4:
+                    args += ['-m', 'icmp', '--icmp-type',
+                             icmp_type_arg]
+                elif version == 6:
+                    args += ['-m', 'icmp6', '--icmpv6-type',
+                             icmp_type_arg]
+
+        args += ['-j ACCEPT']
+        return args
+
+    def _ipset_name(self, security_group_id, version):
+        return 'nova-sg-%s-v%s' % (security_group_id, version)
+
+    def _ipset_versions(self):
+        if FLAGS.use_ipv6:
+            return [4, 6]
+        return [4]
+
+    def _set_security_group_sources(self, security_group_id, source_ids):
+        """Track which ipsets the rules of a security group use.
+
+        ipsets are created when the first group starts using them. Once
+        no group uses an ipset anymore it is marked stale, to be destroyed
+        after the next iptables apply.
+
+        """
+        previous = self.security_group_sources.pop(security_group_id, set())
+        for source_id in source_ids:
+            users = self.ipset_users.setdefault(source_id, set())
+            if source_id not in self.ipsets:
+                self._create_ipset(source_id)
+            else:
+                # Recompiling a group is also the time to catch up on
+                # membership changes whose refresh never made it here.
+                self._sync_ipset(source_id)
+            users.add(security_group_id)
+
+        for source_id in previous - source_ids:
+            users = self.ipset_users.get(source_id, set())
+            users.discard(security_group_id)
+            if not users:
+                self.ipset_users.pop(source_id, None)
+                self.ipsets.pop(source_id, None)
+                self.stale_ipsets.add(source_id)
+
+        if source_ids:
+            self.security_group_sources[security_group_id] = source_ids
+
+    def _security_group_member_addresses(self, security_group_id):
+        """Return {ip version: addresses} of the members of a group."""
+        ctxt = context.get_admin_context()
+        fixed_ips = db.fixed_ip_get_by_security_group(ctxt,
+                                                      security_group_id)
+        members = {4: set(fixed_ip['address'] for fixed_ip in fixed_ips),
+                   6: set()}
+        if FLAGS.use_ipv6:
+            instance_ids = set(fixed_ip['instance_id']
+                               for fixed_ip in fixed_ips)
+            for instance_id in instance_ids:
+                members[6].update(
+                        db.instance_get_fixed_addresses_v6(ctxt, instance_id))
+        return members
+
+    def _restore_ipsets(self, commands):
+        """Run ipset commands in one go through ipset restore."""
+        if commands:
+            self._execute('sudo', 'ipset', 'restore', '-exist',
+                          process_input='\n'.join(commands) + '\n')
+
+    def _create_ipset(self, security_group_id):
+        members = self._security_group_member_addresses(security_group_id)
+        commands = []
+        for version in self._ipset_versions():
+            name = self._ipset_name(security_group_id, version)
+            family = version == 4 and 'inet' or 'inet6'
+            commands.append('create %s hash:ip family %s' % (name, family))
+            # The set may be left over from a previous run
+            commands.append('flush %s' % name)
+            commands += ['add %s %s' % (name, address)
+                         for address in sorted(members[version])]
+        self._restore_ipsets(commands)
+        self.ipsets[security_group_id] = members
+        self.stale_ipsets.discard(security_group_id)
+
+    def _sync_ipset(self, security_group_id):
+        """Add and delete the addresses that joined or left a group."""
+        old_members = self.ipsets[security_group_id]
+        members = self._security_group_member_addresses(security_group_id)
+        commands = []
+        for version in self._ipset_versions():
+            name = self._ipset_name(security_group_id, version)
+            commands += ['add %s %s' % (name, address)
+                         for address in sorted(members[version] -
+                                               old_members[version])]
+            commands += ['del %s %s' % (name, address)
+                         for address in sorted(old_members[version] -
+                                               members[version])]
+        self._restore_ipsets(commands)
+        self.ipsets[security_group_id] = members
+
+    def _destroy_stale_ipsets(self):
+        for security_group_id in self.stale_ipsets:
+            if security_group_id in self.ipsets:
+                continue
+            for version in self._ipset_versions():
+                self._execute('sudo', 'ipset', 'destroy',
+                              self._ipset_name(security_group_id, version),
+                              check_exit_code=False)
+        self.stale_ipsets.clear()
+
+    def instance_rules(self, instance, network_info=None,
+                       security_groups=None):
         if not network_info:
             network_info = netutils.get_network_info(instance)
         ctxt = context.get_admin_context()
@@ -652,62 +941,17 @@ class IptablesFirewallDriver(FirewallDriver):
                 for cidrv6 in cidrv6s:
                     ipv6_rules.append('-s %s -j ACCEPT' % (cidrv6,))
 
-        security_groups = db.security_group_get_by_instance(ctxt,
-                                                            instance['id'])
+        if security_groups is None:
+            security_groups = db.security_group_get_by_instance(
+                    ctxt, instance['id'])
 
-        # then, security group chains and rules
+        # then, jump to the shared chain of each security group. The rules
+        # themselves live there so that a rule change only touches one
+        # chain no matter how many instances are in the group.
         for security_group in security_groups:
-            rules = db.security_group_rule_get_by_security_group(ctxt,
-                                                          security_group['id'])
-
-            for rule in rules:
-                LOG.debug(_('Adding security group rule: %r'), rule)
-
-                if not rule.cidr:
-                    # Eventually, a mechanism to grant access for security
-                    # groups will turn up here. It'll use ipsets.
-                    continue
-
-                version = netutils.get_ip_version(rule.cidr)
-                if version == 4:
-                    fw_rules = ipv4_rules
-                else:
-                    fw_rules = ipv6_rules
-
-                protocol = rule.protocol
-                if version == 6 and rule.protocol == 'icmp':
-                    protocol = 'icmpv6'
-
-                args = ['-p', protocol, '-s', rule.cidr]
-
-                if rule.protocol in ['udp', 'tcp']:
-                    if rule.from_port == rule.to_port:
-                        args += ['--dport', '%s' % (rule.from_port,)]
-                    else:
-                        args += ['-m', 'multiport',
-                                 '--dports', '%s:%s' % (rule.from_port,
-                                                        rule.to_port)]
-                elif rule.protocol == 'icmp':
-                    icmp_type = rule.from_port
-                    icmp_code = rule.to_port
-
-                    if icmp_type == -1:
-                        icmp_type_arg = None
-                    else:
-                        icmp_type_arg = '%s' % icmp_type
-                        if not icmp_code == -1:
-                            icmp_type_arg += '/%s' % icmp_code
-
-                    if icmp_type_arg:
-                        if version == 4:
-                            args += ['-m', 'icmp', '--icmp-type',
-                                     icmp_type_arg]
-                        elif version == 6:
-                            args += ['-m', 'icmp6', '--icmpv6-type',
-                                     icmp_type_arg]
-
-                args += ['-j ACCEPT']
-                fw_rules += [' '.join(args)]
+            chain_name = self._security_group_chain_name(security_group['id'])
+            ipv4_rules += ['-j $%s' % (chain_name,)]
+            ipv6_rules += ['-j $%s' % (chain_name,)]
 
         ipv4_rules += ['-j $sg-fallback']
         ipv6_rules += ['-j $sg-fallback']
@@ -719,32 +963,52 @@ class IptablesFirewallDriver(FirewallDriver):
         return self.nwfilter.instance_filter_exists(instance)
 
     def refresh_security_group_members(self, security_group):
-        pass
+        self.do_refresh_security_group_members(security_group)
+
+    @utils.synchronized('iptables', external=True)
+    def do_refresh_security_group_members(self, security_group):
+        """Bring the ipsets of a group in line with its current members.
+
+        Only the addresses that joined or left are added to or deleted
+        from the sets; the iptables rules referencing them stay as they
+        are.
+
+        """
+        if security_group in self.ipsets:
+            self._sync_ipset(security_group)
 
     def refresh_security_group_rules(self, security_group, network_info=None):
         self.do_refresh_security_group_rules(security_group, network_info)
         self.iptables.apply()
+        self._destroy_stale_ipsets()
 
     @utils.synchronized('iptables', external=True)
     def do_refresh_security_group_rules(self,
                                         security_group,
                                         network_info=None):
-        for instance in self.instances.values():
-            self.remove_filters_for_instance(instance)
-            if not network_info:
-                network_info = netutils.get_network_info(instance)
-            self.add_filters_for_instance(instance, network_info)
+        """Recompile the shared chain of a single security group.
 
-    def refresh_provider_fw_rules(self):
+        Instance chains only jump to the group chain, so they are left
+        alone. Groups with no instances on this host are ignored.
+
+        """
+        if security_group not in self.security_group_instances:
+            LOG.debug(_('Security group %s has no instances on this host, '
+                        'not refreshing'), security_group)
+            return
+        self._compile_security_group(security_group)
+        self._fill_security_group_chain(security_group)
+
+    def refresh_provider_fw_rules(self, rules=None):
         """See class:FirewallDriver: docs."""
-        self._do_refresh_provider_fw_rules()
+        self._do_refresh_provider_fw_rules(rules)
         self.iptables.apply()
 
     @utils.synchronized('iptables', external=True)
-    def _do_refresh_provider_fw_rules(self):
+    def _do_refresh_provider_fw_rules(self, rules=None):
         """Internal, synchronized version of refresh_provider_fw_rules."""
         self._purge_provider_fw_rules()
-        self._build_provider_fw_rules()
+        self._build_provider_fw_rules(rules)
 
     def _purge_provider_fw_rules(self):
         """Remove all rules from the provider chains."""
@@ -752,12 +1016,12 @@ class IptablesFirewallDriver(FirewallDriver):
         if FLAGS.use_ipv6:
             self.iptables.ipv6['filter'].empty_chain('provider')
 
-    def _build_provider_fw_rules(self):
+    def _build_provider_fw_rules(self, rules=None):
         """Create all rules for the provider IP DROPs."""
         self.iptables.ipv4['filter'].add_chain('provider')
         if FLAGS.use_ipv6:
             self.iptables.ipv6['filter'].add_chain('provider')
-        ipv4_rules, ipv6_rules = self._provider_rules()
+        ipv4_rules, ipv6_rules = self._provider_rules(rules)
         for rule in ipv4_rules:
             self.iptables.ipv4['filter'].add_rule('provider', rule)
 
@@ -765,12 +1029,13 @@ class IptablesFirewallDriver(FirewallDriver):
             for rule in ipv6_rules:
                 self.iptables.ipv6['filter'].add_rule('provider', rule)
 
-    def _provider_rules(self):
+    def _provider_rules(self, rules=None):
         """Generate a list of rules from provider for IP4 & IP6."""
-        ctxt = context.get_admin_context()
         ipv4_rules = []
         ipv6_rules = []
-        rules = db.provider_fw_rule_get_all(ctxt)
+        if rules is None:
+            ctxt = context.get_admin_context()
+            rules = db.provider_fw_rule_get_all(ctxt)
         for rule in rules:
             LOG.debug(_('Adding provider rule: %s'), rule['cidr'])
             version = netutils.get_ip_version(rule['cidr'])
@@ -18,8 +18,13 @@
 """
 Utility classes for defining the time saving transfer of data from the reader
 to the write using a LightQueue as a Pipe between the reader and the writer.
+
+The reader and writer only yield to each other when the pipe is full or
+empty, so the transfer runs as fast as the slower of the two allows.
 """
 
+import time
+
 from eventlet import event
 from eventlet import greenthread
 from eventlet.queue import LightQueue
@@ -31,7 +36,9 @@ from nova import log as logging
 
 LOG = logging.getLogger("nova.virt.vmwareapi.io_util")
 
-IO_THREAD_SLEEP_TIME = .01
+# Glance is polled soon after the upload and then less and less often, up
+# to every GLANCE_POLL_INTERVAL seconds.
+GLANCE_FIRST_POLL_INTERVAL = .5
 GLANCE_POLL_INTERVAL = 5
 
 
@@ -43,12 +50,17 @@ class ThreadSafePipe(LightQueue):
         LightQueue.__init__(self, maxsize)
         self.transfer_size = transfer_size
         self.transferred = 0
+        # Times the writer found the pipe empty and the reader found it full
+        self.read_waits = 0
+        self.write_waits = 0
 
     def read(self, chunk_size):
         """Read data from the pipe. Chunksize if ignored for we have ensured
         that the data chunks written to the pipe by readers is the same as the
         chunks asked for by the Writer."""
         if self.transferred < self.transfer_size:
+            if self.empty():
+                self.read_waits += 1
             data_item = self.get()
             self.transferred += len(data_item)
             return data_item
@@ -57,6 +69,8 @@ class ThreadSafePipe(LightQueue):
 
     def write(self, data):
         """Put a data item in the pipe."""
+        if self.full():
+            self.write_waits += 1
         self.put(data)
 
     def close(self):
@@ -85,6 +99,7 @@ class GlanceWriteThread(object):
                                             image_meta=self.image_meta,
                                             image_data=self.input)
             self._running = True
+            poll_interval = GLANCE_FIRST_POLL_INTERVAL
             while self._running:
                 try:
                     image_status = \
@@ -101,7 +116,9 @@ class GlanceWriteThread(object):
                         LOG.exception(exc_msg)
                         self.done.send_exception(exception.Error(exc_msg))
                     elif image_status in ["saving", "queued"]:
-                        greenthread.sleep(GLANCE_POLL_INTERVAL)
+                        greenthread.sleep(poll_interval)
+                        poll_interval = min(poll_interval * 2,
+                                            GLANCE_POLL_INTERVAL)
                     else:
                         self.stop()
                         exc_msg = _("Glance image "
@@ -132,11 +149,14 @@ class IOThread(object):
     """Class that reads chunks from the input file and writes them to the
     output file till the transfer is completely done."""
 
-    def __init__(self, input, output):
+    def __init__(self, input, output, chunk_size=None):
         self.input = input
         self.output = output
+        self.chunk_size = chunk_size
         self._running = False
         self.got_exception = False
+        self.transferred = 0
+        self.elapsed = 0
 
     def start(self):
         self.done = event.Event()
@@ -145,14 +165,17 @@ class IOThread(object):
             """Read data from the input and write the same to the output
             until the transfer completes."""
             self._running = True
+            start = time.time()
             while self._running:
                 try:
-                    data = self.input.read(None)
+                    data = self.input.read(self.chunk_size)
                     if not data:
                         self.stop()
+                        self.elapsed = time.time() - start
                         self.done.send(True)
+                        break
                     self.output.write(data)
-                    greenthread.sleep(IO_THREAD_SLEEP_TIME)
+                    self.transferred += len(data)
                 except Exception, exc:
                     self.stop()
                     LOG.exception(exc)
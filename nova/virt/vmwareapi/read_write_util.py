@@ -171,11 +171,9 @@ class VmWareHTTPReadFile(VMwareHTTPFile):
         VMwareHTTPFile.__init__(self, conn)
 
     def read(self, chunk_size):
-        """Read a chunk of data."""
-        # We are ignoring the chunk size passed for we want the pipe to hold
-        # data items of the chunk-size that Glance Client uses for read
-        # while writing.
-        return self.file_handle.read(READ_CHUNKSIZE)
+        """Read a chunk of data, by default of the chunk-size that Glance
+        Client uses for read while writing."""
+        return self.file_handle.read(chunk_size or READ_CHUNKSIZE)
 
     def get_size(self):
         """Get size of the file to be read."""
@@ -18,6 +18,8 @@
 Utility functions for Image transfer.
 """
 
+import time
+
 from nova import exception
 from nova import flags
 import nova.image
@@ -28,8 +30,13 @@ from nova.virt.vmwareapi import read_write_util
 LOG = logging.getLogger("nova.virt.vmwareapi.vmware_images")
 
 FLAGS = flags.FLAGS
-
-QUEUE_BUFFER_SIZE = 10
+flags.DEFINE_integer('vmwareapi_transfer_queue_size', 10,
+                     'number of image chunks in flight between the reader '
+                     'and the writer of an image transfer')
+flags.DEFINE_integer('vmwareapi_transfer_chunk_size',
+                     read_write_util.READ_CHUNKSIZE,
+                     'bytes read from the ESX datastore at a time when '
+                     'transferring an image')
 
 
 def start_transfer(read_file_handle, data_size, write_file_handle=None,
@@ -37,15 +44,20 @@ def start_transfer(read_file_handle, data_size, write_file_handle=None,
     """Start the data transfer from the reader to the writer.
     Reader writes to the pipe and the writer reads from the pipe. This means
     that the total transfer time boils down to the slower of the read/write
-    and not the addition of the two times."""
+    and not the addition of the two times.
+
+    Returns the number of bytes moved, the seconds it took, and how many
+    times the reader waited on the writer and the writer on the reader."""
     # The pipe that acts as an intermediate store of data for reader to write
     # to and writer to grab from.
-    thread_safe_pipe = io_util.ThreadSafePipe(QUEUE_BUFFER_SIZE, data_size)
+    thread_safe_pipe = io_util.ThreadSafePipe(
+            FLAGS.vmwareapi_transfer_queue_size, data_size)
     # The read thread. In case of glance it is the instance of the
     # GlanceFileRead class. The glance client read returns an iterator
     # and this class wraps that iterator to provide datachunks in calls
     # to read.
-    read_thread = io_util.IOThread(read_file_handle, thread_safe_pipe)
+    read_thread = io_util.IOThread(read_file_handle, thread_safe_pipe,
+                                   FLAGS.vmwareapi_transfer_chunk_size)
 
     # In case of Glance - VMWare transfer, we just need a handle to the
     # HTTP Connection that is to send transfer data to the VMWare datastore.
@@ -59,12 +71,22 @@ def start_transfer(read_file_handle, data_size, write_file_handle=None,
         write_thread = io_util.GlanceWriteThread(thread_safe_pipe,
                                          glance_client, image_id, image_meta)
     # Start the read and write threads.
+    start = time.time()
     read_event = read_thread.start()
     write_event = write_thread.start()
     try:
         # Wait on the read and write events to signal their end
         read_event.wait()
         write_event.wait()
+        stats = {'bytes': read_thread.transferred,
+                 'seconds': time.time() - start,
+                 'reader_waits': thread_safe_pipe.write_waits,
+                 'writer_waits': thread_safe_pipe.read_waits}
+        LOG.debug(_("Transferred %(bytes)d bytes in %(seconds).2f seconds, "
+                    "the reader waited on the writer %(reader_waits)d "
+                    "times and the writer on the reader %(writer_waits)d "
+                    "times") % stats)
+        return stats
     except Exception, exc:
         # In case of any of the reads or writes raising an exception,
         # stop the threads so that we un-necessarily don't keep the other one
@@ -50,7 +50,10 @@ class API(base.Base):
             if not size:
                 size = snapshot['volume_size']
 
-        if quota.allowed_volumes(context, 1, size) < 1:
+        try:
+            reservations = quota.reserve(context, volumes=1,
+                                         gigabytes=int(size))
+        except exception.OverQuota:
             pid = context.project_id
             LOG.warn(_("Quota exceeded for %(pid)s, tried to create"
                     " %(size)sG volume") % locals())
@@ -68,7 +71,12 @@ class API(base.Base):
             'display_name': name,
             'display_description': description}
 
-        volume = self.db.volume_create(context, options)
+        try:
+            volume = self.db.volume_create(context, options)
+        except Exception:
+            quota.rollback(context, reservations)
+            raise
+        quota.commit(context, reservations)
         rpc.cast(context,
                  FLAGS.scheduler_topic,
                  {"method": "create_volume",
@@ -110,6 +118,9 @@ class API(base.Base):
             return self.db.volume_get_all(context)
         return self.db.volume_get_all_by_project(context, context.project_id)
 
+    def get_all_by_ids(self, context, volume_ids):
+        return self.db.volume_get_all_by_ids(context, volume_ids)
+
     def get_snapshot(self, context, snapshot_id):
         rv = self.db.snapshot_get(context, snapshot_id)
         return dict(rv.iteritems())
@@ -48,6 +48,7 @@ from nova import exception
 from nova import flags
 from nova import log as logging
 from nova import manager
+from nova import quota
 from nova import utils
 
 
@@ -158,7 +159,12 @@ class VolumeManager(manager.SchedulerDependentManager):
                                   {'status': 'error_deleting'})
             raise
 
+        reservations = quota.reserve(context,
+                                     project_id=volume_ref['project_id'],
+                                     volumes=-1,
+                                     gigabytes=-volume_ref['size'])
         self.db.volume_destroy(context, volume_id)
+        quota.commit(context, reservations)
         LOG.debug(_("volume %s: deleted successfully"), volume_ref['name'])
         return True
 